@@ -7,6 +7,16 @@
 # from around them to create patches. It can also use already made .mat datasets.
 #################################################################################
 
+import os                                   # Import os to manage the paths of the memory-mapped stores
+import json                                 # Import json to save the metadata of the memory-mapped stores
+import hashlib                              # Import hashlib to identify the source files of the patch banks
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor     # Import pools of workers to load patients concurrently
+import multiprocessing                      # Import multiprocessing to fork the workers that train the cross-validation folds
+from collections import OrderedDict, deque  # Import OrderedDict to keep the least recently used patient cubes and deque to bound the submitted loads
+import itertools                            # Import itertools to submit the patient loads in a bounded window
+import threading                            # Import threading to prefetch batches in the background
+import queue                                # Import queue to bound the number of prefetched batches
+import warnings                             # Import warnings to warn when the patient cubes memory budget is too small
 import numpy as np                          # Import numpy
 import torch                                # Import PyTorch
 from scipy.io import loadmat                # Import scipy.io to load .mat files
@@ -32,13 +42,15 @@ class DatasetManager:
     #*#### DEFINED METHODS #####
     #*
 
-    def __init__(self, batch_size = 64):
+    def __init__(self, batch_size = 64, dtype = np.float32):
         """
         Define the constructor of 'DatasetManager' class. It only works with '_dataset.mat' files.
 
         Inputs
         ----------
         - 'batch_size': Integer. Size of each data batch.
+        - 'dtype':      Numpy data type of the loaded samples and batches. Use the same precision as the model (np.float32 for 'torch.float')
+                        so that 'batch_to_tensor()' does not need to copy the batches.
 
         Attributes
         ----------
@@ -53,6 +65,7 @@ class DatasetManager:
         #* CREATE ATTRIBUTES FOR THE INSTANCES
         # Global attributes
         self.batch_size = batch_size
+        self.dtype = dtype
 
         #* Attributes related to '_dataset.mat' files 
         self.patients_list = []
@@ -93,7 +106,7 @@ class DatasetManager:
 
         return (np.where(temp_labels == np.amax(temp_labels))[0] + 1)   # Return the label containing the largest amount of elements (+1 since np.where returns the index starting at 0)
 
-    def load_patient_datasets(self, patients_list, dir_path):
+    def load_patient_datasets(self, patients_list, dir_path, dir_store = None):
         """
         Load all patient '.mat' datasets from the input list 'patients_list'. It saves the data in 2 'DatasetManager' attributes, 'self.data' and 'self.label4Classes'. 
         If more than 1 patient is given in the list, the data is appended to those attributes, so that each index in the attribute corresponds to 1 single patient.
@@ -104,6 +117,8 @@ class DatasetManager:
         ----------
         - 'patients_list': Python list including the strings ID for each patient
         - 'dir_path': String that includes the path directory where the files are
+        - 'dir_store': (Optional) String with the path directory of the memory-mapped stores. If given, every '_dataset.mat' file is converted
+                       only once to a binary store (see 'load_mat_store()') and next loads open it with 'np.memmap' instead of parsing the '.mat' file.
         """
 
         #*################
@@ -125,55 +140,14 @@ class DatasetManager:
 
         self.patients_list = patients_list              # Save in the 'self.patients_list' attribute all patient IDs as a python list with strings
 
-        # Load the first patient image to extract
-        # Create temporary numpy array to store all samples with 1 row and as many columns as features in the first dataset patient
-        temp_data_array = np.zeros((1, loadmat(dir_path + patients_list[0] + '_dataset.mat')['data'].shape[-1]))
-        # Create temporary numpy array to store all labels and label4Classes with 1 row and 1 column 
-        temp_label_array = np.zeros((1, 1))
-        temp_label4Classes_array = np.copy(temp_label_array)
+        # Load the datasets of all patients (each file is only loaded once)
+        datasets = [load_mat_store(dir_path + patient + '_dataset.mat', ['data', 'label', 'label4Classes'], dir_store = dir_store) for patient in patients_list]
 
-        # Flag to indicate that we have deleted the first row of the temporary array,
-        # otherwise we would append always the empty row.
-        deleted_row = False
-
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL PATIENTS IN THE INPUT LIST.
-        #* IT ALSO APPENDS ALL DATA AND LABELS IN 'self.data' AND 
-        #* 'self.label4Classes' ATTRIBUTES
-        #*
-        for patient in patients_list:
-
-            dataset = loadmat(dir_path + patient + '_dataset.mat')                                          # Load dataset from the current patient
-
-            temp_data_array = np.vstack((temp_data_array, dataset['data']))                                 # Concatenate all samples in 'data' from the current patient
-            temp_label_array = np.vstack((temp_label_array, dataset['label']))                              # Concatenate all labels in 'label' from the current patient
-            temp_label4Classes_array = np.vstack((temp_label4Classes_array, dataset['label4Classes']))      # Concatenate all labels in 'label' from the current patient
-
-            #*############################################################
-            #* IF STATEMENT TO CHECK IF FIRST ROW OF THE TEMP ARRAY HAS
-            #* BEEN DELETED. (remember they where created with the first 
-            #* row as empty)
-            #*
-            if not (deleted_row):
-                # Delete the first empty row
-                temp_data_array = np.delete(temp_data_array, 0, axis = 0)
-                temp_label_array = np.delete(temp_label_array, 0, axis = 0)
-                temp_label4Classes_array = np.delete(temp_label4Classes_array, 0, axis = 0)
-                # Update flag to True
-                deleted_row = True
-            #*
-            #* END OF IF
-            #*############
-
-        #*
-        #* END FOR LOOP
-        #*##############
-
-        # Store in 'self.data', 'self.label' and 'self.label4Classes' instance attributes all loaded data
-        
-        self.data = temp_data_array
-        self.label = temp_label_array.astype(int)
-        self.label4Classes = temp_label4Classes_array.astype(int)
+        # Store in 'self.data', 'self.label' and 'self.label4Classes' instance attributes all loaded data.
+        # Every attribute is concatenated with 1 single copy, which also converts the samples to 'self.dtype'.
+        self.data = np.concatenate([dataset['data'] for dataset in datasets], axis = 0).astype(self.dtype, copy = False)
+        self.label = np.concatenate([dataset['label'] for dataset in datasets], axis = 0).astype(int)
+        self.label4Classes = np.concatenate([dataset['label4Classes'] for dataset in datasets], axis = 0).astype(int)
 
         self.numUniqueLabels = len(np.unique(self.label))       # Store in the 'self.numUniqueLabels' attribute a numpy array with the number of unique classes from all stored labels
         self.numTotalSamples = self.data.shape[0]               # Store in the 'self.numTotalSamples' attribute the total number of loaded samples
@@ -204,135 +178,74 @@ class DatasetManager:
 
         largest_label = self.__largest_class()                          # Find the label with more elements
 
-        data_temp = np.copy(self.data)                                  # Create a copy of the loaded data in a temporary variable. This way, we don't delete data from the instance 'data' attribute.
-        label4Classes_temp = np.copy(self.label4Classes)                # Create a copy of the loaded label4Classes in a temporary variable. This way, we don't delete data from the instance 'label4Classes' attribute.
-
-        list_sample_batches = []
-        list_label_batches = []
-
-        #*###############################################
-        #* WHILE LOOP CREATES 1 BATCH EVERY ITERATION
-        #*
-        while data_temp.shape[0] >= self.batch_size:                # Stay in this while loop if the number of samples left in 'dataTemp' is equal or greater than 'bath_size'
-
-            list_samples = []                                       # Create empty Python list to append data samples
-            list_labels = []                                        # Create empty Python list to append data labels
-            size_current_batch = 0
-
-            num_total_samples_left =  data_temp.shape[0]
-            
-            #*#################################################
-            #* FOR LOOP ITERATES OVER EVERY LABEL AVAILABLE
-            #*
-            for label in np.unique(label4Classes_temp)[0::]:             # Iterate over all labels available
-
-                # [0::] indicates the following thing:
-                #	- '0': start a the first element of the list
-                #	- ':': end at the last element
-                #	- ':': jump in invervals of 1
-                class_indices = np.where(label4Classes_temp == label)[0]        # Extract the 'indices' where pixels are labeled as the input 'label'. [0] is to extract the indices, since np.where() returns 2 arrays.
-                                                                                # 'class_indices' is an array where each position indicates the index of every labeled pixel equal to 'label'
-                
-                #*###############################################################################
-                #* IF STATEMENT IS TO EVALUATE IF THERE ARE SAMPLES LEFT FOR THE CURRENT LABEL
-                #*
-                if ( len(class_indices) > 0 ):
-
-                    percentage =  (len(class_indices) / num_total_samples_left)     # Calculate percentage that correspond to the pixel 'labels' out of all samples left unused
-
-                    num_samples = int(round(self.batch_size * percentage))          # Calculate the number of samples to add to the batch for the current label
-
-                    if num_samples == 0: num_samples = 1
-                    
-                    #*##############################################################
-                    #* IF STATEMENT IS TO EVALUATE WHETHER OR NOT I NEED TO
-                    #*  SUBSTRACT ANY SAMPLE BECAUSE THE BATCH HAS REACH ITS LIMIT
-                    #*
-                    if ( (size_current_batch + num_samples) > self.batch_size ):
-                        samples_to_substract = ((size_current_batch + num_samples) - self.batch_size)   # Calculate the samples that need to be substracted
-                        num_samples -= samples_to_substract                                             # Update the 'num_samples' variable to comply with the 'batch_dimension' size
-                        class_indices = class_indices[0:-samples_to_substract]                          # Delete the latest samples that we are going to substract
-                    #*
-                    #* END OF IF
-                    #*############
-
-                    size_current_batch += num_samples                                                               # Update 'size_current_batch' variable to know the size of the current batch
-
-                    sample_indices = np.random.choice(len(class_indices), num_samples, replace=False)               # Randomly select a total of 'num_samples' sample indices for the batch
+        # Build the whole stratified batch plan working only with sample indices. 'batch_indices' is a Python list where
+        # each element has the indices of 1 batch, while 'left_indices' has the indices of the samples that can not fill
+        # a batch of 'batch_size' size.
+        batch_indices, left_indices = _stratified_batch_plan(self.label4Classes[:, 0], self.batch_size, largest_label)
 
-                    list_samples.append(data_temp[class_indices[sample_indices]])                                    # Store in the Python list all randomly selected samples from the current label
-                    list_labels.append(label4Classes_temp[class_indices[sample_indices]])                            # Store in the Python list all randomly selected sample labels from the current label
-
-                    data_temp = np.delete(data_temp, class_indices[sample_indices], axis = 0)                        # Remove the sampled pixels from the temporary 'data' variable
-                    label4Classes_temp = np.delete(label4Classes_temp, class_indices[sample_indices], axis = 0)      # Remove the sampled labels from the temporary 'label4Classes' variable   
-                #*
-                #* END OF IF
-                #*############
-            #*
-            #* END OF FOR LOOP
-            #*###################
-
-            # Convert both Python lists 'list_samples' and 'list_labels' to numpy arrays by using 'np.concatenate()'.
-            # This way we concatenate all pixels from all labels to be stored in 1 single variable, which would represent 1 single batch
-            single_sample_batch = np.concatenate(list_samples, axis=0)
-            single_label_batch = np.concatenate(list_labels, axis=0)
-
-            #*##################################################################
-            #* IF STATEMENT IS TO ADD ADDITIONAL SAMPLES TO THE CURRENT BATCH 
-            #* IN CASE ITS LENGHT IS LESS THAN THE ACTUAL BATCH_SIZE
-            #* (We take samples from the label with more classes)
-            #*
-            if (len(single_sample_batch) < self.batch_size):
-                # Calculate the number of elements that we need to add to the batch. Will use the 'label' with more elements
-                samples_to_add = (self.batch_size - len(single_sample_batch))
-
-                # Extract the 'indices' where pixels are labeled as the 'largest label'. [0] is to extract the indices, since np.where() returns 2 arrays.
-                class_indices_temp = np.where(label4Classes_temp == largest_label)[0]
-
-                # Randomly select a total of 'num_samples' sample indices for the batch
-                sample_indices_temp = np.random.choice(len(class_indices_temp), samples_to_add, replace=False)
-
-                # Store in the Python list all randomly selected samples and labels from the current label and the additional samples from the 'largest label' 
-                single_sample_batch = np.vstack([single_sample_batch, data_temp[class_indices_temp[sample_indices_temp]]])
-                single_label_batch = np.vstack([single_label_batch, label4Classes_temp[class_indices_temp[sample_indices_temp]]])
-
-                # Remove the additional sampled pixels and labels from the temporary 'data' and 'label4Classes variable
-                data_temp = np.delete(data_temp, class_indices_temp[sample_indices_temp], axis = 0)
-                label4Classes_temp = np.delete(label4Classes_temp, class_indices_temp[sample_indices_temp], axis = 0)
-            #*   
-            #* END OF IF
-            #*##############
-
-            list_sample_batches.append(single_sample_batch)
-            list_label_batches.append(single_label_batch)
-        #*
-        #* END OF WHILE 
-        #*################
-        
         #*########################################################
         #* IF STATEMENT IS USED TO APPEND THE REMAINING DATA 
         #* THAT CAN NOT BE USED AS A BATCH OF 'batch_size' SIZE
-        if( (data_temp.shape[0] / self.batch_size) > 0):
-            list_sample_batches.append(data_temp)
-            list_label_batches.append(label4Classes_temp)
+        if ( len(left_indices) > 0 ):
+            batch_indices.append(left_indices)
         #*   
         #* END OF IF
         #*##############
 
+        # Gather all planned samples and labels at once. Then split them in batches (np.split() returns views, no more copies are done)
+        sample_order = np.concatenate(batch_indices)
+        batch_bounds = np.cumsum([len(indices) for indices in batch_indices])[:-1]
+
+        list_sample_batches = np.split(self.data[sample_order], batch_bounds)
+        list_label_batches = np.split(self.label4Classes[sample_order], batch_bounds)
+
         return {'data':list_sample_batches, 'label4Classes':list_label_batches}
 
-    def batch_to_tensor(self, python_list, data_type):
+    def generate_batches(self, to_tensor = False, prefetch = 0, reshuffle = False, seed = None):
+        """
+        Streaming version of 'create_batches()'. Batches are planned the same way (Random Stratified Sampling), but each batch
+        is only gathered when it is needed while iterating over the returned 'BatchStream'. The stream can be iterated once per epoch
+        and passed directly to 'trainNet()' or 'CrossValidator'.
+
+        Inputs
+        ----------
+        - 'to_tensor':  Boolean. If True, batches are yielded as PyTorch tensors (without copies if the data is already 'self.dtype').
+        - 'prefetch':   Integer. Number of batches gathered in advance by a background thread (0 gathers them while iterating).
+        - 'reshuffle':  Boolean. If True, the pixels of every class are assigned again to the batches every epoch (see 'StratifiedEpochPlanner').
+        - 'seed':       Integer. Seed of the reshuffles. If None, it is drawn from 'np.random'.
+
+        Outputs
+        ----------
+        - 'BatchStream' yielding (data, label4Classes) batches.
+        """
+        # Find the label with more elements and plan all batches (pixels left are a last smaller batch, as in 'create_batches()')
+        largest_label = self.__largest_class()
+        if reshuffle:
+            planner = StratifiedEpochPlanner(self.label4Classes[:, 0], self.batch_size, largest_label, seed = seed, keep_left = True)
+            batch_indices = planner(0)
+        else:
+            planner = None
+            batch_indices, left_indices = _stratified_batch_plan(self.label4Classes[:, 0], self.batch_size, largest_label)
+            if ( len(left_indices) > 0 ):
+                batch_indices.append(left_indices)
+
+        return BatchStream(batch_indices, lambda idx: self.data[idx], lambda idx: self.label4Classes[idx], to_tensor = to_tensor, prefetch = prefetch, planner = planner)
+
+    def batch_to_tensor(self, python_list, data_type, packed = False):
         """
         Convert all numpy array batches included in a Python list to desired PyTorch tensors types.
         
         Inputs
         ----------
         - 'python_list':    Python list with batches as numpy arrays
-        - 'data_type':      PyTorch tensor type to convert the numpy array batch to desired tensor type
+        - 'data_type':      PyTorch tensor type to convert the numpy array batch to desired tensor type.
+                            If the batches already have the same data type (e.g. np.float32 for 'torch.float'), no copy is done.
+        - 'packed':         Boolean. If True, all batches are copied into 1 single contiguous tensor and returned as 'PackedBatches',
+                            which can be moved to the GPU with 1 single transfer (see 'PackedBatches').
 
         Outputs
         ----------
-        - 'tensor_batch':   Python list with batches as PyTorch tensors
+        - 'tensor_batch':   Python list with batches as PyTorch tensors ('PackedBatches' if 'packed' is True)
         """
 
         #*################
@@ -348,6 +261,9 @@ class DatasetManager:
         #* END OF ERROR CHECKER ###
         #*#########################
 
+        if packed:
+            return _pack_batches(python_list, data_type)
+
         tensor_batch = []                               # Create empty Python list to return
 
         #*###############################################################
@@ -415,7 +331,7 @@ class CubeManager:
     #*##########################
     #*#### DEFINED METHODS #####
     #*
-    def __init__(self, patch_size = 7, batch_size = 16, dic_label = None, batch_dim = '2D'):
+    def __init__(self, patch_size = 7, batch_size = 16, dic_label = None, batch_dim = '2D', dtype = np.float32, max_cube_bytes = None):
         """
         Define the constructor of 'CubeManager' class. It only works with '_cropped_Pre-processed.mat' files (GT and preProcessedImages).
 
@@ -428,6 +344,12 @@ class CubeManager:
         reference a pixel from the ground-truth and its surroundings.)
             - 2D: Pixels with spectral information. Row of 1 sample or pixel and all columns indicating spectral information.
             - 3D: Small pixel images representing spatial information ('patch_size' of heigh and width) where each pixel indicates its spectral information.
+        - 'dtype':      Numpy data type of the loaded cubes, samples and patches. Use the same precision as the model (np.float32 for 'torch.float')
+                        so that 'batch_to_tensor()' does not need to copy the batches.
+        - 'max_cube_bytes': (Optional) Integer. Memory budget (in bytes) for the patient cubes kept in memory by 'patient_cubes'. When exceeded,
+                            the least recently used cubes are released and loaded again when needed. By default (None) all cubes are kept.
+                            - Important: Stratified batches mix patients, so the budget must hold the cubes of all patients in 1 batch (usually all of them).
+                              Otherwise, cubes are loaded again in every batch (a warning is raised if it happens).
 
         Attributes
         ----------
@@ -436,12 +358,14 @@ class CubeManager:
             - 'batch_size':         Integer representing the size of each batch.
             - 'dic_label':          Python dictionary with the labels as keys and their corresponding label4Classes as values. Used to generate datasets from cubes.
             - 'batch_dim':          String indicating if batches are '2D' or '3D'.
+            - 'dtype':              Numpy data type of the loaded cubes, samples and patches.
             - 'pad_margin':         Calculated pad dimension using 'patch_size' to add to each patient cube (usefull to create 3D patches)
-            - 'max_gt_width':       Calculated maximum width of all loaded cubes. Used inside '__create_3D_batches()' to create an empty array to append all ground-truth maps and preProcessedImages.
-            - 'max_padded_width':   Calculated maximum width of all loaded and padded cubes.  Used inside '__create_3D_batches()' to create an empty array to append all ground-truth maps and preProcessedImages.
+            - 'max_gt_width':       Calculated maximum width of all loaded cubes.
+            - 'max_padded_width':   Calculated maximum width of all loaded and padded cubes.
         - Attribute related to '_cropped_Pre-processed.mat' files (GT and preProcessedImages):
             - 'patients_list':    Python list. Attribute to store all patient IDs as a python list with strings. Used when _cropped_Pre-processed.mat files are loaded.
-            - 'patient_cubes':          Python dictionary. Indeces are the patient IDs. Stores each patient 'preProcessedImage' (as cube) and 'groundTruthMap' (as gt). Dictionary keys are:
+            - 'patient_cubes':          'PatientCubeStore' (used as a Python dictionary). Indeces are the patient IDs. Stores each patient 'preProcessedImage' (as cube) and 'groundTruthMap' (as gt).
+                                        Cubes are only loaded in memory when they are accessed. Raw arrays are views of the padded ones. Dictionary keys are:
                 - 'pad_preProcessedImage':  Padded Preprocessed cubes data for every patient. Used to create the patches.
                 - 'pad_groundTruthMap':     Padded Ground truth maps for every patient. Used to create the patches.
                 - 'raw_preProcessedImage':  Raw Preprocessed cubes data for every patient. Used to predict data.
@@ -460,8 +384,9 @@ class CubeManager:
             - 'numUniqueLabels':    Integer. Attribute to store the total number of different labels once all patients have been loaded.
             - 'numTotalSamples':    Integer. Attribute to store the total number of samples once all patients have been loaded. 
             - 'numBands':           Integer. Number of loaded spectral bands
-            - 'appended_cubes':     Numpy array. All appended padded preProcessedImages cubes loaded in a single array. Generated when '__append_loaded_cubes()' is called. Used when calling '__create_3D_batches()'.
-            - 'appended_gtMaps':    Numpy array. All appended padded ground-truth maps loaded in a single array. Generated when '__append_loaded_cubes()' is called. Used when calling '__create_3D_batches()'.
+            - 'source_files':       Python dictionary. Indeces are the patient IDs. Stores the paths of the ground-truth and preProcessedImage '.mat' files of every patient.
+            - 'patch_banks':        Python list (None until 'load_patch_banks()' is called). Memory-mapped patch bank of every patient, in the order of 'patients_list'.
+                                    If loaded, '3D' patches are gathered from the banks instead of being extracted from the cubes.
         """
 
         #*################
@@ -486,6 +411,7 @@ class CubeManager:
         self.batch_size = batch_size
         self.dic_label = dic_label
         self.batch_dim = batch_dim
+        self.dtype = dtype
 
         self.pad_margin = int(np.ceil(self.patch_size/2))
         self.max_gt_width = 0
@@ -493,7 +419,7 @@ class CubeManager:
 
         #* Attribute related to '_cropped_Pre-processed.mat' files (GT and preProcessedImages)
         self.patients_list = []
-        self.patient_cubes = {}
+        self.patient_cubes = PatientCubeStore(self.pad_margin, dtype = self.dtype, max_cube_bytes = max_cube_bytes)
 
         self.data = []
         self.label = []
@@ -504,126 +430,9 @@ class CubeManager:
         self.numTotalSamples = None
         self.numBands = None
 
-        self.appended_cubes = None
-        self.appended_gtMaps = None
+        self.source_files = {}
+        self.patch_banks = None
     
-    def __get_gt_labels_coord(self, gt_map, preProcessedImage, patientNum, batch_dim):
-        """
-        (Private method) Get the coordenates for each label in the passed ground truth map
-        - Important: This method works if a call to or 'load_patient_cubes()' was made first.
-
-        Inputs
-        ----------
-        - 'gt_map':             Numpy array with the ground truth map.
-        - 'preProcessedImage':  Numpy array with the preProcessedImage.
-        - 'patientNum':         Integer to indicate the patient id of the input cube.
-
-        Outputs
-        ----------
-        - 'labels_coord': 2D numpy array with 3 columns:
-            - i) x coordenates for every labeled pixel in the ground truth map
-			- ii) y coordenates for every labeled pixel in the ground truth map
-			- iii) Label for the pixel
-        """
-
-        # Create empty array to append all label coordenates with 1 row and 3 colums (x, y, label) 
-        labels_coord = np.zeros((1,3))
-
-        # Flag to indicate that we have deleted the first row of the temporary array,
-        # otherwise we would append always the empty row.
-        deleted_row = False
-
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL PATIENTS IN THE INPUT LIST
-        #* EXCEPT THE LABEL 0, WHCIH IS UNLABELED DATA
-        #*
-        for label in np.unique(gt_map)[1::]:
-            # [1::] indicates the following thing:
-            #	> '1': start a the second element of the list
-            #	> ':': end at the last element
-            #	> ':': jump in invervals of 1
-
-            # Extract all the coordenates for the 'label' available in the Ground Truth.
-            # np.nonzero() returns a tuple of arrays, one for each dimension of gt_map == label.
-            x, y = np.nonzero(gt_map == label)
-            
-            """
-            #*############################################################
-            #* IF STATEMENT TO CHECK IF BATCHES ARE '3D' AND NEED TO USE
-            #* THE PADDED GROUND-TRUTH MAP 
-            #*
-            if (batch_dim == '3D'):
-                # If '3D' batches, sum the pad margin to the extracted coordenates. This way, we can ensure
-                # that we are using the correct coordenates for the padded ground-truth map
-                x = x + self.pad_margin
-                y = y + self.pad_margin
-            #*
-            #* END OF IF
-            #*############
-            """
-
-            # Call private method to generate dataset from the passed cube
-            self.__get_dataset_from_cube(preProcessedImage, x, y, label, patientNum)
-
-            # Create and append a 2D numpy array with 3 columns:
-			#	- x: x coordenates for every 'label' pixel
-			#	- y: y coordenates for every 'label' pixel
-			# 	- np.ones(x.shape[0],) * label]): vector with the same lenght as the number of sampled pixels of label 'l'.
-            #                                     Note: labels are passed to label4Classes!
-            labels_coord = np.vstack((labels_coord, np.array([x, y, np.ones(x.shape[0],) * label], dtype=int).transpose()))
-
-            #*############################################################
-            #* IF STATEMENT TO CHECK IF FIRST ROW OF THE TEMP ARRAY HAS
-            #* BEEN DELETED. (remember they where created with the first 
-            #* row as empty)
-            #*
-            if not (deleted_row):
-                # Delete the first empty row
-                labels_coord = np.delete(labels_coord, 0, axis = 0)
-                # Update flag to True
-                deleted_row = True
-            #*
-            #* END OF IF
-            #*############
-        #*
-        #* END FOR LOOP
-        #*##############
-
-        return labels_coord
- 
-    def __get_dataset_from_cube(self, preProcessedImage, x, y, label, patientNum):
-        """
-        (Private method) Generate a dataset from the input cube (preProcessedImage).
-        Append the dataset generated to the instance attributes 'self.data', 'self.cubes_label'
-        and 'self_cubes_label4Classes'.
-        - Important: This method works if a call to or '__get_gt_labels_coord()' was made first.
-
-        Inputs
-        ----------
-        - 'preProcessedImage':  Numpy array with the preProcessed image.
-        - 'x':                  Numpy array with the X coordenates.
-        - 'y':                  Numpy array with the Y coordenates.   
-        - 'label':              Label value of all passed X and Y coordenates.
-        - 'patientNum':         Integer to indicate the patient id of the input coordenates.    
-        """
-
-        # Append to 'self.label_coords' all coordenates from the preProcessedImage
-        self.label_coords.append( np.array([x, y, np.ones(x.shape)*patientNum]).transpose() )
-
-        # Append to 'self.data' all pixels from the preProcessedImage corresponding to the input label
-        self.data.append( preProcessedImage[x, y] )
-
-        # Create temporary array for label and label4Classes with same rows as the preProcessedImage
-        temp_array = np.ones((preProcessedImage[x, y].shape[0], 1))
-
-        # Get the label4Class from the passed label
-        label4Class = self.__label_2_label4Class(label)
-
-        # Append to 'self.cubes_label' and 'self.cubes_label4Classes' a numpy array with same
-        # rows ad the preProcessedImage but filled with different values.
-        self.label.append( temp_array*label )
-        self.label4Classes.append( temp_array*label4Class )
-
     def __label_2_label4Class(self, label):
         """
         (Private method) Extract the label4Class for the corresponding input label.
@@ -636,7 +445,7 @@ class CubeManager:
         """
         return self.dic_label.get(str(label))
 
-    def load_patient_cubes(self, patients_list, dir_path_gt, dir_par_preProcessed):
+    def load_patient_cubes(self, patients_list, dir_path_gt, dir_par_preProcessed, dir_store = None, num_workers = None, pool = 'thread'):
         """
         Load all patient '.mat' ground truth maps and its corresponding preProcessedImage from the input list 'patients_list'.
         It saves the data in 8 'CubeManager' attributes:
@@ -648,7 +457,8 @@ class CubeManager:
                                     (2D Numpy array with 3 columns: x coordenate, y coordenate, patient number as an index to indicate the order of the loaded patients)
         - 'self.numUniqueLabels':   Stores the number of unique classes from all stored labels.
         - 'self.numTotalSamples':   Stores the number of total samples loaded.
-        - 'self.patient_cubes': Python dictionary. Indeces are the patient IDs. Stores each patient 'preProcessedImage' (as cube) and 'groundTruthMap' (as gt). Dictionary keys are:
+        - 'self.patient_cubes': 'PatientCubeStore' (used as a Python dictionary). Indeces are the patient IDs. Stores each patient 'preProcessedImage' (as cube) and 'groundTruthMap' (as gt).
+                                Cubes are only kept in memory within the 'max_cube_bytes' budget and loaded again when accessed. Dictionary keys are:
                 - 'pad_preProcessedImage':  Padded Preprocessed cubes data for every patient. Used to create the patches.
                 - 'pad_groundTruthMap':     Padded Ground truth maps for every patient. Used to create the patches.
                 - 'raw_preProcessedImage':  Raw Preprocessed cubes data for every patient. Used to predict data.
@@ -663,6 +473,11 @@ class CubeManager:
         - 'patients_list':          Python list including the strings ID for each patient.
         - 'dir_path_gt':            String that includes the path directory where the ground truth files are.
         - 'dir_par_preProcessed':   String that includes the path directory where the preProcessed image files are.
+        - 'dir_store':              (Optional) String with the path directory of the memory-mapped stores. If given, every '.mat' file is converted
+                                    only once to a binary store (see 'load_mat_store()') and next loads open it with 'np.memmap' instead of parsing the '.mat' file.
+        - 'num_workers':            (Optional) Integer. Number of workers used to load, pad and extract the labels of the patients concurrently.
+                                    By default (None) patients are loaded one by one. Results are always merged in the order of 'patients_list'.
+        - 'pool':                   (Optional) String. Type of workers to use if 'num_workers' is given: 'thread' or 'process'.
         """
 
         #*################
@@ -671,6 +486,9 @@ class CubeManager:
         # Check if python list is empty
         if (len(patients_list) == 0):
             raise RuntimeError("Not expected an empty python list input. 'patients_list' is empty.")
+        # Check if the type of pool is 'thread' or 'process'
+        if not (pool == 'thread' or pool == 'process'):
+            raise RuntimeError("To load patients concurrently, please specify the type of workers. Use 'thread' or 'process' as input for 'pool'.")
         # Check if first python list element is a string
         if not ( isinstance(patients_list[0], str) ):
             raise TypeError("Expected first element of 'patients_list' to be string. Received instead element of type: ", str(type(patients_list[0])) )
@@ -685,52 +503,69 @@ class CubeManager:
         # Save in the 'self.patients_list' attribute all patient IDs as a python list with strings
         self.patients_list = patients_list
 
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL PATIENTS IN THE INPUT LIST.
-        #* IT ALSO APPENDS ALL GT MAPS AND PREPROCESSED IMAGES IN 
-        #* 'self.gtMap' AND 'self.preProcessedImage' ATTRIBUTES
-        #*
-        p = 0   # Variable to indicate with an index the loaded patient
+        # Arguments of '_load_patient_cube()' for every patient. 'patientNum' is the index of the patient in 'patients_list'.
+        patient_args = [(patient, p, dir_path_gt, dir_par_preProcessed, self.pad_margin, self.dic_label, dir_store, self.dtype) for p, patient in enumerate(patients_list)]
 
-        for patient in patients_list:
+        #*####################################################
+        #* IF ELSE STATEMENT TO LOAD PATIENTS ONE BY ONE OR
+        #* CONCURRENTLY WITH A POOL OF WORKERS. IN BOTH CASES,
+        #* THE LOADED PATIENTS ARE RETURNED IN THE ORDER OF
+        #* 'patients_list' AND MERGED 1 BY 1. WITH WORKERS, ONLY
+        #* 'num_workers' PATIENTS ARE SUBMITTED AHEAD OF THE ONE
+        #* BEING MERGED, SO NOT ALL CUBES ARE IN MEMORY AT ONCE
+        #*
+        if (num_workers is None):
+            workers = None
+            loaded_patients = map(_load_patient_cube, *zip(*patient_args))
+        else:
+            executor = ThreadPoolExecutor if (pool == 'thread') else ProcessPoolExecutor
+            workers = executor(max_workers = num_workers)
+            loaded_patients = _bounded_map(workers, _load_patient_cube, patient_args, num_workers)
+        #*
+        #* END OF IF ELSE
+        #*################
 
-            gt_mat = loadmat(dir_path_gt + 'SNAPgt' + patient + '_cropped_Pre-processed.mat')                           # Load ground truth map from the current patient
-            preProcessed_mat = loadmat(dir_par_preProcessed + 'SNAPimages' + patient + '_cropped_Pre-processed.mat')    # Load preProcessed image from the current patient
-        
-            #*####################################################################
-            #* IF STATEMENT TO CHECK IF CURRENT GROUND-TRUTH MAP IS WIDER 
-            #* THAN THE MAXIMUM GROUND TRUTH WIDTH, AND UPDATE 'self.max_gt_width'
+        # The pool of workers is always shut down, even if loading or merging any patient raises an exception
+        try:
+            #*############################################################
+            #* FOR LOOP ITERATES OVER ALL LOADED PATIENTS IN THE ORDER OF
+            #* THE INPUT LIST. IT APPENDS ALL GT MAPS, PREPROCESSED IMAGES
+            #* AND LABELED PIXELS IN THE INSTANCE ATTRIBUTES
             #*
-            if(gt_mat['groundTruthMap'].shape[1] >= self.max_gt_width):
-                self.max_gt_width = gt_mat['groundTruthMap'].shape[1]
-                self.max_padded_width = self.max_gt_width + 2*self.pad_margin
+            for patient, loaded in zip(patients_list, loaded_patients):
+
+                #*####################################################################
+                #* IF STATEMENT TO CHECK IF CURRENT GROUND-TRUTH MAP IS WIDER 
+                #* THAN THE MAXIMUM GROUND TRUTH WIDTH, AND UPDATE 'self.max_gt_width'
+                #*
+                gt_width = loaded['pad_groundTruthMap'].shape[1] - 2*self.pad_margin
+                if(gt_width >= self.max_gt_width):
+                    self.max_gt_width = gt_width
+                    self.max_padded_width = self.max_gt_width + 2*self.pad_margin
+                #*
+                #* END OF IF
+                #*############
+
+                # Append the labeled pixels of the current patient
+                self.data.append(loaded['data'])
+                self.label.append(loaded['label'])
+                self.label4Classes.append(loaded['label4Classes'])
+                self.label_coords.append(loaded['coords'])
+
+                # Add the patient to the store. Its padded cube is kept in memory only if it fits in the memory budget.
+                self.source_files[patient] = (dir_path_gt + 'SNAPgt' + patient + '_cropped_Pre-processed.mat', dir_par_preProcessed + 'SNAPimages' + patient + '_cropped_Pre-processed.mat')
+                self.patient_cubes.add(patient, self.source_files[patient][1], loaded['pad_groundTruthMap'],
+                                       loaded['label_coords'], dir_store = dir_store, pad_cube = loaded['pad_preProcessedImage'])
             #*
-            #* END OF IF
-            #*############
-            
-            # Get coordenate labels for the current patient ground truth map.
-            # Inside, it calls '__get_dataset_from_cube()' method to append data to the
-            # instance attributes 'self.data', 'self.cubes_label' and 'self.cubes_label4Classes'.
-            labels_cords = self.__get_gt_labels_coord(gt_mat['groundTruthMap'], preProcessed_mat['preProcessedImage'], patientNum = p, batch_dim = self.batch_dim)
-
-            # Apply a constant padding to the GT to the height and width dimensions
-            gt = np.pad(gt_mat['groundTruthMap'], (self.pad_margin,), 'constant')
-            # Apply a constant padding to the preProcessed cube to the height and width dimensions (not the spectral channels)
-            cube = np.pad(preProcessed_mat['preProcessedImage'], [(self.pad_margin, self.pad_margin), (self.pad_margin, self.pad_margin), (0,0)], 'constant')
-
-            self.patient_cubes[patient] = {'pad_preProcessedImage': cube, 'pad_groundTruthMap': gt,
-                                         'raw_preProcessedImage': preProcessed_mat['preProcessedImage'],'raw_groundTruthMap': gt_mat['groundTruthMap'],
-                                         'label_coords': labels_cords}
-            
-            p += 1  # Update patient number variable
-        #*
-        #* END FOR LOOP
-        #*##############
+            #* END FOR LOOP
+            #*##############
+        finally:
+            if workers is not None: workers.shutdown()
 
         # Call private instance method to concatenate properly 'self.data', 'self.cubes_label'
         # and 'self.cubes_label4Classes'. At this point they are Python lists where each element
-        # corresponds to a specific label and data for every patient loaded. (If 2 images with 5
-        # classes were loaded, these attributes would have 10 elements). That is why we call the
+        # corresponds to the labeled data of every patient loaded. (If 2 images were loaded,
+        # these attributes would have 2 elements). That is why we call the
         # 'concatenate_list_to_numpy' method, to append all data.
         self.data = self.concatenate_list_to_numpy(self.data)
         self.label = self.concatenate_list_to_numpy(self.label).astype('int')
@@ -740,80 +575,13 @@ class CubeManager:
         self.numUniqueLabels = len(np.unique(self.label))       # Store in the 'self.numUniqueLabels' attribute a numpy array with the number of unique classes from all stored labels
         self.numTotalSamples = self.data.shape[0]               # Store in the 'self.numTotalSamples' attribute the total number of loaded samples
 
-        self.__append_loaded_cubes()    # Create numpy arrays with all appended and padded ground-truth maps and preProcessedImages
-
-    def __append_loaded_cubes(self):
-        """
-        (Private method) Reads all loaded ground-truth maps and preProcessedImages and saves 2 main numpy arrays as instance attributes:
-        'self.appended_cubes' and'self.appended_gtMaps'. This method is called at the end of 'load_patient_cubes()' (when all data has been loaded).
-        These attributes include the padded ground-truth maps and preProcessedImages loaded in 'load_patient_cubes()' method.
-        """
-
-        # Calculate the number of bands length of the first loaded cube
-        self.numBands = self.patient_cubes[self.patients_list[0]]['pad_preProcessedImage'].shape[-1]
-
-        # Create first row of temp arrays used to append all ground-truth maps and preProcessedImages
-        padded_gt_maps = np.zeros((1, self.max_padded_width))
-        padded_preProcessedImages = np.zeros((1, self.max_padded_width, self.numBands))
-
-        # Flag to indicate that we have deleted the first row of the temporary array,
-        # otherwise we would append always the empty row.
-        deleted_row = False
-
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL PATIENTS IN THE INPUT LIST.
-        #*
-        for patient in self.patients_list:
-
-            # Load the patient preProcessedImage and ground-truth map
-            temp_preProcessedImage = self.patient_cubes[patient]['pad_preProcessedImage']
-            temp_gt_map = self.patient_cubes[patient]['pad_groundTruthMap']
-
-            #*############################################################
-            #* IF STATEMENT TO CHECK IF CURRENT PATIENT GROUND-TRUTH MAP 
-            #* IS SMALLER THAN THE MAXIMUM LOADED GROUND-TRUTH WIDTH
-            #*
-            if ( temp_gt_map.shape[-1] < self.max_padded_width):
-                # Calculate the padding to add (so that we can append all ground-truth maps with same width)
-                padding = self.max_padded_width - temp_gt_map.shape[-1]
-                # Add padding to the current ground-truth map and preProcessedImage to the right of the array  (to increase the width)
-                temp_preProcessedImage = np.pad(temp_preProcessedImage, [(0, 0), (0, padding), (0,0)], 'constant')
-                temp_gt_map = np.pad(temp_gt_map, [(0, 0), (0, padding)] , 'constant')
-            #*
-            #* END OF IF
-            #*############
-
-            # Concatenate the current patient cube and ground-truth map
-            padded_preProcessedImages = np.vstack((padded_preProcessedImages, temp_preProcessedImage))
-            padded_gt_maps = np.vstack((padded_gt_maps, temp_gt_map))
-
-            #*############################################################
-            #* IF STATEMENT TO CHECK IF FIRST ROW OF THE TEMP ARRAY HAS
-            #* BEEN DELETED. (remember they where created with the first 
-            #* row as empty)
-            #*
-            if not (deleted_row):
-                # Delete the first empty row
-                padded_preProcessedImages = np.delete(padded_preProcessedImages, 0, axis = 0)
-                padded_gt_maps = np.delete(padded_gt_maps, 0, axis = 0)
-                # Update flag to True
-                deleted_row = True
-            #*
-            #* END OF IF
-            #*############
-        #*
-        #* END FOR LOOP
-        #*##############
-
-        # Store appended padded ground-truth maps and preProcessedImages in the instance atributes
-        self.appended_cubes = padded_preProcessedImages
-        self.appended_gtMaps = padded_gt_maps.astype(int)
+        self.numBands = self.patient_cubes.numBands             # Store in the 'self.numBands' attribute the number of spectral bands of the loaded cubes
 
     def __largest_class(self):
         """
         (Private method) Look for the labeled class with more elements from a numpy vector.
         - If working with '2D' batches, we look at all unique labels of 'self.label4Classes' attribute.
-        - If working with '3D' batches, we look at all unique labels of 'self.appended_gtMaps' attribute (except unlabeled pixels representing 0)
+        - If working with '3D' batches, we look at all unique labels of 'self.label' attribute (labeled pixels of the ground-truth maps)
         - Important: This method works if a call to 'load_patient_datasets()' or 'load_patient_cubes()' was made first.
 
         Inputs
@@ -843,34 +611,20 @@ class CubeManager:
 
                 # Number of pixels that are 'label'
                 temp_labels[label-1] = np.count_nonzero(self.label4Classes == label)
-            
-                # Return the label containing the largest amount of elements (+1 since np.where returns the index starting at 0)
-                return (np.where(temp_labels == np.amax(temp_labels))[0] + 1)
             #*
             #* END FOR LOOP
             #*##############
+
+            # Return the label containing the largest amount of elements (+1 since np.where returns the index starting at 0)
+            return (np.where(temp_labels == np.amax(temp_labels))[0] + 1)
         
         elif (self.batch_dim == '3D'):
 
-            #*############################################################
-            #* FOR LOOP ITERATES OVER ALL AVAILABLE LABELS FROM THE
-            #* LOADED PREPROCESSED CUBES EXCEPT LABEL 0 (which is 
-            #* unlabeled data)
-            #*
-            l = 0
-            for label in np.unique(self.appended_gtMaps)[1::]:
-                # Number of pixels that are 'label'
-                temp_labels[l] = np.count_nonzero(self.appended_gtMaps == label)
-
-                l += 1
-            #*
-            #* END FOR LOOP
-            #*##############
-
-            # Return the index label containing the largest amount of elements 
-            label_index = (np.where(temp_labels == np.amax(temp_labels))[0])
+            # Extract all labels from the labeled pixels of the loaded ground-truth maps and their number of pixels
+            unique_labels, label_counts = np.unique(self.label, return_counts = True)
 
-            return np.asscalar(np.unique(self.appended_gtMaps)[1::][label_index])   # We need to use np.asscalar() because we want to retrieve the numpy scalar as a Python scalar.
+            # Return the label containing the largest amount of elements. We need to use '.item()' because we want to retrieve the numpy scalar as a Python scalar.
+            return unique_labels[np.argmax(label_counts)].item()
         #*
         #* END OF IF ELSE
         #*################
@@ -922,172 +676,52 @@ class CubeManager:
 
         largest_label = self.__largest_class()                      # Find the label with more elements
 
-        data_temp = np.copy(self.data)                              # Create a copy of the loaded data in a temporary variable. This way, we don't delete data from the instance 'data' attribute.
-        label4Classes_temp = np.copy(self.label4Classes)            # Create a copy of the loaded label4Classes in a temporary variable. This way, we don't delete data from the instance 'label4Classes' attribute.
-        label_coords_temp = np.copy(self.label_coords)              # Create a copy of the loaded label_coords in a temporary variable. This way, we don't delete data from the instance 'label_coords' attribute.
+        # Build the whole stratified batch plan working only with sample indices. 'batch_indices' is a Python list where
+        # each element has the indices of 1 batch. Samples left that can not fill a batch of 'batch_size' size are discarded.
+        batch_indices, _ = _stratified_batch_plan(self.label4Classes[:, 0], self.batch_size, largest_label)
 
+        # Create empty Python lists (they stay empty if there are not enough samples to fill 1 batch)
         list_sample_batches = []
         list_label_batches = []
         list_coords_batches = []
         list_patientNum_batches = []
 
-        #*###############################################
-        #* WHILE LOOP CREATES 1 BATCH EVERY ITERATION
-        #*
-        while data_temp.shape[0] >= self.batch_size:                # Stay in this while loop if the number of samples left in 'dataTemp' is equal or greater than 'bath_size'
-
-            list_samples = []                                       # Create empty Python list to append data samples
-            list_labels = []                                        # Create empty Python list to append data labels
-            list_coords = []                                        # Create empty Python list to append label coordenates
-            list_patientNums = []                                   # Create empty Python list to append the patient number corresponding to each label
-
-            size_current_batch = 0
-
-            num_total_samples_left =  data_temp.shape[0]
-            
-            #*#################################################
-            #* FOR LOOP ITERATES OVER EVERY LABEL AVAILABLE
-            #*
-            for label in np.unique(label4Classes_temp)[0::]:
-
-                # [0::] indicates the following thing:
-                #	- '0': start a the first element of the list
-                #	- ':': end at the last element
-                #	- ':': jump in invervals of 1
-                class_indices = np.where(label4Classes_temp == label)[0]        # Extract the 'indices' where pixels are labeled as the input 'label'. [0] is to extract the indices, since np.where() returns 2 arrays.
-                                                                                # 'class_indices' is an array where each position indicates the index of every labeled pixel equal to 'label'
-                
-                #*###############################################################################
-                #* IF STATEMENT TO EVALUATE IF THERE ARE SAMPLES LEFT FOR THE CURRENT LABEL
-                #*
-                if ( len(class_indices) > 0 ):
-
-                    percentage =  (len(class_indices) / num_total_samples_left)     # Calculate percentage that correspond to the pixel 'labels' out of all samples left unused
-
-                    num_samples = int(round(self.batch_size * percentage))          # Calculate the number of samples to add to the batch for the current label
-
-                    if num_samples == 0: num_samples = 1
-                    
-                    #*##############################################################
-                    #* IF STATEMENT TO EVALUATE WHETHER OR NOT I NEED TO
-                    #* SUBSTRACT ANY SAMPLE BECAUSE THE BATCH HAS REACH ITS LIMIT
-                    #*
-                    if ( (size_current_batch + num_samples) > self.batch_size ):
-
-                        samples_to_substract = ((size_current_batch + num_samples) - self.batch_size)   # Calculate the samples that need to be substracted
-                        num_samples -= samples_to_substract                                             # Update the 'num_samples' variable to comply with the 'batch_dimension' size
-                        class_indices = class_indices[0:-samples_to_substract]                          # Delete the latest samples that we are going to substract
-                    #*
-                    #* END OF IF
-                    #*############
-
-                    size_current_batch += num_samples                                                           # Update 'size_current_batch' variable to know the size of the current batch
-
-                    sample_indices = np.random.choice(len(class_indices), num_samples, replace=False)           # Randomly select a total of 'num_samples' sample indices for the batch
-
-                    list_samples.append(data_temp[class_indices[sample_indices]])                               # Store in the Python list all randomly selected samples from the current label
-                    list_labels.append(label4Classes_temp[class_indices[sample_indices]])                       # Store in the Python list all randomly selected sample labels from the current label
-                    list_coords.append(label_coords_temp[class_indices[sample_indices]][:, 0:-1])               # Store in the Python list all randomly selected sample label coordenates from the current label
-                    list_patientNums.append(label_coords_temp[class_indices[sample_indices]][:, -1])            # Store in the Python list the patient number of the randomly selected samples for the current label
-
-                    data_temp = np.delete(data_temp, class_indices[sample_indices], axis = 0)                       # Remove the sampled pixels from the temporary 'data_temp' variable
-                    label4Classes_temp = np.delete(label4Classes_temp, class_indices[sample_indices], axis = 0)     # Remove the sampled labels from the temporary 'label4Classes_temp' variable
-                    label_coords_temp = np.delete(label_coords_temp, class_indices[sample_indices], axis = 0)       # Remove the sampled coordenates from the temporary 'label_coords' variable
-                #*
-                #* END OF IF
-                #*############
-            #*
-            #* END OF FOR LOOP
-            #*###################
-
-            # Convert both Python lists 'list_samples' and 'list_labels' to numpy arrays by using 'np.concatenate()'.
-            # This way we concatenate all pixels from all labels to be stored in 1 single variable, which would represent 1 single batch
-            single_sample_batch = np.concatenate(list_samples, axis=0)
-            single_label_batch = np.concatenate(list_labels, axis=0)
-            single_coords_batch = np.concatenate(list_coords, axis=0)
-            single_patientNums_batch = np.concatenate(list_patientNums, axis=0)
-            # 'single_patientNums_batch' have shape (N,), but should be (N,1). That is why we do the reshape. Otherwise we would encounter errors when
-            # entering the next if statement (since when using np.vstack() at least 1 array should have (N,1) shape.)
-            single_patientNums_batch = single_patientNums_batch.reshape((len(single_patientNums_batch), 1))
-
-            #*##################################################################
-            #* IF STATEMENT TO ADD ADDITIONAL SAMPLES TO THE CURRENT BATCH 
-            #* IN CASE ITS LENGHT IS LESS THAN THE ACTUAL BATCH_SIZE
-            #* (We take samples from the label with more classes)
-            #*
-            if (len(single_sample_batch) < self.batch_size):
-                # Calculate the number of elements that we need to add to the batch. Will use the 'label' with more elements
-                samples_to_add = (self.batch_size - len(single_sample_batch))
-
-                # Extract the 'indices' where pixels are labeled as the 'largest label'. [0] is to extract the indices, since np.where() returns 2 arrays.
-                class_indices_temp = np.where(label4Classes_temp == largest_label)[0]
-
-                # Randomly select a total of 'num_samples' sample indices for the batch
-                sample_indices_temp = np.random.choice(len(class_indices_temp), samples_to_add, replace=False)
-
-                # Store in the Python list all randomly selected samples and labels from the current label and the additional samples from the 'largest label' 
-                single_sample_batch = np.vstack([single_sample_batch, data_temp[class_indices_temp[sample_indices_temp]]])
-                single_label_batch = np.vstack([single_label_batch, label4Classes_temp[class_indices_temp[sample_indices_temp]]])
-                single_coords_batch = np.vstack([single_coords_batch, label_coords_temp[class_indices_temp[sample_indices_temp]][:, 0:-1]])
-                single_patientNums_batch = np.vstack([single_patientNums_batch, label_coords_temp[class_indices_temp[sample_indices_temp]][:, -1]])
-
-                # Remove the additional sampled pixels and labels from the temporary 'data','label4Classes' and 'label_coords_temp' variables
-                data_temp = np.delete(data_temp, class_indices_temp[sample_indices_temp], axis = 0)
-                label4Classes_temp = np.delete(label4Classes_temp, class_indices_temp[sample_indices_temp], axis = 0)
-                label_coords_temp = np.delete(label_coords_temp, class_indices_temp[sample_indices_temp], axis = 0)
-            #*   
-            #* END OF IF
-            #*##############
-
-            list_sample_batches.append(single_sample_batch)
-            list_label_batches.append(single_label_batch)
-            list_coords_batches.append(single_coords_batch)
-            list_patientNum_batches.append(single_patientNums_batch)
+        #*###################################################################
+        #* IF STATEMENT TO GATHER ALL PLANNED SAMPLES, LABELS, COORDENATES
+        #* AND PATIENT NUMBERS AT ONCE. SINCE ALL BATCHES HAVE 'batch_size'
+        #* SAMPLES, 'np.split()' RETURNS VIEWS OF THE GATHERED ARRAYS.
         #*
-        #* END OF WHILE 
-        #*################
-        
-        """
-        #*########################################################
-        #* IF STATEMENT IS USED TO APPEND THE REMAINING DATA 
-        #* THAT CAN NOT BE USED AS A BATCH OF 'batch_size' SIZE
-        if( (data_temp.shape[0] / self.batch_size) > 0):
-            list_sample_batches.append(data_temp)
-            list_label_batches.append(label4Classes_temp)
-            list_coords_batches.append(label_coords_temp[:, 0:-1])
-
-            # Since 'label_coords_temp[:, -1]' extracts a 1D numpy array, we have to reshape it into a 2D numpy array
-            # This way we append the array correctly.
-            label_coords_temp = label_coords_temp[:, -1].reshape((len(label_coords_temp[:, -1]), 1))
-            list_patientNum_batches.append(label_coords_temp)
-
+        if ( len(batch_indices) > 0 ):
+            sample_order = np.concatenate(batch_indices)
+            num_batches = len(batch_indices)
+
+            list_sample_batches = np.split(self.data[sample_order], num_batches)
+            list_label_batches = np.split(self.label4Classes[sample_order], num_batches)
+            list_coords_batches = np.split(self.label_coords[sample_order, 0:-1], num_batches)
+            list_patientNum_batches = np.split(self.label_coords[sample_order, -1:], num_batches)       # Use '-1:' to keep the (N,1) shape of the patient numbers
         #*   
         #* END OF IF
         #*##############
-        """
 
         return {'data':list_sample_batches, 'label4Classes':list_label_batches, 'label_coords': list_coords_batches, 'patientNums': list_patientNum_batches}
 
     def __create_3D_batches(self):
         """
-        Create a Python dictionary with batches composed of small patches images (3D batches). It access the
-        appended ground-truth maps and appended cubes attributes to generate 3D patches. These attributes
-        were created at the end of 'load_patient_cubes()', which calls '__append_loaded_cubes()'.
+        Create a Python dictionary with batches composed of small patches images (3D batches). Batches are planned with the
+        (patientNum, x, y) coordenates of the labeled pixels stored in 'self.label_coords' and every patch is extracted from
+        the padded cube of its own patient in 'self.patient_cubes'.
         Note: If we have few samples left but they are not as big as 'batch_size', then we discard those pixels. (batches need to should be the same size for training)
         Important: This method works when '_cropped_Pre-processed.mat' files have been loaded!
 
-        Inputs
-        ----------
-        - 'python_dic': Python dictionary obtained after calling the '__create_2D_batches()' method.
-
         Outputs
         ----------
         - Python dictionary with 3 Python lists: (they are all in order, so index 0 of any key value would have information of the same sample)
             - A) key = 'cube'.          Includes 'list_cube_batch': Python list with sample of batches
             - B) key = 'label'.         Includes 'list_labels_batch': Python list with the labels of all batches in 'list_cube_batch'. Each batch has a numpy array with
-                                        - X: x coordenate of the center pixel of every batch (the ground-truth map labeled pixel)
-                                        - Y: y coordenate of the center pixel of every batch (the ground-truth map labeled pixel)
+                                        - X: x coordenate of the center pixel of every batch (in the padded ground-truth map of its patient)
+                                        - Y: y coordenate of the center pixel of every batch (in the padded ground-truth map of its patient)
                                         - Label: indicating the label of the patch (takes the ground-truth label of the center pixel)
+            - C) key = 'patientNums'.   Includes 'list_patientNum_batch': Python list with the patient identifier of every patch in 'list_cube_batch'
         """
         #*################
         #* ERROR CHECKER
@@ -1101,340 +735,290 @@ class CubeManager:
 
         largest_label = self.__largest_class()                  # Find the label with more elements
 
-        gt_maps = np.copy(self.appended_gtMaps)                 # Create a copy of the appended and padded ground-truth maps in a temporary variable. This way, we don't delete data from the instance 'appended_gtMaps' attribute.            
-        
-        # Create empty Python lists
+        # Extract once the patient, coordenates and the label of every labeled pixel
+        x, y, patientNums, labels = self.__labeled_pixels()
+
+        # Build the whole stratified batch plan working only with pixel indices. 'batch_indices' is a Python list where
+        # each element has the indices of 1 batch. Pixels left that can not fill a batch of 'batch_size' size are discarded.
+        batch_indices, _ = _stratified_batch_plan(labels, self.batch_size, largest_label)
+
+        # Create empty Python lists (they stay empty if there are not enough pixels to fill 1 batch)
         list_labels_batch = []
         list_cube_batch = []
+        list_patientNum_batch = []
 
-        #*###############################################
-        #* WHILE LOOP CREATES 1 BATCH EVERY ITERATION
+        #*###################################################################
+        #* IF STATEMENT TO GATHER ALL PLANNED COORDENATES, LABELS AND 
+        #* PATCHES AT ONCE. SINCE ALL BATCHES HAVE 'batch_size' SAMPLES,
+        #* 'np.split()' RETURNS VIEWS OF THE GATHERED ARRAYS.
         #*
-        while np.sum(gt_maps > 0) >= self.batch_size:                # Stay in this while loop if the number of samples left in 'dataTemp' is equal or greater than 'bath_size'
-
-            list_cube_samples = []                                       # Create empty Python list to append data cube samples
-            list_label_samples = []                                      # Create empty Python list to append data ground truth map label samples
-
-            size_current_batch = 0
+        if ( len(batch_indices) > 0 ):
+            sample_order = np.concatenate(batch_indices)
+            num_batches = len(batch_indices)
 
-            num_total_samples_left =  gt_maps[gt_maps > 0].shape[0]
+            # Convert every 'label' to a 'label4Class' to properly create batches and feed CNN with labels starting at 1.
+            label4Classes = self.__labels_2_label4Classes(labels[sample_order])
 
-            #*#################################################
-            #* FOR LOOP ITERATES OVER EVERY LABEL AVAILABLE
-            #*
-            for label in np.unique(gt_maps)[1::]:
-
-                # [1::] indicates the following thing:
-                #	- '1': start a the second element of the list (omit 0 labels)
-                #	- ':': end at the last element
-                #	- ':': jump in invervals of 1
+            # 2D numpy array with 3 columns (x, y, label4Class) for every planned pixel
+            label_array = np.array([x[sample_order], y[sample_order], label4Classes], dtype=int).transpose()
 
-                x, y = np.nonzero(gt_maps == label)     # Extract the x, y coordenates where pixels are labeled as the input 'label'.
+            list_labels_batch = np.split(label_array, num_batches)
+            list_cube_batch = np.split(self.__get_patches(patientNums[sample_order], x[sample_order], y[sample_order]), num_batches)
+            list_patientNum_batch = np.split(patientNums[sample_order].reshape((-1, 1)), num_batches)
+        #*   
+        #* END OF IF
+        #*##############
 
-                #*###############################################################################
-                #* IF STATEMENT TO EVALUATE IF THERE ARE SAMPLES LEFT FOR THE CURRENT LABEL
-                #*
-                if ( len(x) > 0 ):
-
-                    percentage =  (len(x) / num_total_samples_left)             # Calculate percentage that correspond to the pixel 'labels' out of all samples left unused
-
-                    num_samples = int(round(self.batch_size * percentage))      # Calculate the number of samples to add to the batch for the current label
-
-                    if num_samples == 0: num_samples = 1
-
-                    #*##############################################################
-                    #* IF STATEMENT TO EVALUATE WHETHER OR NOT I NEED TO
-                    #* SUBSTRACT ANY SAMPLE BECAUSE THE BATCH HAS REACH ITS LIMIT
-                    #*
-                    if ( (size_current_batch + num_samples) > self.batch_size ):
-
-                        samples_to_substract = ((size_current_batch + num_samples) - self.batch_size)   # Calculate the samples that need to be substracted
-                        num_samples -= samples_to_substract                                             # Update the 'num_samples' variable to comply with the 'batch_dimension' size
-                        x = x[0:-samples_to_substract]                                                  # Delete the latest samples that we are going to substract
-                        y = y[0:-samples_to_substract]                                                  # Delete the latest samples that we are going to substract
-                    #*
-                    #* END OF IF
-                    #*############
-                    
-                    size_current_batch += num_samples                                                       # Update 'size_current_batch' variable to know the size of the current batch
-
-                    sample_indices = np.random.choice(len(x), num_samples, replace=False)                   # Randomly select a total of 'num_samples' sample indices for the batch
-
-                    # Append a numpy array to the created Python list 'list_label_samples'.
-                    # We create a 2D numpy array with 3 columns including the sampled coordenates destined to the training sample and the label of the pixel.
-                    #	> x[sample_indices] --> x coordenate of label 'label' pixel
-                    #	> y[sample_indices] --> y coordenate of label 'label' pixel 
-                    # 	> np.ones(x[sample_indices].shape[0],)*label --> creates a vector with the same lenght as the number of sampled pixels of label 'l'.
-                    #										  This vector does not contain 1s but the actual value of the label!
-                    label4Class = self.__label_2_label4Class(label)     # Convert 'label' to a 'label4Class' to properly create batches and feed CNN with labels starting at 1
-                    list_label_samples.append(np.array([x[sample_indices], y[sample_indices], np.ones(x[sample_indices].shape[0],)*label4Class], dtype=int).transpose())
-                    list_cube_samples.append(self.__get_patches(x[sample_indices], y[sample_indices]))
-
-                    # Delete from the ground truth the pixel coordenates that have been used to create the patches
-                    gt_maps[x[sample_indices], y[sample_indices]] = 0
-                    
+        return {'cube': list_cube_batch, 'label': list_labels_batch, 'patientNums': list_patientNum_batch}
 
-                #*
-                #* END OF IF
-                #*############
-            #*
-            #* END OF FOR LOOP
-            #*###################
-
-            # Convert both Python lists 'list_samples' and 'list_labels' to numpy arrays by using 'np.concatenate()'.
-            # This way we concatenate all pixels from all labels to be stored in 1 single variable, which would represent 1 single batch
-            single_label_batch = np.concatenate(list_label_samples, axis = 0)
-            single_cube_batch = np.concatenate(list_cube_samples, axis = 0)
-
-            #*##################################################################
-            #* IF STATEMENT TO ADD ADDITIONAL SAMPLES TO THE CURRENT BATCH 
-            #* IN CASE ITS LENGHT IS LESS THAN THE ACTUAL BATCH_SIZE
-            #* (We take samples from the label with more classes)
-            #*
-            if (len(single_label_batch) < self.batch_size):
-                # Calculate the number of elements that we need to add to the batch. Will use the 'label' with more elements
-                samples_to_add = (self.batch_size - len(single_label_batch))
+    def __labeled_pixels(self):
+        """
+        (Private method) Return the coordenates (x, y) in the padded ground-truth maps, the patient number and the label of every labeled pixel.
+        Pixels are sorted by patient and in raster order, so that the pool from where 3D batches are planned does not depend on the label order.
+        """
+        pixel_order = np.lexsort((self.label_coords[:, 1], self.label_coords[:, 0], self.label_coords[:, -1]))
+        x = self.label_coords[pixel_order, 0] + self.pad_margin
+        y = self.label_coords[pixel_order, 1] + self.pad_margin
+        patientNums = self.label_coords[pixel_order, -1]
+        labels = self.label[pixel_order, 0]
 
-                # Extract all left coordenates where pixels are labeled as the 'largest label'.
-                x_temp, y_temp = np.where(gt_maps == largest_label)
+        return x, y, patientNums, labels
 
-                # Randomly select a total of 'num_samples' sample indices for the batch
-                sample_indices_temp = np.random.choice(len(x_temp), samples_to_add, replace=False)
+    def __labels_2_label4Classes(self, labels):
+        """
+        (Private method) Convert a numpy array of labels to label4Classes. Only unique labels are converted with the dictionary,
+        then each element takes the 'label4Class' of its label.
+        """
+        unique_labels = np.unique(labels)
+        unique_label4Classes = np.array([self.__label_2_label4Class(label) for label in unique_labels], dtype = int)
 
-                # Store in the Python list all randomly selected samples and labels from the current label and the additional samples from the 'largest label' 
-                label4Class = self.__label_2_label4Class(largest_label)     # Convert 'largest_label' to a 'label4Class' to properly create batches and feed CNN with labels starting at 1
-                single_label_batch = np.vstack([single_label_batch, np.array([x_temp[sample_indices_temp], y_temp[sample_indices_temp], np.ones(x_temp[sample_indices_temp].shape[0],)*label4Class], dtype=int).transpose()])
-                single_cube_batch = np.vstack([single_cube_batch, self.__get_patches(x_temp[sample_indices_temp], y_temp[sample_indices_temp])])
+        return unique_label4Classes[np.searchsorted(unique_labels, labels)]
 
-                # Delete from the ground truth the pixel coordenates that have been used to create the patches
-                gt_maps[x_temp[sample_indices_temp], y_temp[sample_indices_temp]] = 0
-            #*   
-            #* END OF IF
-            #*##############
+    def generate_batches(self, to_tensor = False, prefetch = 0, reshuffle = False, seed = None):
+        """
+        Streaming version of 'create_batches()'. Batches are planned the same way (Random Stratified Sampling), but each batch
+        (and its patches, for '3D' batches) is only gathered when it is needed while iterating over the returned 'BatchStream'.
+        This way, memory is bounded by the batches being used and prefetched instead of all batches. The stream can be iterated
+        once per epoch and passed directly to 'trainNet()' or 'CrossValidator'.
 
-            list_labels_batch.append(single_label_batch)
-            list_cube_batch.append(single_cube_batch)
-        
-        #*
-        #* END OF WHILE 
-        #*################
+        Inputs
+        ----------
+        - 'to_tensor':  Boolean. If True, batches are yielded as PyTorch tensors (without copies if the data is already 'self.dtype').
+        - 'prefetch':   Integer. Number of batches gathered in advance by a background thread (0 gathers them while iterating).
+        - 'reshuffle':  Boolean. If True, the pixels of every class are assigned again to the batches every epoch (see 'StratifiedEpochPlanner').
+                        Batches are only index gathers, so reshuffling costs O(N) per epoch (even less with 'load_patch_banks()').
+        - 'seed':       Integer. Seed of the reshuffles. If None, it is drawn from 'np.random'.
 
+        Outputs
+        ----------
+        - 'BatchStream' yielding batches as tuples:
+            - If '2D' batches: (data, label4Classes), same as the 'data' and 'label4Classes' keys of 'create_batches()'.
+            - If '3D' batches: (cube, label), same as the 'cube' and 'label' keys of 'create_batches()'.
         """
-        #*########################################################
-        #* IF STATEMENT IS USED TO APPEND THE REMAINING DATA 
-        #* THAT CAN NOT BE USED AS A BATCH OF 'batch_size' SIZE
-        if( (np.sum(gt_maps > 0) / self.batch_size) > 0):
-
-            # Create temporary array for the left over samples with 3 colums, (X, Y, label)
-            temp_label_array = []
-            temp_sample_array = []
+        #*################
+        #* ERROR CHECKER
+        #*
+        # Check if 'patient_cubes' instance attribute contains elements. If not, it would mean that no '_cropped_Pre-processed.mat' file has been loaded.
+        if ( len(self.patient_cubes) == 0):
+            raise RuntimeError("No '_cropped_Pre-processed.mat' file has been loaded. To use 'generate_batches()' method, please first load datasets using the 'load_patient_cubes()' method.")
+        #*    
+        #* END OF ERROR CHECKER ###
+        #*#########################
 
-            #*###################################################
-            #* FOR LOOP ITERATES OVER EVERY LABEL LEFT AVAILABLE
-            #*
-            for label in np.unique(gt_maps)[1::]:
-                # Extract the remaining coordenates
-                x_left, y_left = np.where(gt_maps == label)
+        largest_label = self.__largest_class()                  # Find the label with more elements
 
-                # Stack left over samples coordenates and label to the temporary array
-                temp_label_array.append( np.array([x_left, y_left, np.ones(x_left.shape[0],) * label]).transpose() )
-                temp_sample_array.append( self.__get_patches(x_left, y_left) )
-            
-            #*
-            #* END OF FOR LOOP
-            #*###################
+        if (self.batch_dim == '2D'):
+            planner = StratifiedEpochPlanner(self.label4Classes[:, 0], self.batch_size, largest_label, seed = seed) if reshuffle else None
+            batch_indices = planner(0) if reshuffle else _stratified_batch_plan(self.label4Classes[:, 0], self.batch_size, largest_label)[0]
 
-            # Concatenate all labels from the remaining labels and get a numpy array
-            # Append the remaining ground truth labels to 'list_gt_maps_batch'
-            # Generate patches with the remaining coordenates and append to batch list
-            list_labels_batch.append( self.concatenate_list_to_numpy(temp_label_array) ) 
-            list_cube_batch.append( self.concatenate_list_to_numpy(temp_sample_array) )  
+            return BatchStream(batch_indices, lambda idx: self.data[idx], lambda idx: self.label4Classes[idx], to_tensor = to_tensor, prefetch = prefetch, planner = planner)
 
-        #*   
-        #* END OF IF
-        #*##############
-        """
+        elif (self.batch_dim == '3D'):
+            x, y, patientNums, labels = self.__labeled_pixels()
+            planner = StratifiedEpochPlanner(labels, self.batch_size, largest_label, seed = seed) if reshuffle else None
+            batch_indices = planner(0) if reshuffle else _stratified_batch_plan(labels, self.batch_size, largest_label)[0]
+            label4Classes = self.__labels_2_label4Classes(labels)
 
-        return {'cube': list_cube_batch, 'label': list_labels_batch}
+            return BatchStream(batch_indices,
+                               lambda idx: self.__get_patches(patientNums[idx], x[idx], y[idx]),
+                               lambda idx: np.array([x[idx], y[idx], label4Classes[idx]], dtype = int).transpose(),
+                               to_tensor = to_tensor, prefetch = prefetch, planner = planner)
 
-    def create_cube_batch(self):
+    def load_patch_banks(self, dir_bank):
         """
-        Generate batches from the entire input preprocessed image, which was loaded when used
-        the 'load_patient_cubes' method of the CubeManager class.
+        Load the patch bank of every loaded patient from 'dir_bank' as read-only memory maps. A patch bank stores, for 1 patient and 1 'patch_size',
+        the contiguous patches of all its labeled pixels, their label4Classes and their coordenates. Missing banks, or banks whose source
+        '.mat' files (content hash), 'patch_size', 'dtype' or 'dic_label' changed, are built again. Then, the same banks can be shared by
+        every experiment (with or without cross-validation) that uses the same patients. Once loaded, '3D' batches are gathered from the banks.
+        - Important: This method works if a call to 'load_patient_cubes()' was made first.
 
-        Outputs
-        ---------
-        Python dictionary including 2 Python lists
-        - 'data':   Python list with all batches.
-        - 'coords': Python coordenates for every patch in the batches.
+        Inputs
+        ----------
+        - 'dir_bank':   String with the path directory of the patch banks. It is created if it does not exist.
         """
         #*################
         #* ERROR CHECKER
         #*
-        if not (len(self.patients_list) == 1):
-            raise RuntimeError("'patients_list' contains more than 1 ID. Please, create a new instance of CubeManager and load only 1 image to batch its HSI cube.")
-        #*
-        #* ERROR CHECKER
-        #*################
-
-        # Create a copy of the entire HSI padded cube from the loaded patient image
-        cube = np.copy(self.patient_cubes[self.patients_list[0]]['pad_preProcessedImage'])
-        gt = np.copy(self.patient_cubes[self.patients_list[0]]['raw_groundTruthMap'])
-        
-        # Create mask of 1s with same dimension as the loaded ground truth map
-        mask = np.ones( (gt.shape[0], gt.shape[1]) )
+        if not (self.batch_dim == '3D'):
+            raise RuntimeError("'load_patch_banks()' only works with '3D' batches. Please, create a CubeManager instance with batch_dim = '3D'.")
+        if ( len(self.patient_cubes) == 0):
+            raise RuntimeError("No '_cropped_Pre-processed.mat' file has been loaded. To use 'load_patch_banks()' method, please first load datasets using the 'load_patient_cubes()' method.")
+        #*    
+        #* END OF ERROR CHECKER ###
+        #*#########################
 
-        # Create empty Python lists to append all batches with 3D patches
-        list_cube_batch = []
-        list_coords_batch = []
+        x, y, patientNums, labels = self.__labeled_pixels()     # Extract once the patient, coordenates and the label of every labeled pixel
+        label4Classes = self.__labels_2_label4Classes(labels)
 
-        #*###############################################
-        #* WHILE LOOP CREATES 1 BATCH EVERY ITERATION
-        #*
-        while np.sum(mask > 0) >= self.batch_size:                # Stay in this while loop if the number of samples left in 'dataTemp' is equal or greater than 'bath_size'
-            
-            list_cube_samples = []                                       # Create empty Python list to append data cube samples
-            list_coord_samples = []                                      # Create empty Python list to append data ground truth map label samples
+        # Metadata that identifies the content of a patch bank (besides its patient)
+        bank_config = {'patch_size': self.patch_size, 'dtype': np.dtype(self.dtype).str, 'dic_label': self.dic_label}
 
-            # Extract the coordenates from all pixels left
-            x, y = np.nonzero(mask == 1)
+        patch_banks = []
+        #*############################################################
+        #* FOR LOOP ITERATES OVER ALL LOADED PATIENTS.
+        #* IT BUILDS THE PATCH BANK OF EVERY PATIENT IF NEEDED
+        #*
+        for p, patient in enumerate(self.patients_list):
+            bank_path = os.path.join(dir_bank, patient + '_patch' + str(self.patch_size))
+            metadata = dict(bank_config, sources = [_file_hash(path) for path in self.source_files[patient]])
 
-            # From all pixels left, extract 'self.batch_size' random coordenates without replacement
-            indices = np.random.choice(len(x), self.batch_size, replace=False)
+            if not _patch_bank_is_valid(bank_path, metadata):
+                idx = np.nonzero(patientNums == p)[0]
+                _write_patch_bank(bank_path, metadata, self.patient_cubes.pad_preProcessedImage(patient), x[idx], y[idx], label4Classes[idx], self.patch_size)
 
-            # Create a numpy array with the coordenates for the sampled indices and append to the list.
-            list_coord_samples.append( np.array([x[indices], y[indices]]).transpose() )
+            patch_banks.append(_load_patch_bank(bank_path, self.patient_cubes.pad_groundTruthMap(patient).shape))
+        #*
+        #* END FOR LOOP
+        #*##############
 
-            # Generate 3D patches from the extract coordenates using the patient HSI cube
-            # Since the mask does not have the padding, we have to add the pad_margin when accessing the cube
-            # since the cube has padding.
-            list_cube_samples.append( self.__get_patches_full_cube(x[indices] + self.pad_margin, y[indices] + self.pad_margin, cube) )
+        self.patch_banks = patch_banks
 
-            # Delete from the mask the used coordenates to create the patches
-            mask[x[indices],y[indices]] = 0
+    def get_dataloader(self, num_workers = 0, pin_memory = False, prefetch_factor = 2, reshuffle = False, seed = None):
+        """
+        Create a PyTorch 'DataLoader' that yields the same stratified '3D' batches as 'create_batches()', but extracts their
+        patches on the fly. With 'num_workers' > 0, patches are extracted in worker processes while the model is training,
+        so data preparation overlaps with the forward and backward passes. The 'DataLoader' can be passed directly to 'trainNet()'.
+        - Important: This method only works with '3D' batches.
 
-            # Convert both Python lists 'list_cube_samples' and 'list_coord_samples' to numpy arrays by using 'np.concatenate()'.
-            # This way we concatenate all pixels from all labels to be stored in 1 single variable, which would represent 1 single batch
-            cube_batch = np.concatenate(list_cube_samples, axis=0)
-            coords_batch = np.concatenate(list_coord_samples, axis=0)
+        Inputs
+        ----------
+        - 'num_workers':        Integer. Number of worker processes extracting patches (0 extracts them in the main process).
+        - 'pin_memory':         Boolean. If True, batches are copied to pinned memory (faster and asynchronous transfers to the GPU).
+        - 'prefetch_factor':    Integer. Number of batches prefetched by every worker.
+        - 'reshuffle':          Boolean. If True, the pixels of every class are assigned again to the batches every epoch (see 'StratifiedEpochPlanner').
+        - 'seed':               Integer. Seed of the reshuffles. If None, it is drawn from 'np.random'.
 
-            # Append each batch to its corresponding list
-            list_cube_batch.append(cube_batch)
-            list_coords_batch.append(coords_batch)
-        #*
-        #* END OF WHILE 
+        Outputs
+        ----------
+        - PyTorch 'DataLoader' yielding (cube, label) tensor batches (same as the 'cube' and 'label' keys of 'create_batches()').
+        """
         #*################
-
-        #*########################################################
-        #* IF STATEMENT IS USED TO APPEND THE REMAINING DATA 
-        #* THAT CAN NOT BE USED AS A BATCH OF 'batch_size' SIZE
+        #* ERROR CHECKER
         #*
-        if ( mask[mask > 0].shape[0] / self.batch_size > 0):
+        if not (self.batch_dim == '3D'):
+            raise RuntimeError("'get_dataloader()' only works with '3D' batches. Please, create a CubeManager instance with batch_dim = '3D'.")
+        if ( len(self.patient_cubes) == 0):
+            raise RuntimeError("No '_cropped_Pre-processed.mat' file has been loaded. To use 'get_dataloader()' method, please first load datasets using the 'load_patient_cubes()' method.")
+        #*    
+        #* END OF ERROR CHECKER ###
+        #*#########################
 
-            # Extract the coordenates for the remaining left pixels in the mask
-            x, y = np.nonzero(mask != 0)
-            
-            # Create a numpy array with the coordenates for the sampled indices and append to the list
-            list_coords_batch.append(np.array([x, y]).transpose())
+        largest_label = self.__largest_class()                  # Find the label with more elements
+        x, y, patientNums, labels = self.__labeled_pixels()     # Extract once the patient, coordenates and the label of every labeled pixel
 
-            # Generate 3D patches from the extract coordenates using the patient HSI cube.
-            # Since the mask does not have the padding, we have to add the pad_margin when accessing the cube
-            # since the cube has padding.
-            list_cube_batch.append(self.__get_patches_full_cube(x + self.pad_margin, y + self.pad_margin, cube))
+        sampler = StratifiedBatchSampler(labels, self.batch_size, largest_label, reshuffle = reshuffle, seed = seed)
+        dataset = PatchDataset(self.patient_cubes, self.patients_list, x, y, patientNums, self.__labels_2_label4Classes(labels), self.patch_size,
+                               dtype = self.dtype, patch_banks = self.patch_banks)
 
-        #*   
-        #* END OF IF
-        #*##############
+        # Workers are kept alive between epochs. 'prefetch_factor' can only be used with workers.
+        worker_args = {'prefetch_factor': prefetch_factor, 'persistent_workers': True} if (num_workers > 0) else {}
 
-        return {'data': list_cube_batch, 'coords': list_coords_batch}
+        # 'batch_size = None' because the sampler already yields the indices of whole batches, which are gathered at once by the dataset
+        return torch.utils.data.DataLoader(dataset, sampler = sampler, batch_size = None, num_workers = num_workers, pin_memory = pin_memory, **worker_args)
 
-    def __get_patches_full_cube(self, x, y, cube):
+    def create_cube_batch(self, batch_size = None):
         """
-        (Private method) Create 3D patches using the input coordenates and extract data from the entire
-        preprocessed cube passed as input. 
-        
+        Generate batches from the entire input preprocessed image, which was loaded when used
+        the 'load_patient_cubes' method of the CubeManager class. Pixels are batched in raster
+        order (row by row), so the last batch may have less than 'batch_size' patches.
+
         Inputs
-        ----------
-        - 'x' and 'y':  Coordenates to access the input 'cube' and use them as center coordenates
-                        for the patches.
-        - 'cube':       Numpy array. Preprocessed cube with already added padding.
+        ---------
+        - 'batch_size': Integer. Number of patches in each inference batch. If None, 'self.batch_size' is used.
 
         Outputs
-        ----------
-        - 'patches':    Numpy array with all generated patches from the centered coordenates passed as inputs.
+        ---------
+        Python dictionary including 2 Python lists
+        - 'data':   Python list with all batches.
+        - 'coords': Python coordenates for every patch in the batches.
         """
-    
-        # Create empty 'len(x)' arrays (or patches) with size: "number of bands" x "patch_size" x "patch_size" 
-        patches = np.zeros((len(x), cube.shape[-1], self.patch_size, self.patch_size))
-
-		# Extract start coordenates for 'x' and 'y' Python lists passed as parameter 
-        xs = (x - int(self.patch_size/2)).astype(int)
-        ys = (y - int(self.patch_size/2)).astype(int)
-
-		# Extract end coordenates for 'x' and 'y' Python lists passed as parameter
-        xe = xs + self.patch_size
-        ye = ys + self.patch_size
+        # Create empty Python lists to append all batches with 3D patches
+        list_cube_batch = []
+        list_coords_batch = []
 
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL PASSED PIXEL COORDENATES TO 
-        #* GENERATE PATCHES FROM THE HSI CUBES AND SAVE THEM IN
-        #* THE 'patches' VARIABLE.
+        #*###############################################
+        #* FOR LOOP APPENDS 1 BATCH EVERY ITERATION
         #*
-        for i in range(len(x)):
-            # Save inside the 'patches' variable each small 3D patch of size "number of bands" x "patch_size" x "patch_size"
-		    # Use 'self.cube' attribute which contains the 'preProcessed' image. From the 'preProcessed' image extract small patches
-		    # from the coordenates extracted.
-            patches[i,:,:,:] = np.transpose(cube[xs[i]:xe[i], ys[i]:ye[i], :], (2, 0, 1) )
-
+        for cube_batch, coords_batch in self.generate_cube_batches(batch_size = batch_size):
+            list_cube_batch.append(cube_batch)
+            list_coords_batch.append(coords_batch)
         #*
         #* END FOR LOOP
         #*##############
 
-        return patches
+        return {'data': list_cube_batch, 'coords': list_coords_batch}
+
+    def generate_cube_batches(self, batch_size = None):
+        """
+        Return a Python generator that yields batches from the entire input preprocessed image, which was loaded when used
+        the 'load_patient_cubes' method of the CubeManager class. Pixels are batched in raster order (row by row),
+        so every batch is a contiguous block of pixel coordenates and only 1 batch of patches is alive at a time.
+
+        Inputs
+        ---------
+        - 'batch_size': Integer. Number of patches in each inference batch. If None, 'self.batch_size' is used.
+
+        Outputs (every iteration)
+        ---------
+        - 'cube_batch':     Numpy array with the patches of the batch.
+        - 'coords_batch':   Numpy array with the (x, y) coordenates of every patch in the batch.
+        """
+        #*################
+        #* ERROR CHECKER
+        #*
+        if not (len(self.patients_list) == 1):
+            raise RuntimeError("'patients_list' contains more than 1 ID. Please, create a new instance of CubeManager and load only 1 image to batch its HSI cube.")
+        #*
+        #* ERROR CHECKER
+        #*################
+
+        if batch_size is None: batch_size = self.batch_size
 
-    def __get_patches(self, x, y):
+        # Extract the entire HSI padded cube and the dimensions of the ground truth map from the loaded patient image
+        cube = self.patient_cubes.pad_preProcessedImage(self.patients_list[0])
+        height, width = self.patient_cubes.raw_groundTruthMap(self.patients_list[0]).shape
+
+        return _raster_cube_batches(cube, height, width, self.pad_margin, self.patch_size, batch_size)
+
+    def __get_patches(self, patientNums, x, y):
         """
-        (Private method) Uses the input coordenates to extract patches from the appended ground-truth maps
-        and appended cubes. Patches are created with dimension (batch_size, num_features, height, width)
-        to comply with PyTorch convolutional layer requirements.
+        (Private method) Uses the input patient numbers and coordenates to extract patches from the padded cube of every patient.
+        Patches are created with dimension (batch_size, num_features, height, width) to comply with PyTorch convolutional layer requirements.
         
         Inputs
         ----------
-        - 'x' and 'y':  Coordenates to access the 'appended_gtMaps' attribute and use them as center coordenates
-                        for the patches.
+        - 'patientNums':    Index in 'self.patients_list' of the patient of every patch.
+        - 'x' and 'y':      Coordenates in the padded ground-truth map of the patient, used as center coordenates for the patches.
 
         Outputs
         ----------
         - 'patches':    Numpy array with all generated patches from the centered coordenates passed as inputs.
         """
     
-        # Create empty 'len(x)' arrays (or patches) with size: "number of bands" x "patch_size" x "patch_size" 
-        patches = np.zeros((len(x), self.appended_cubes.shape[-1], self.patch_size, self.patch_size))
-
-		# Extract start coordenates for 'x' and 'y' Python lists passed as parameter 
-        xs = (x - int(self.patch_size/2)).astype(int)
-        ys = (y - int(self.patch_size/2)).astype(int)
-
-		# Extract end coordenates for 'x' and 'y' Python lists passed as parameter
-        xe = xs + self.patch_size
-        ye = ys + self.patch_size
-
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL PASSED PIXEL COORDENATES TO 
-        #* GENERATE PATCHES FROM THE HSI CUBES AND SAVE THEM IN
-        #* THE 'patches' VARIABLE.
-        #*
-        for i in range(len(x)):
-            # Save inside the 'patches' variable each small 3D patch of size "number of bands" x "patch_size" x "patch_size"
-		    # Use 'self.cube' attribute which contains the 'preProcessed' image. From the 'preProcessed' image extract small patches
-		    # from the coordenates extracted.
-            patches[i,:,:,:] = np.transpose(self.appended_cubes[xs[i]:xe[i], ys[i]:ye[i], :], (2, 0, 1) )
-
-        #*
-        #* END FOR LOOP
-        #*##############
-
-        return patches	
+        # Gather all patches of every patient at once from its patch bank (if loaded) or from a sliding-window view of its padded cube
+        if self.patch_banks is not None:
+            return _get_patches_from_banks(self.patch_banks, patientNums, x, y)
+        return _get_patches_from_patients(self.patient_cubes, self.patients_list, patientNums, x, y, self.patch_size, dtype = self.dtype)
 
     def concatenate_list_to_numpy(self, python_list):
         """
@@ -1449,68 +1033,24 @@ class CubeManager:
         - Numpy array with all elements of the python list concatenated
         """
 
-        #*##############################################################
-        #* IF ELSE STATEMENT TO CHECK SHAPE OF THE ELEMENTS IN THE INPUT
-        #* PYTHON LIST. GENERATE DIFFERENT TEMPORARY ARRAYS DEPENDING
-        #* ON THE INPUT BATCHES (2d with shape 2 and 3d with shape 4)
-        #*
-        if ( len(python_list[0].shape) == 2 ):
-            # If entered here, we are working with data with only rows and columns (samples x wavelenghts)
-            # Some examples are: 'self.data', 'self.label4Classes', 'self.label' or 'self.labels_coords'
-            # Create temporary array of 1 empty row with same columns as the elements in the python list
-            temp_array = np.zeros((1, python_list[0].shape[-1]))
-
-        elif ( len(python_list[0].shape) == 4 ):
-            # If entered here, we are working with data with ("patch_id" x "number of bands" x "patch_size" x "patch_size")
-            # Create temporary array of 1 array of ("patch_size" x "patch_size" x "number of bands")
-            temp_array = np.zeros_like(python_list[0])[0, :, :, :].reshape(1, python_list[0].shape[1], python_list[0].shape[2], python_list[0].shape[3])
-        #*
-        #* END OF IF ELSE
-        #*################
-
-        # Flag to indicate that we have deleted the first row of the temporary array,
-        # otherwise we would append always the empty row.
-        deleted_row = False
-
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL ELEMENTS IN THE INPUT LIST
-        #* AND STACK THEM IN THE TEMPORARY ARRAY
-        #*
-        for element in python_list:
-            temp_array = np.vstack((temp_array, element))
-
-            #*############################################################
-            #* IF STATEMENT TO CHECK IF FIRST ROW OF THE TEMP ARRAY HAS
-            #* BEEN DELETED. (remember they where created with the first 
-            #* row as empty)
-            #*
-            if not (deleted_row):
-                # Delete the first empty row
-                temp_array = np.delete(temp_array, 0, axis = 0)
-                # Update flag to True
-                deleted_row = True       
-            #*
-            #* END OF IF
-            #*############
-        #*
-        #* END FOR LOOP
-        #*##############
-
-        # Return the numpy array with all elements and delete the first empty row
-        return temp_array
+        # Concatenate all elements along the first axis with 1 single copy, keeping their data type
+        return np.concatenate(python_list, axis = 0)
 
-    def batch_to_tensor(self, python_list, data_type):
+    def batch_to_tensor(self, python_list, data_type, packed = False):
         """
         Convert all numpy array batches included in a Python list to desired PyTorch tensors types.
         
         Inputs
         ----------
         - 'python_list':    Python list with batches as numpy arrays
-        - 'data_type':      PyTorch tensor type to convert the numpy array batch to desired tensor type
+        - 'data_type':      PyTorch tensor type to convert the numpy array batch to desired tensor type.
+                            If the batches already have the same data type (e.g. np.float32 for 'torch.float'), no copy is done.
+        - 'packed':         Boolean. If True, all batches are copied into 1 single contiguous tensor and returned as 'PackedBatches',
+                            which can be moved to the GPU with 1 single transfer (see 'PackedBatches').
 
         Outputs
         ----------
-        - 'tensor_batch':   Python list with batches as PyTorch tensors
+        - 'tensor_batch':   Python list with batches as PyTorch tensors ('PackedBatches' if 'packed' is True)
         """
 
         #*################
@@ -1526,6 +1066,9 @@ class CubeManager:
         #* END OF ERROR CHECKER ###
         #*#########################
 
+        if packed:
+            return _pack_batches(python_list, data_type)
+
         tensor_batch = []                               # Create empty Python list to return
 
         #*###############################################################
@@ -1575,6 +1118,452 @@ class CubeManager:
 #*#### CubeManager class  #####
 #*#############################
 
+#*#########################
+#* PatientCubeStore class
+#*
+class PatientCubeStore:
+    """
+    This class stores the patients loaded by 'CubeManager.load_patient_cubes()' and is used as a Python dictionary
+    (indeces are the patient IDs). Ground-truth maps and label coordenates (small arrays) are always kept in memory, but
+    padded preProcessedImages are only loaded when accessed and kept within a memory budget. When the budget is exceeded,
+    the least recently used cubes are released. Raw cubes and ground-truth maps are views of the padded ones.
+    """
+    def __init__(self, pad_margin, dtype = np.float32, max_cube_bytes = None):
+        """
+        Define the constructor of 'PatientCubeStore' class.
+
+        Inputs
+        ----------
+        - 'pad_margin':     Integer. Padding added to the height and width of every cube and ground-truth map.
+        - 'dtype':          Numpy data type of the loaded cubes.
+        - 'max_cube_bytes': (Optional) Integer. Memory budget (in bytes) for the cubes kept in memory. By default (None) all cubes are kept.
+                            It must hold the cubes accessed by 1 batch. If released cubes are loaded again more times than the number of patients,
+                            the store is thrashing and a warning is raised (only once).
+
+        Attributes
+        ----------
+        - 'sources':        Python dictionary with the path of the preProcessedImage '.mat' file and the memory-mapped store directory of every patient.
+        - 'gt_maps':        Python dictionary with the padded ground-truth map of every patient.
+        - 'label_coords':   Python dictionary with the label coordenates (x, y, label) of every patient.
+        - 'cubes':          OrderedDict with the padded cubes kept in memory, from the least to the most recently used.
+        - 'cube_bytes':     Integer. Memory used by the cubes kept in memory.
+        - 'numBands':       Integer. Number of spectral bands of the added cubes.
+        - 'released':       Python set with the patients whose cube has been released at least once.
+        - 'reloads':        Integer. Number of times a released cube has been loaded again.
+        """
+        self.pad_margin = pad_margin
+        self.dtype = dtype
+        self.max_cube_bytes = max_cube_bytes
+
+        self.sources = {}
+        self.gt_maps = {}
+        self.label_coords = {}
+        self.cubes = OrderedDict()
+        self.cube_bytes = 0
+        self.numBands = None
+        self.released = set()
+        self.reloads = 0
+
+    def add(self, patient, mat_path, pad_groundTruthMap, label_coords, dir_store = None, pad_cube = None):
+        """
+        Add a patient to the store. If its padded cube 'pad_cube' has already been loaded, it is kept in memory (within the memory budget).
+        Otherwise, it will be loaded from 'mat_path' (or from the memory-mapped store in 'dir_store') the first time it is accessed.
+        """
+        self.sources[patient] = (mat_path, dir_store)
+        self.gt_maps[patient] = pad_groundTruthMap
+        self.label_coords[patient] = label_coords
+
+        if pad_cube is not None:
+            self.numBands = pad_cube.shape[-1]
+            self.__keep_cube(patient, pad_cube)
+
+    def __keep_cube(self, patient, pad_cube):
+        """
+        (Private method) Keep 'pad_cube' in memory as the most recently used cube and release the least recently used
+        cubes if the memory budget is exceeded. The cube of 'patient' is never released here.
+        """
+        if patient in self.cubes:
+            self.cube_bytes -= self.cubes.pop(patient).nbytes
+        self.cubes[patient] = pad_cube
+        self.cube_bytes += pad_cube.nbytes
+
+        while (self.max_cube_bytes is not None) and (self.cube_bytes > self.max_cube_bytes) and (len(self.cubes) > 1):
+            released_patient, released_cube = self.cubes.popitem(last = False)
+            self.cube_bytes -= released_cube.nbytes
+            self.released.add(released_patient)
+
+    def pad_preProcessedImage(self, patient):
+        """
+        Return the padded cube of 'patient'. It is loaded if it is not in memory.
+        """
+        if patient in self.cubes:
+            self.cubes.move_to_end(patient)
+            return self.cubes[patient]
+
+        # Count the cubes loaded again after being released. More reloads than patients means that the memory budget
+        # can not hold the cubes of 1 batch, so cubes are loaded again every batch.
+        if patient in self.released:
+            self.reloads += 1
+            if self.reloads == len(self.sources) + 1:
+                warnings.warn("'PatientCubeStore' is loading released cubes again repeatedly (" + str(self.reloads) + " reloads). 'max_cube_bytes' (" +
+                              str(self.max_cube_bytes) + " bytes) is too small to hold the cubes of 1 batch. Increase it or use patch banks.", RuntimeWarning)
+
+        mat_path, dir_store = self.sources[patient]
+        preProcessedImage = load_mat_store(mat_path, ['preProcessedImage'], dir_store = dir_store)['preProcessedImage']
+        pad_cube = _pad_array(preProcessedImage, self.pad_margin, dtype = self.dtype)
+        self.numBands = pad_cube.shape[-1]
+        self.__keep_cube(patient, pad_cube)
+
+        return pad_cube
+
+    def pad_groundTruthMap(self, patient):
+        """
+        Return the padded ground-truth map of 'patient'.
+        """
+        return self.gt_maps[patient]
+
+    def raw_preProcessedImage(self, patient):
+        """
+        Return the cube of 'patient' without padding (view of its padded cube).
+        """
+        return _unpad_array(self.pad_preProcessedImage(patient), self.pad_margin)
+
+    def raw_groundTruthMap(self, patient):
+        """
+        Return the ground-truth map of 'patient' without padding (view of its padded ground-truth map).
+        """
+        return _unpad_array(self.gt_maps[patient], self.pad_margin)
+
+    def __getitem__(self, patient):
+        """
+        Return a Python dictionary with the same keys used by 'CubeManager.patient_cubes' for the input 'patient'.
+        Accessing it loads the cube of the patient if it is not in memory.
+        """
+        pad_cube = self.pad_preProcessedImage(patient)
+        return {'pad_preProcessedImage': pad_cube, 'pad_groundTruthMap': self.gt_maps[patient],
+                'raw_preProcessedImage': _unpad_array(pad_cube, self.pad_margin), 'raw_groundTruthMap': self.raw_groundTruthMap(patient),
+                'label_coords': self.label_coords[patient]}
+
+    def __contains__(self, patient):
+        return patient in self.sources
+
+    def __iter__(self):
+        return iter(self.sources)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def keys(self):
+        return self.sources.keys()
+#*
+#* PatientCubeStore class
+#*#########################
+
+#*##############################################
+#* PatchDataset and StratifiedBatchSampler classes
+#*
+class PatchDataset(torch.utils.data.Dataset):
+    """
+    PyTorch 'Dataset' with the labeled pixels loaded by a 'CubeManager'. Indexing it with the sample indices of a whole batch
+    (as yielded by 'StratifiedBatchSampler') extracts all patches of the batch at once from the padded cube of every patient.
+    It is created by 'CubeManager.get_dataloader()'.
+    """
+    def __init__(self, patient_cubes, patients_list, x, y, patientNums, label4Classes, patch_size, dtype = np.float32, patch_banks = None):
+        """
+        Define the constructor of 'PatchDataset' class.
+
+        Inputs
+        ----------
+        - 'patient_cubes':  'PatientCubeStore' with the padded cube of every patient.
+        - 'patients_list':  Python list with the patient IDs. 'patientNums' are indices of this list.
+        - 'x' and 'y':      Numpy arrays with the coordenates of every labeled pixel in the padded ground-truth map of its patient.
+        - 'patientNums':    Numpy array with the patient number of every labeled pixel.
+        - 'label4Classes':  Numpy array with the label4Class of every labeled pixel.
+        - 'patch_size':     Integer. Height and width of the patches.
+        - 'dtype':          Numpy data type of the patches.
+        - 'patch_banks':    (Optional) Python list with the patch bank of every patient (see 'CubeManager.load_patch_banks()'). If given, patches are gathered from the banks.
+        """
+        self.patient_cubes = patient_cubes
+        self.patients_list = patients_list
+        self.x = x
+        self.y = y
+        self.patientNums = patientNums
+        self.label4Classes = label4Classes
+        self.patch_size = patch_size
+        self.dtype = dtype
+        self.patch_banks = patch_banks
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, idx):
+        """
+        Return the (patches, labels) tensors of the input sample indices. Labels have 3 columns (x, y, label4Class).
+        """
+        idx = np.asarray(idx)
+        if self.patch_banks is not None:
+            patches = _get_patches_from_banks(self.patch_banks, self.patientNums[idx], self.x[idx], self.y[idx])
+        else:
+            patches = _get_patches_from_patients(self.patient_cubes, self.patients_list, self.patientNums[idx], self.x[idx], self.y[idx], self.patch_size, dtype = self.dtype)
+        labels = np.array([self.x[idx], self.y[idx], self.label4Classes[idx]], dtype = int).transpose()
+
+        return torch.from_numpy(patches), torch.from_numpy(labels)
+
+class StratifiedBatchSampler(torch.utils.data.Sampler):
+    """
+    PyTorch 'Sampler' that yields the sample indices of whole batches following the Random Stratified Sampling
+    planned with '_stratified_batch_plan()' (the same used by 'create_batches()'). Samples left that can not fill
+    a batch of 'batch_size' size are discarded. With 'reshuffle', batches are planned again every epoch with a 'StratifiedEpochPlanner'.
+    """
+    def __init__(self, labels, batch_size, largest_label, reshuffle = False, seed = None):
+        """
+        Define the constructor of 'StratifiedBatchSampler' class.
+
+        Inputs
+        ----------
+        - 'labels':         Numpy 1D array with the label of every sample.
+        - 'batch_size':     Integer. Size of each batch.
+        - 'largest_label':  Label with more samples, used to complete batches.
+        - 'reshuffle':      Boolean. If True, samples of every class are assigned again to the batches every epoch.
+        - 'seed':           Integer. Seed of the reshuffles. If None, it is drawn from 'np.random'.
+        """
+        self.planner = StratifiedEpochPlanner(labels, batch_size, largest_label, seed = seed) if reshuffle else None
+        self.batch_indices = self.planner(0) if reshuffle else _stratified_batch_plan(labels, batch_size, largest_label)[0]
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.batch_indices)
+
+    def __iter__(self):
+        if self.planner is not None:
+            self.batch_indices = self.planner(self.epoch)
+            self.epoch += 1
+        return iter(self.batch_indices)
+#*
+#* PatchDataset and StratifiedBatchSampler classes
+#*##################################################
+
+#*###############################
+#* StratifiedEpochPlanner class
+#*
+class StratifiedEpochPlanner:
+    """
+    This class plans new batches every epoch with the Random Stratified Sampling of '_stratified_batch_plan()'. The number of samples
+    of every class in every batch only depends on the number of samples per class, so it is planned once. Every epoch, only the
+    pool of indices of every class is shuffled again and assigned to the planned positions, which is O(N) and does not gather any data.
+    Epochs are reproducible: the batches of an epoch only depend on 'seed' and the epoch number.
+    """
+    def __init__(self, labels, batch_size, largest_label, seed = None, keep_left = False):
+        """
+        Define the constructor of 'StratifiedEpochPlanner' class.
+
+        Inputs
+        ----------
+        - 'labels':         Numpy 1D array with the label of every sample.
+        - 'batch_size':     Integer. Size of each batch.
+        - 'largest_label':  Label with more samples, used to complete batches.
+        - 'seed':           Integer. Seed of the reshuffles. If None, it is drawn from 'np.random' (so 'np.random.seed()' also fixes it).
+        - 'keep_left':      Boolean. If True, samples left that can not fill a batch are planned as a last smaller batch.
+        """
+        self.sorted_indices, self.class_counts, self.batch_slots, self.left_slots = _stratified_batch_slots(labels, batch_size, largest_label)
+        self.seed = np.random.randint(0, 2**31 - 1) if seed is None else seed
+        self.keep_left = keep_left
+
+    def __call__(self, epoch):
+        """
+        Return a Python list with 1 numpy array per batch with the sample indices of every batch of the input epoch number.
+        """
+        rng = np.random.default_rng([self.seed, epoch])
+
+        # Shuffle the pool of indices of every class and put the pools one after the other, as the planned positions expect
+        class_pools = np.split(self.sorted_indices, np.cumsum(self.class_counts)[:-1])
+        pool_indices = np.concatenate([rng.permutation(pool) for pool in class_pools])
+
+        batch_indices = list(pool_indices[self.batch_slots])
+        if ( self.keep_left and len(self.left_slots) > 0 ):
+            batch_indices.append(np.sort(pool_indices[self.left_slots]))
+
+        return batch_indices
+#*
+#* END StratifiedEpochPlanner class
+#*###################################
+
+#*####################
+#* BatchStream class
+#*
+class BatchStream:
+    """
+    This class is an iterable over planned batches that gathers every batch only when it is needed. It is returned by
+    the 'generate_batches()' methods of 'DatasetManager' and 'CubeManager'. Every iteration (for example, every epoch)
+    yields all batches again in the same order as tuples (data, labels), unless a 'planner' plans the batches of every epoch.
+    It can be passed directly to 'trainNet()' and 'CrossValidator'.
+    """
+    def __init__(self, batch_indices, get_data, get_labels, to_tensor = False, prefetch = 0, planner = None):
+        """
+        Define the constructor of 'BatchStream' class.
+
+        Inputs
+        ----------
+        - 'batch_indices':  Python list. Each element is a numpy array with the sample indices of 1 batch.
+        - 'get_data':       Function that returns the numpy data of the input sample indices.
+        - 'get_labels':     Function that returns the numpy labels of the input sample indices.
+        - 'to_tensor':      Boolean. If True, batches are converted with 'torch.from_numpy()' (no copies are done).
+        - 'prefetch':       Integer. Number of batches gathered in advance by a background thread (0 gathers them while iterating).
+        - 'planner':        (Optional) Function that returns the 'batch_indices' of the input epoch number, like a 'StratifiedEpochPlanner'.
+                            It is called at the start of every iteration, so every epoch gets new batches.
+        """
+        self.batch_indices = batch_indices
+        self.get_data = get_data
+        self.get_labels = get_labels
+        self.to_tensor = to_tensor
+        self.prefetch = prefetch
+        self.planner = planner
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.batch_indices)
+
+    def __get_batch(self, idx):
+        """
+        (Private method) Gather the data and labels of 1 batch.
+        """
+        data, labels = self.get_data(idx), self.get_labels(idx)
+        if self.to_tensor:
+            return torch.from_numpy(data), torch.from_numpy(labels)
+        return data, labels
+
+    def __iter__(self):
+        # Plan the batches of the current epoch (only the indices change, no data is gathered here)
+        if self.planner is not None:
+            self.batch_indices = self.planner(self.epoch)
+            self.epoch += 1
+
+        #*###############################################
+        #* IF STATEMENT TO GATHER BATCHES WHILE ITERATING
+        #* IF NO BATCHES ARE PREFETCHED
+        #*
+        if (self.prefetch <= 0):
+            for idx in self.batch_indices:
+                yield self.__get_batch(idx)
+            return
+        #*
+        #* END OF IF
+        #*############
+
+        # The background thread puts up to 'prefetch' batches in the queue. The end of the stream (or an error
+        # while gathering a batch) is indicated with a last element. 'stop' ends the thread if the iteration is interrupted.
+        batches = queue.Queue(maxsize = self.prefetch)
+        stop = threading.Event()
+        end_of_stream = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout = 0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def producer():
+            try:
+                for idx in self.batch_indices:
+                    if not put(self.__get_batch(idx)):
+                        return
+                put(end_of_stream)
+            except Exception as error:
+                put(error)
+
+        thread = threading.Thread(target = producer, daemon = True)
+        thread.start()
+
+        try:
+            while True:
+                item = batches.get()
+                if item is end_of_stream:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+    def subset(self, batches):
+        """
+        Return a new 'BatchStream' with only the batches with the input indices (used to split folds without gathering any batch).
+        The subset always yields the current batches (it is not reshuffled), so its samples do not change between epochs.
+        """
+        return BatchStream([self.batch_indices[b] for b in batches], self.get_data, self.get_labels, to_tensor = self.to_tensor, prefetch = self.prefetch)
+
+    def data(self):
+        """
+        Return a generator yielding only the data of every batch (for example, to predict the batches).
+        """
+        return (data for data, _ in self)
+
+    def labels(self):
+        """
+        Return the labels of all batches concatenated in 1 numpy array. No data is gathered.
+        """
+        if (len(self.batch_indices) == 0):
+            return self.get_labels(np.zeros(0, dtype = int))
+        return self.get_labels(np.concatenate(self.batch_indices))
+#*
+#* BatchStream class
+#*####################
+
+#*######################
+#* PackedBatches class
+#*
+class PackedBatches:
+    """
+    This class packs equally sized batches as 1 single contiguous PyTorch tensor with shape (num_batches, batch_size, ...)
+    plus an optional smaller last batch (the ragged 'tail'). It is returned by 'batch_to_tensor(packed = True)' and behaves as the Python list
+    of tensors: indexing and iterating yield each batch as a view of the packed tensor. The whole set of batches is moved to
+    another device with 1 single (non-blocking) transfer with 'to()', instead of 1 transfer per batch.
+    """
+    def __init__(self, full, tail = None):
+        """
+        Define the constructor of 'PackedBatches' class.
+
+        Inputs
+        ----------
+        - 'full':   PyTorch tensor with shape (num_batches, batch_size, ...) with all batches of 'batch_size' size.
+        - 'tail':   (Optional) PyTorch tensor with the last batch, if it is smaller than 'batch_size'.
+        """
+        self.full = full
+        self.tail = tail
+
+    def __len__(self):
+        return self.full.shape[0] + (self.tail is not None)
+
+    def __getitem__(self, b):
+        if (b < 0): b += len(self)
+        if not (0 <= b < len(self)):
+            raise IndexError("Batch index out of range")
+        return self.full[b] if (b < self.full.shape[0]) else self.tail
+
+    def __iter__(self):
+        yield from self.full
+        if self.tail is not None:
+            yield self.tail
+
+    def to(self, device, non_blocking = False):
+        """
+        Return new 'PackedBatches' in the input device. The packed tensor (and the tail) is transferred at once.
+        """
+        return PackedBatches(self.full.to(device, non_blocking = non_blocking), None if self.tail is None else self.tail.to(device, non_blocking = non_blocking))
+
+    def pin_memory(self):
+        """
+        Return new 'PackedBatches' in pinned memory, so 'to(device, non_blocking = True)' is asynchronous for CUDA devices.
+        """
+        return PackedBatches(self.full.pin_memory(), None if self.tail is None else self.tail.pin_memory())
+#*
+#* END PackedBatches class
+#*##########################
+
 #*#######################
 #* CrossValidator class
 #*
@@ -1584,29 +1573,43 @@ class CrossValidator:
     over PyTorch CNN models.
     
     """
-    def __init__(self, batch_data, batch_labels, k_folds=5, numUniqueLabels=None, numBands=25, epochs=100, lr=0.01):
+    def __init__(self, batch_data, batch_labels = None, k_folds=5, numUniqueLabels=None, numBands=25, epochs=100, lr=0.01, num_workers = None, seed = None,
+                 pruning_rate = None, pruning_min_epochs = 5):
         """
         Define the constructor of 'CrossValidator' class.
 
         Inputs
         ----------
         - 'batch_data':         Python list. Batches with data. Elements can be numpy arrays or PyTorch tensors.
-        - 'batch_labels':       Python list. Batches with labels. Elements can be numpy arrays or PyTorch tensors.
+                                It can also be a 'BatchStream' (from 'generate_batches()') with data and labels. Then, folds are subsets of the stream
+                                and batches are only gathered when a model is trained or tested with them.
+        - 'batch_labels':       Python list. Batches with labels. Elements can be numpy arrays or PyTorch tensors. Not used if 'batch_data' is a 'BatchStream'.
         - 'k_folds':            Integer. Indicates the number of folds for the K-fold cross-validator.
         - 'numUniqueLabels':    Integer. Indicates the number of unique labels in the batches.
         - 'numBands':           Integer. Indicates the spectral bands included in the batches.
         - 'epochs':             Integer. Indicates the number of epochs used to train the CNN models.
         - 'lr':                 Integer. Learning rate used for the optimizer when training CNN models.
+        - 'num_workers':        Integer. Number of worker processes training the inner (Kn) folds in parallel. If None (or 1), folds are trained one after another.
+                                Workers are forked, so they share the batches with this process without copying them, and each one uses
+                                1/'num_workers' of the available cores. Parallel folds are always trained in the CPU (also in GPU nodes).
+        - 'seed':               Integer. Seed used to initialize the model of every inner fold (model Kn uses 'seed' + Kn). If None, it is drawn
+                                from the PyTorch random generator. The same seed gives the same models sequentially and in parallel when both train in the CPU.
+        - 'pruning_rate':       Integer (opt-in). If given, unpromising inner (Kn) models are stopped early with successive halving: models are validated at
+                                checkpoint epochs ('pruning_min_epochs' * 'pruning_rate'^i) and only the best 1/'pruning_rate' of the models of the same K fold
+                                (compared with the ones that already reached the same checkpoint) keep training. Stopped models can not be the best Kn model.
+                                It can not be combined with 'num_workers', since every model is compared with the models trained before it.
+        - 'pruning_min_epochs': Integer. Epoch of the first checkpoint of the pruning.
 
         Attributes
         ----------
-        - 'calibration_data_folds':     Python list. Each index element includes the numpy data batches destined to train the models for every single Kn-fold split.
-        - 'calibration_label_folds':    Python list. Each index element includes the numpy label batches destined to train the models for every single Kn-fold split.
-        - 'validation_data_folds':      Python list. Each index element includes the numpy data batches destined to validate the best models for every single Kn-fold split.
-        - 'validation_label_folds':     Python list. Each index element includes the numpy label batches destined to validate the best models for every single Kn-fold split.
-        - 'test_data_folds':            Python list. Each index element includes the numpy data batches destined to test the best models for every single K-fold split.
-        - 'test_label_folds':           Python list. Each index element includes the numpy label batches destined to test the best models for every single K-fold split.
+        - 'calibration_folds':          Python list. Each index element is a numpy array with the indices of the batches destined to train the models for every single Kn-fold split.
+        - 'validation_folds':           Python list. Each index element is a numpy array with the indices of the batches destined to validate the best models for every single Kn-fold split.
+        - 'test_folds':                 Python list. Each index element is a numpy array with the indices of the batches destined to test the best models for every single K-fold split.
+        - 'batch_data_tensor':          PyTorch tensor (num_batches, num_patches, num_features, patch_height, patch_width) with all data batches, shared by all folds.
+                                        Folds are views of this tensor, created only when a model is trained or tested with them. (None if 'batch_data' is a 'BatchStream')
+        - 'batch_labels_tensor':        PyTorch tensor (num_batches, num_patches, (x, y, label)) with all label batches, shared by all folds. (None if 'batch_data' is a 'BatchStream')
         - 'bestModel':                  Toch. PyTorch model obtained after performing a K-fold double-cross validation.
+        - 'epochs_saved':               Integer. Number of training epochs saved by the pruning in the last double-cross validation.
         """
 
         self.batch_data = batch_data
@@ -1616,40 +1619,35 @@ class CrossValidator:
         self.numBands = numBands
         self.epochs = epochs
         self.lr = lr
+        self.num_workers = num_workers
+        self.seed = seed
+        self.pruning_rate = pruning_rate
+        self.pruning_min_epochs = pruning_min_epochs
+
+        self.test_folds = None
+        self.calibration_folds = None
+        self.validation_folds = None
 
-        self.test_data_folds = None
-        self.test_label_folds = None
-        self.calibration_data_folds = None
-        self.calibration_label_folds = None
-        self.validation_data_folds = None
-        self.validation_label_folds = None
+        self.batch_data_tensor = None
+        self.batch_labels_tensor = None
 
         self.bestModel = None
+        self.epochs_saved = 0
 
     def __kfold_double_cv_split(self):
         """
-        (Private method) Uses the K-fold cross-validator from sklearn to extracts test, calibration, and validation indexes from the input Python list.
-        This method generates 3 Python lists with the batches for every K-fold and Kn-fold. Therefore, it returns the splitted data to use
-        in a double-cross validation, where each index of 'test_data_folds' is for every K iteration and each indexes of 'calibration_data_folds'
-        and 'validation_data_folds' are for every Kn iteration. (The same happens with '_label_folds' lists)
+        (Private method) Uses the K-fold cross-validator from sklearn to extracts test, calibration, and validation indexes from the input batches.
+        This method generates 3 Python lists with the indices of the batches of every K-fold and Kn-fold. Therefore, it returns the splitted batches to use
+        in a double-cross validation, where each index of 'test_folds' is for every K iteration and each indexes of 'calibration_folds'
+        and 'validation_folds' are for every Kn iteration. Folds only store indices: batches are stacked once in 'batch_data_tensor' and
+        'batch_labels_tensor' (if they are not a 'BatchStream'), and every fold takes views of them only when it is used.
         - Important: At the moment the '__kfold_double_cv_split()' can only be performed if the input Python list 'batches' contains
         elements in 3D (if it includes patches).
         """
-        # Create numpy array with same lenght as the number of batches included in the Python list
-        # This way we can extract the indices for the batches properly.
-        arr_1_loop = np.ones((len(self.batch_data), 1))
-
-        # Create empty lists to store the calibration, validation, and test batches for every K and Kn fold split.
-        test_data_folds = []
-        test_label_folds = []
-        calibration_data_folds = []
-        calibration_label_folds = []
-        validation_data_folds = []
-        validation_label_folds = []
-
-        # Convert Python lists to numpy arrays
-        batch_data_array = self.__reshape_list_to_numpy(self.batch_data)
-        batch_labels_array = self.__reshape_list_to_numpy(self.batch_labels)
+        # Create empty lists to store the calibration, validation, and test batch indices for every K and Kn fold split.
+        test_folds = []
+        calibration_folds = []
+        validation_folds = []
 
         # General KFold cross-validator using the passed number of 'k_folds'
         # Shuffle = False: consecutive folds will be the shifted version of previous fold.
@@ -1662,12 +1660,9 @@ class CrossValidator:
         #* TRAIN AND TEST.
         #* ----> FIRST CROSS-VALIDATION LOOP (K)
         #*
-        for train_k, test_k in kf.split( range(len(arr_1_loop)) ):
+        for train_k, test_k in kf.split( range(len(self.batch_data)) ):
             # Each iteration corresponds to 1 single K-fold split.
-            # Append the batches using the indexes of the current fold split to the
-            # created Python lists.
-            test_data_folds.append( batch_data_array[test_k, :, :, :, :]  )
-            test_label_folds.append( batch_labels_array[test_k, :, :]  )
+            test_folds.append( test_k )
 
             #*#########################################################
             #* FOR LOOP TO EXTRACT ALL INDEXES TO SPLIT THE BATCHES 
@@ -1676,20 +1671,12 @@ class CrossValidator:
             #* CALIBRATE AND VALIDATE.
             #* ----> SECOND CROSS-VALIDATION LOOP (Kn)
             #*
-
             for train_kn, test_kn in kf.split( range(len(train_k)) ):
                 # Each iteration corresponds to 1 single K-n fold split.
-                # Append the batches using the indexes of the current fold split to the
-                # numpy batch arrays created in the first loop of the double-cross validation.
-                # Note: 'batch_data_array[train_k, :, :, :, :]' is a numpy array with all batches for the Kn folds
-                #       Adding '[train_kn, :, :, :, :]' to the end, extracts the batches for calibration while
-                #       adding '[test_kn, :, :, :, :]' to the end, extracts the batches for validation.
-                calibration_data_folds.append( batch_data_array[train_k, :, :, :, :][train_kn, :, :, :, :] )
-                calibration_label_folds.append( batch_labels_array[train_k, :, :][train_kn, :, :] )
-
-                validation_data_folds.append( batch_data_array[train_k, :, :, :, :][test_kn, :, :, :, :] )
-                validation_label_folds.append( batch_labels_array[train_k, :, :][test_kn, :, :] )
-                
+                # Note: 'train_k' has the indices of all batches for the Kn folds. Then, 'train_k[train_kn]'
+                #       has the indices of the batches for calibration and 'train_k[test_kn]' for validation.
+                calibration_folds.append( train_k[train_kn] )
+                validation_folds.append( train_k[test_kn] )
             #*
             #* END FOR LOOP
             #*###############
@@ -1698,13 +1685,15 @@ class CrossValidator:
         #* END FOR LOOP
         #*###############
 
-        # Save all data and label folds into the instance attributes
-        self.test_data_folds = test_data_folds
-        self.test_label_folds = test_label_folds
-        self.calibration_data_folds = calibration_data_folds
-        self.calibration_label_folds = calibration_label_folds
-        self.validation_data_folds = validation_data_folds
-        self.validation_label_folds = validation_label_folds 
+        # Save all folds into the instance attributes
+        self.test_folds = test_folds
+        self.calibration_folds = calibration_folds
+        self.validation_folds = validation_folds
+
+        # Stack all batches once in the tensors shared by every fold ('BatchStream' folds are subsets of the stream instead)
+        if not isinstance(self.batch_data, BatchStream):
+            self.batch_data_tensor = torch.from_numpy(self.__reshape_list_to_numpy(self.batch_data)).type(torch.float)
+            self.batch_labels_tensor = torch.from_numpy(self.__reshape_list_to_numpy(self.batch_labels)).type(torch.LongTensor)
 
     def __reshape_list_to_numpy(self, python_list):
         """
@@ -1725,73 +1714,176 @@ class CrossValidator:
         - 'batch_array_3d': Numpy array. In case Python list has 2D. Final shape is '(num_batches, (x, y, label))'
         """
 
-        #*###############################################
-        #* IF ELSE STATEMENT TO EVALUATE THE SHAPE OF
-        #* THE INPUT PYTHON LIST
-        #*
-        if (len(python_list[0].shape) == 4):
-            # Create empty array with shape '( num_batches, num_patches, num_features, patch_height, patch_width )'
-            # The idea is to work with a numpy array where dimensions correspond to '( num_batches, num_patches, num_features, height, width )'
-            batch_array_5d = np.zeros((len(python_list), python_list[0].shape[0], python_list[0].shape[1], python_list[0].shape[2], python_list[0].shape[3]))
+        # Stack all batches in a new first dimension with 1 single copy, keeping their data type. Then, batches
+        # with data (4D) become 'batch_array_5d' and batches with labels (2D) become 'batch_array_3d'.
+        return np.stack(python_list, axis = 0)
 
-            #*############################################################
-            #* FOR LOOP ITERATES OVER ALL ELEMENTS IN THE INPUT LIST
-            #* AND STACK THEM IN THE TEMPORARY ARRAY
-            #*
-            i = 0
-            for element in python_list:
-
-                # Save inside the 'patches' variable each small 3D patch of size "number of bands" x "patch_size" x "patch_size"
-                # Use 'self.cube' attribute which contains the 'preProcessed' image. From the 'preProcessed' image extract small patches
-                # from the coordenates extracted.
-                batch_array_5d[i, :, :, :, :] = element
-                i += 1
-            
-            #*
-            #* END FOR LOOP
-            #*##############
+    def __fold_batches(self, fold):
+        """
+        (Private method) Return the (batch_x, batch_y) batches of the input fold (numpy array with batch indices) to train a model.
+        If batches are a 'BatchStream', 'batch_x' is a subset of the stream (it yields data and labels) and 'batch_y' is None.
+        Otherwise, they are Python lists with views of the shared 'batch_data_tensor' and 'batch_labels_tensor' (no batch is copied).
+        """
+        if isinstance(self.batch_data, BatchStream):
+            return self.batch_data.subset(fold), None
+        return [self.batch_data_tensor[b] for b in fold], [self.batch_labels_tensor[b] for b in fold]
 
-            return batch_array_5d
-        
-        elif (len(python_list[0].shape) == 2):
+    def __fold_data(self, fold):
+        """
+        (Private method) Return an iterable with the data of every batch of the input fold (numpy array with batch indices) to predict it.
+        """
+        if isinstance(self.batch_data, BatchStream):
+            return self.batch_data.subset(fold).data()
+        return [self.batch_data_tensor[b] for b in fold]
 
-            # Create empty array with shape '(num_batches, x_coord, y_coord, label)'
-            # The idea is to work with a numpy array where dimensions correspond to '(num_batches, (x, y, label))'
-            batch_array_3d = np.zeros((len(python_list), python_list[0].shape[0], python_list[0].shape[1]))
+    def __fold_labels(self, fold):
+        """
+        (Private method) Return all labels of the input fold (numpy array with batch indices) concatenated along the rows as a numpy array.
+        """
+        if isinstance(self.batch_data, BatchStream):
+            return self.batch_data.subset(fold).labels()
+        return self.batch_labels_tensor[fold].reshape((-1, self.batch_labels_tensor.shape[-1])).numpy()
 
-            #*############################################################
-            #* FOR LOOP ITERATES OVER ALL ELEMENTS IN THE INPUT LIST
-            #* AND STACK THEM IN THE TEMPORARY ARRAY
-            #*
-            i = 0
-            for element in python_list:
-
-                # Save inside the 'patches' variable each small 3D patch of size "number of bands" x "patch_size" x "patch_size"
-                # Use 'self.cube' attribute which contains the 'preProcessed' image. From the 'preProcessed' image extract small patches
-                # from the coordenates extracted.
-                batch_array_3d[i, :, :] = element
-                i += 1
-            
-            #*
-            #* END FOR LOOP
-            #*##############
-            
-            return batch_array_3d
-        #*
-        #* END OF IF ELSE
-        #*###############################################
+    def _train_inner_fold(self, Kn, seed, checkpoints = None):
+        """
+        (Private method) Train a new Conv2DNet model with the calibration data of the inner fold 'Kn' and evaluate it with its validation data.
+        The model is initialized with the PyTorch seed 'seed' + 'Kn', so every fold gives the same initial model no matter where it is trained.
+        The random generators of PyTorch are restored after initializing the model, so the caller's random state is not changed.
+        It is also called by the parallel workers (see '_train_inner_fold_worker()').
+
+        Inputs
+        ----------
+        - 'Kn':             Integer. Index of the inner fold.
+        - 'seed':           Integer. Seed of the models of the inner folds.
+        - 'checkpoints':    (Optional) Python dictionary used to prune the model (see '__stop_at_checkpoint()'). Keys are the checkpoint epochs
+                            and values are Python lists with the validation OACC of every model that reached each checkpoint.
+
+        Outputs
+        ----------
+        - 'model':      Trained Conv2DNet model.
+        - 'Kn_OACC':    Overall accuracy of the model in the validation data of the fold.
+        """
+        print('\n\t\t\t Current Kn fold =', Kn+1)
+
+        # Create a Conv2DNet model. We need to define a new one for every Kn iteration.
+        # Only the CPU RNG is forked ('devices = []'), since it is the only one used to initialize the model and
+        # forking the CUDA RNG would initialize CUDA inside the forked workers, which always train in the CPU.
+        with torch.random.fork_rng(devices = []):
+            torch.manual_seed(seed + Kn)
+            model = models.Conv2DNet(num_classes = self.numUniqueLabels, in_channels = self.numBands)
+
+        # Extract the labels (and not the coordenates) of the validation batches of the current 'Kn' as a column vector of integers,
+        # since the shape of 'y_hat_Kn' is (N, 1) and we need the labels as indexes inside 'get_metrics()'
+        y_true_Kn = self.__fold_labels(self.validation_folds[Kn])[:, -1].reshape((-1,1)).astype(int)
+
+        # Validate the model at the checkpoints of the pruning (if used) to stop it early if it is not promising
+        epoch_callback = None
+        if checkpoints is not None:
+            epoch_callback = lambda epoch: self.__stop_at_checkpoint(model, Kn, y_true_Kn, checkpoints, epoch)
+
+        # Train CNN in current Kn fold using the calibration batches
+        batch_x, batch_y = self.__fold_batches(self.calibration_folds[Kn])
+        model.trainNet(batch_x = batch_x, batch_y = batch_y, epochs = self.epochs, plot = False, lr = self.lr, epoch_callback = epoch_callback)
+
+        # Test CNN in current Kn fold using the data of the validation batches
+        y_hat_Kn = model.predict(batch_x = self.__fold_data(self.validation_folds[Kn]))
+
+        # Evaluate metrics by comparing the predicted labels with the true labels for the current Kn fold
+        Kn_OACC = mts.get_metrics(y_true_Kn, y_hat_Kn, self.numUniqueLabels)['OACC']
+
+        return model, Kn_OACC
+
+    def __stop_at_checkpoint(self, model, Kn, y_true_Kn, checkpoints, epoch):
+        """
+        (Private method) Successive halving step used as 'epoch_callback' of 'trainNet()'. At every checkpoint epoch, the model is validated
+        and its OACC is compared with the OACC of the models of the same K fold that already reached the checkpoint.
+        It returns True (stop training) if the model is not in the best 1/'self.pruning_rate' of them.
+        """
+        if epoch not in checkpoints:
+            return False
+
+        y_hat_Kn = model.predict(batch_x = self.__fold_data(self.validation_folds[Kn]))
+        Kn_OACC = mts.get_metrics(y_true_Kn, y_hat_Kn, self.numUniqueLabels)['OACC']
+        checkpoints[epoch].append(Kn_OACC)
+
+        # Number of models that keep training at this checkpoint (at least 1, so the first model always trains all epochs)
+        num_promoted = max(1, int(np.ceil(len(checkpoints[epoch]) / self.pruning_rate)))
+
+        return Kn_OACC < sorted(checkpoints[epoch], reverse = True)[num_promoted - 1]
+
+    def __train_inner_folds_parallel(self, seed):
+        """
+        (Private method) Train all inner folds (K x Kn) at once in 'self.num_workers' forked worker processes, since they are independent.
+        Workers inherit this instance (batches and folds included) when they are forked, so no data is copied to them.
+        Every worker is limited to its share of the available cores, so all workers together do not oversubscribe the CPU.
+        - Important: Workers always train in the CPU (CUDA can not be used in forked processes). Returned models are moved
+                     to the device of this process ('models.device'), so they predict in the same device as sequential models.
+
+        Outputs
+        ----------
+        - Python list with the (model, Kn_OACC) tuple of every inner fold, in the order of the folds.
+        """
+        global _shared_cross_validator
+
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+        num_threads = max(1, num_cores // self.num_workers)
+        num_inner_folds = self.k_folds * self.k_folds
+
+        _shared_cross_validator = self
+        try:
+            workers = ProcessPoolExecutor(max_workers = self.num_workers, mp_context = multiprocessing.get_context('fork'),
+                                          initializer = _init_inner_fold_worker, initargs = (num_threads,))
+            with workers:
+                inner_folds = list(workers.map(_train_inner_fold_worker, range(num_inner_folds), [seed] * num_inner_folds))
+        finally:
+            _shared_cross_validator = None
+
+        # Models were trained in the CPU of the workers. Move them to the device used to predict in this process.
+        return [(model.to(models.device), Kn_OACC) for model, Kn_OACC in inner_folds]
 
     def double_cross_validation(self):
         """
         Perform a K-fold double-cross validation and stores in the instance attribute 'self.bestModel' the
         best model. It calls '__kfold_double_cv_split()' internally to split the data for every K and Kn folds.
-        Trained models are 'Conv2DNet'.
+        Trained models are 'Conv2DNet'. If 'self.num_workers' > 1, inner folds are trained in parallel processes in the CPU
+        (see '__train_inner_folds_parallel()'). In CPU nodes, the same models are selected as if they were trained one after another.
+        In GPU nodes, sequential models are trained in the GPU, so parallel models may differ slightly (floating-point results of the CPU).
         """
 
         print("\tSplitting data before performing K-fold double-cross validation...")
         self.__kfold_double_cv_split()
         print("\tData has been splitted. Performing ", self.k_folds ,"fold double-cross validation...")
 
+        # Seed of the models of the inner folds (model Kn is initialized with 'seed' + Kn)
+        seed = self.seed if self.seed is not None else int(torch.randint(0, 2**31 - 1, (1,)))
+
+        # Checkpoint epochs of the pruning: 'pruning_min_epochs' * 'pruning_rate'^i (only epochs before the last one)
+        checkpoint_epochs = []
+        if self.pruning_rate is not None:
+            if (self.num_workers is not None and self.num_workers > 1):
+                raise RuntimeError("Pruning ('pruning_rate') can not be combined with parallel inner folds ('num_workers'). Please, use only 1 of them.")
+            if not (self.pruning_rate > 1 and self.pruning_min_epochs > 0):
+                raise RuntimeError("To prune the inner folds, 'pruning_rate' must be greater than 1 and 'pruning_min_epochs' greater than 0.")
+            epoch = self.pruning_min_epochs
+            while epoch < self.epochs:
+                checkpoint_epochs.append(epoch)
+                epoch *= self.pruning_rate
+        epochs_trained = 0
+
+        #*###############################################################
+        #* IF STATEMENT TO TRAIN ALL INNER FOLDS IN PARALLEL BEFORE THE
+        #* DOUBLE-CROSS VALIDATION LOOPS (IF WORKERS ARE USED)
+        #*
+        inner_folds = None
+        if (self.num_workers is not None and self.num_workers > 1):
+            if not ('fork' in multiprocessing.get_all_start_methods()):
+                raise RuntimeError("Training the inner folds in parallel needs to fork processes, which is not available in this platform. Please, use 'num_workers = None'.")
+            print("\tTraining ", self.k_folds * self.k_folds, " inner folds in ", self.num_workers, " parallel workers...")
+            inner_folds = self.__train_inner_folds_parallel(seed)
+        #*
+        #* END OF IF
+        #*############
+
         print('\n\t### DOUBLE-CROSS VALIDATION ###')
         #*###############################################################
         #* FOR ITERATION FOR THE OUTER DOUBLE-CROSS VALIDATION LOOP (K)
@@ -1806,37 +1898,20 @@ class CrossValidator:
             #* FOR ITERATION FOR THE INNER DOUBLE-CROSS VALIDATION LOOP (Kn)
             #*
             best_Kn_OACC = 0
+
+            # Models of every K fold are only compared (to prune them) with the models of the same K fold
+            checkpoints = {epoch: [] for epoch in checkpoint_epochs} if (self.pruning_rate is not None) else None
             
             for _ in range(0, self.k_folds, 1):
-                print('\n\t\t\t Current Kn fold =', Kn+1)
-                
-                # Create a Conv2DNet model. We need to define a new one for every Kn iteration
-                model = models.Conv2DNet(num_classes = self.numUniqueLabels, in_channels = self.numBands)
-
-                # Convert calibration data to tensor
-                batch_x = torch.from_numpy(self.calibration_data_folds[Kn]).type(torch.float)
-                batch_y = torch.from_numpy(self.calibration_label_folds[Kn]).type(torch.LongTensor)
-
-                # Train CNN in current Kn fold using the calibration data
-                model.trainNet(batch_x = batch_x, batch_y = batch_y, epochs = self.epochs, plot = False, lr = self.lr)
-
-                # Convert validation data to tensor
-                batch_x_val = torch.from_numpy(self.validation_data_folds[Kn]).type(torch.float)
 
-                # Test CNN in current Kn fold using the validation data
-                y_hat_Kn = model.predict(batch_x = batch_x_val)
+                # Train and validate the model of the current Kn fold (or take it if it was trained in parallel)
+                model, Kn_OACC = inner_folds[Kn] if inner_folds is not None else self._train_inner_fold(Kn, seed, checkpoints)
+                epochs_trained += model.epochs_trained
 
-                # Manipulate 'validation_label_folds' for the current 'Kn'.
-                # We first need to concatenate all batches together with 'np.concatenate()' along the rows (axis=0)
-                # Then we extract the labels and not the coordenates (remember that '_labels_folds' variables have (x_coord, y_coord, label)).
-                # Since the result is of shape (N,) and the shape of 'y_hat_Kn' is (N, 1), we need to reshape (-1 indicates to take the entire lenght)
-                # We convert it as integers since they originally are floats and we need the labels as indexes inside 'get_metrics()'
-                y_true_Kn = np.concatenate(self.validation_label_folds[Kn], axis = 0)[:, -1].reshape((-1,1)).astype(int)
-
-                # Evaluate metrics by comparing the predicted labels with the true labels for the current Kn fold
-                Kn_OACC = mts.get_metrics(y_true_Kn, y_hat_Kn, self.numUniqueLabels)['OACC']
-
-                if (best_Kn_OACC < Kn_OACC):
+                # Models stopped by the pruning are not fully trained, so they can not be the best model
+                if (model.epochs_trained < self.epochs):
+                    print('\t\t\t Kn=', Kn+1, 'model was pruned at epoch', model.epochs_trained)
+                elif (best_Kn_OACC < Kn_OACC):
                     print('\t\t\t ** Found new best model in Kn=', Kn+1, 'iteration! **')
                     best_Kn_OACC = Kn_OACC
 
@@ -1848,18 +1923,12 @@ class CrossValidator:
             #* END OF INNER DOUBLE-CROSS VALIDATION LOOP (Kn)
             #*################################################
 
-            # Convert test data to tensor
-            batch_x_test = torch.from_numpy(self.test_data_folds[K]).type(torch.float)
-
-            # Test 'best_Kn_model' with current K test batch
-            y_hat_K = best_Kn_model.predict(batch_x = batch_x_test)
+            # Test 'best_Kn_model' with the data of the current K test batches
+            y_hat_K = best_Kn_model.predict(batch_x = self.__fold_data(self.test_folds[K]))
 
-            # Manipulate 'validation_label_folds' for the current 'Kn'.
-            # We first need to concatenate all batches together with 'np.concatenate()' along the rows (axis=0)
-            # Then we extract the labels and not the coordenates (remember that '_labels_folds' variables have (x_coord, y_coord, label)).
-            # Since the result is of shape (N,) and the shape of 'y_hat_Kn' is (N, 1), we need to reshape (-1 indicates to take the entire lenght)
-            # We convert it as integers since they originally are floats and we need the labels as indexes inside 'get_metrics()'
-            y_true_K = np.concatenate(self.test_label_folds[K], axis = 0)[:, -1].reshape((-1,1)).astype(int)
+            # Extract the labels (and not the coordenates) of the test batches of the current 'K' as a column vector of integers,
+            # since the shape of 'y_hat_K' is (N, 1) and we need the labels as indexes inside 'get_metrics()'
+            y_true_K = self.__fold_labels(self.test_folds[K])[:, -1].reshape((-1,1)).astype(int)
 
             # Evaluate metrics by comparing the predicted labels with the true labels for the current K fold
             # Use the last column of labels since is the one containing the labels (others has coordenates)
@@ -1876,6 +1945,12 @@ class CrossValidator:
         #* END OF OUTER DOUBLE-CROSS VALIDATION LOOP (Kn)
         #*#################################################
 
+        # Training epochs saved by the pruning, compared with training all inner folds for all epochs
+        epochs_total = self.k_folds * self.k_folds * self.epochs
+        self.epochs_saved = epochs_total - epochs_trained
+        if self.pruning_rate is not None:
+            print('\n\t Pruning saved', self.epochs_saved, 'of', epochs_total, 'training epochs (%.1f%%)' % (100 * self.epochs_saved / epochs_total))
+
         print('\n\t### DOUBLE-CROSS VALIDATION IS FINISHED ###')
 #*
 #* CrossValidator class
@@ -1891,7 +1966,7 @@ class RawManager:
     XIMEA Snapshot MQ022HG-IM-SM5X5-NIR hyperspectral camera.
     """
 
-    def __init__(self, raw_image, white_ref, black_ref, patch_size = 7, batch_size = 16):
+    def __init__(self, raw_image, white_ref = None, black_ref = None, patch_size = 7, batch_size = 16, calib_reference = None, dtype = np.float32):
         """
         Constructor for the RawManager class. Loads input tif images using PIL package and 
         convert them to numpy array for easy management.
@@ -1901,11 +1976,20 @@ class RawManager:
         - 'raw_image':  Numpy array. Tif raw brain image from the XIMEA snapshot hyperspectral camera.
         - 'white_ref':  Numpy array. Tif white reference image from the XIMEA snapshot hyperspectral camera.
         - 'black_ref':  Numpy array. Tif black reference image from the XIMEA snapshot hyperspectral camera.
+        - 'calib_reference': (Optional) Tuple of precomputed calibration terms returned by 'ppc.f_calibration_reference()'
+                             or 'ppc.CalibrationCache.get()'. If used, 'white_ref' and 'black_ref' are not needed.
+        - 'dtype':      Numpy data type of the pre-processed cube and patches. Use the same precision as the model (np.float32 for 'torch.float')
+                        so that 'batch_to_tensor()' does not need to copy the batches.
         """
 
+        if calib_reference is None and (white_ref is None or black_ref is None):
+            raise RuntimeError("Please specify both 'white_ref' and 'black_ref', or a precomputed 'calib_reference'.")
+
         self.raw_image = raw_image
         self.white_ref = white_ref
         self.black_ref = black_ref
+        self.calib_reference = calib_reference
+        self.dtype = dtype
 
         self.processedCube = None
         self.pad_processedCube = None   # pre-processed cube with padding
@@ -1925,17 +2009,25 @@ class RawManager:
             3. Spectrally correct the cube using XIMEA correction matrix
             4. Normalize the cube using the HELICOID normalization
         """
-        # Apply the pre-processing chain to the input image
-        self.processedCube = ppc.f_norm_helicoid(ppc.f_spectral_correction(ppc.f_cube(ppc.f_calibration(self.raw_image , self.white_ref, self.black_ref))))
-
-        # Apply a constant padding to the preProcessed cube to the height and width dimensions (not the spectral channels)
+        # Apply the fused pre-processing chain to the input image. It writes the pre-processed cube directly
+        # with a constant padding to the height and width dimensions (not the spectral channels).
         # Save the padded cube to the instance attribute
-        self.pad_processedCube = np.pad(self.processedCube, [(self.pad_margin, self.pad_margin), (self.pad_margin, self.pad_margin), (0,0)], 'constant')
+        self.pad_processedCube = ppc.f_fused_preProcessing(self.raw_image, self.white_ref, self.black_ref, pad_margin = self.pad_margin,
+                                                           dtype = self.dtype, reference = self.calib_reference)
+
+        # The pre-processed cube without padding is a view of the padded cube (no copy is done)
+        height, width = self.pad_processedCube.shape[0] - 2*self.pad_margin, self.pad_processedCube.shape[1] - 2*self.pad_margin
+        self.processedCube = self.pad_processedCube[self.pad_margin : self.pad_margin + height, self.pad_margin : self.pad_margin + width, :]
 
-    def create_cube_batch(self):
+    def create_cube_batch(self, batch_size = None):
         """
-        Generate batches from the entire input preprocessed image, which was loaded when used
-        the 'load_patient_cubes' method of the CubeManager class.
+        Generate batches from the entire input preprocessed image, which was pre-processed
+        with the 'preProcessImage' method of the RawManager class. Pixels are batched in raster
+        order (row by row), so the last batch may have less than 'batch_size' patches.
+
+        Inputs
+        ---------
+        - 'batch_size': Integer. Number of patches in each inference batch. If None, 'self.batch_size' is used.
 
         Outputs
         ---------
@@ -1943,134 +2035,59 @@ class RawManager:
         - 'data':   Python list with all batches.
         - 'coords': Python coordenates for every patch in the batches.
         """
-
-        # Create a copy of the entire HSI padded cube from the loaded patient image
-        cube = np.copy(self.pad_processedCube)
-        gt = np.copy(self.processedCube)
-        
-        # Create mask of 1s with same dimension as the loaded ground truth map
-        mask = np.ones( (gt.shape[0], gt.shape[1]) )
-
         # Create empty Python lists to append all batches with 3D patches
         list_cube_batch = []
         list_coords_batch = []
 
         #*###############################################
-        #* WHILE LOOP CREATES 1 BATCH EVERY ITERATION
+        #* FOR LOOP APPENDS 1 BATCH EVERY ITERATION
         #*
-        while np.sum(mask > 0) >= self.batch_size:                # Stay in this while loop if the number of samples left in 'dataTemp' is equal or greater than 'bath_size'
-            
-            list_cube_samples = []                                       # Create empty Python list to append data cube samples
-            list_coord_samples = []                                      # Create empty Python list to append data ground truth map label samples
-
-            # Extract the coordenates from all pixels left
-            x, y = np.nonzero(mask == 1)
-
-            # From all pixels left, extract 'self.batch_size' random coordenates without replacement
-            indices = np.random.choice(len(x), self.batch_size, replace=False)
-
-            # Create a numpy array with the coordenates for the sampled indices and append to the list.
-            list_coord_samples.append( np.array([x[indices], y[indices]]).transpose() )
-
-            # Generate 3D patches from the extract coordenates using the patient HSI cube
-            # Since the mask does not have the padding, we have to add the pad_margin when accessing the cube
-            # since the cube has padding.
-            list_cube_samples.append( self.__get_patches_full_cube(x[indices] + self.pad_margin, y[indices] + self.pad_margin, cube) )
-
-            # Delete from the mask the used coordenates to create the patches
-            mask[x[indices],y[indices]] = 0
-
-            # Convert both Python lists 'list_cube_samples' and 'list_coord_samples' to numpy arrays by using 'np.concatenate()'.
-            # This way we concatenate all pixels from all labels to be stored in 1 single variable, which would represent 1 single batch
-            cube_batch = np.concatenate(list_cube_samples, axis=0)
-            coords_batch = np.concatenate(list_coord_samples, axis=0)
-
-            # Append each batch to its corresponding list
+        for cube_batch, coords_batch in self.generate_cube_batches(batch_size = batch_size):
             list_cube_batch.append(cube_batch)
             list_coords_batch.append(coords_batch)
         #*
-        #* END OF WHILE 
-        #*################
-
-        #*########################################################
-        #* IF STATEMENT IS USED TO APPEND THE REMAINING DATA 
-        #* THAT CAN NOT BE USED AS A BATCH OF 'batch_size' SIZE
-        #*
-        if ( mask[mask > 0].shape[0] / self.batch_size > 0):
-
-            # Extract the coordenates for the remaining left pixels in the mask
-            x, y = np.nonzero(mask != 0)
-            
-            # Create a numpy array with the coordenates for the sampled indices and append to the list
-            list_coords_batch.append(np.array([x, y]).transpose())
-
-            # Generate 3D patches from the extract coordenates using the patient HSI cube.
-            # Since the mask does not have the padding, we have to add the pad_margin when accessing the cube
-            # since the cube has padding.
-            list_cube_batch.append(self.__get_patches_full_cube(x + self.pad_margin, y + self.pad_margin, cube))
-
-        #*   
-        #* END OF IF
+        #* END FOR LOOP
         #*##############
 
         return {'data': list_cube_batch, 'coords': list_coords_batch}
 
-    def __get_patches_full_cube(self, x, y, cube):
+    def generate_cube_batches(self, batch_size = None):
         """
-        (Private method) Create 3D patches using the input coordenates and extract data from the entire
-        preprocessed cube passed as input. 
-        
+        Return a Python generator that yields batches from the entire input preprocessed image, which was pre-processed
+        with the 'preProcessImage' method of the RawManager class. Pixels are batched in raster order (row by row),
+        so every batch is a contiguous block of pixel coordenates and only 1 batch of patches is alive at a time.
+
         Inputs
-        ----------
-        - 'x' and 'y':  Coordenates to access the input 'cube' and use them as center coordenates
-                        for the patches.
-        - 'cube':       Numpy array. Preprocessed cube with already added padding.
+        ---------
+        - 'batch_size': Integer. Number of patches in each inference batch. If None, 'self.batch_size' is used.
 
-        Outputs
-        ----------
-        - 'patches':    Numpy array with all generated patches from the centered coordenates passed as inputs.
+        Outputs (every iteration)
+        ---------
+        - 'cube_batch':     Numpy array with the patches of the batch.
+        - 'coords_batch':   Numpy array with the (x, y) coordenates of every patch in the batch.
         """
-    
-        # Create empty 'len(x)' arrays (or patches) with size: "number of bands" x "patch_size" x "patch_size" 
-        patches = np.zeros((len(x), cube.shape[-1], self.patch_size, self.patch_size))
-
-		# Extract start coordenates for 'x' and 'y' Python lists passed as parameter 
-        xs = (x - int(self.patch_size/2)).astype(int)
-        ys = (y - int(self.patch_size/2)).astype(int)
-
-		# Extract end coordenates for 'x' and 'y' Python lists passed as parameter
-        xe = xs + self.patch_size
-        ye = ys + self.patch_size
-
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL PASSED PIXEL COORDENATES TO 
-        #* GENERATE PATCHES FROM THE HSI CUBES AND SAVE THEM IN
-        #* THE 'patches' VARIABLE.
-        #*
-        for i in range(len(x)):
-            # Save inside the 'patches' variable each small 3D patch of size "number of bands" x "patch_size" x "patch_size"
-		    # Use 'self.cube' attribute which contains the 'preProcessed' image. From the 'preProcessed' image extract small patches
-		    # from the coordenates extracted.
-            patches[i,:,:,:] = np.transpose(cube[xs[i]:xe[i], ys[i]:ye[i], :], (2, 0, 1) )
+        if batch_size is None: batch_size = self.batch_size
 
-        #*
-        #* END FOR LOOP
-        #*##############
+        # Extract the dimensions of the pre-processed cube (without padding)
+        height, width = self.processedCube.shape[0], self.processedCube.shape[1]
 
-        return patches
+        return _raster_cube_batches(self.pad_processedCube, height, width, self.pad_margin, self.patch_size, batch_size)
 
-    def batch_to_tensor(self, python_list, data_type):
+    def batch_to_tensor(self, python_list, data_type, packed = False):
         """
         Convert all numpy array batches included in a Python list to desired PyTorch tensors types.
         
         Inputs
         ----------
         - 'python_list':    Python list with batches as numpy arrays
-        - 'data_type':      PyTorch tensor type to convert the numpy array batch to desired tensor type
+        - 'data_type':      PyTorch tensor type to convert the numpy array batch to desired tensor type.
+                            If the batches already have the same data type (e.g. np.float32 for 'torch.float'), no copy is done.
+        - 'packed':         Boolean. If True, all batches are copied into 1 single contiguous tensor and returned as 'PackedBatches',
+                            which can be moved to the GPU with 1 single transfer (see 'PackedBatches').
 
         Outputs
         ----------
-        - 'tensor_batch':   Python list with batches as PyTorch tensors
+        - 'tensor_batch':   Python list with batches as PyTorch tensors ('PackedBatches' if 'packed' is True)
         """
 
         #*################
@@ -2086,6 +2103,9 @@ class RawManager:
         #* END OF ERROR CHECKER ###
         #*#########################
 
+        if packed:
+            return _pack_batches(python_list, data_type)
+
         tensor_batch = []                               # Create empty Python list to return
 
         #*###############################################################
@@ -2113,56 +2133,583 @@ class RawManager:
         - Numpy array with all elements of the python list concatenated
         """
 
-        #*##############################################################
-        #* IF ELSE STATEMENT TO CHECK SHAPE OF THE ELEMENTS IN THE INPUT
-        #* PYTHON LIST. GENERATE DIFFERENT TEMPORARY ARRAYS DEPENDING
-        #* ON THE INPUT BATCHES (2d with shape 2 and 3d with shape 4)
-        #*
-        if ( len(python_list[0].shape) == 2 ):
-            # If entered here, we are working with data with only rows and columns (samples x wavelenghts)
-            # Some examples are: 'self.data', 'self.label4Classes', 'self.label' or 'self.labels_coords'
-            # Create temporary array of 1 empty row with same columns as the elements in the python list
-            temp_array = np.zeros((1, python_list[0].shape[-1]))
-
-        elif ( len(python_list[0].shape) == 4 ):
-            # If entered here, we are working with data with ("patch_id" x "number of bands" x "patch_size" x "patch_size")
-            # Create temporary array of 1 array of ("patch_size" x "patch_size" x "number of bands")
-            temp_array = np.zeros_like(python_list[0])[0, :, :, :].reshape(1, python_list[0].shape[1], python_list[0].shape[2], python_list[0].shape[3])
+        # Concatenate all elements along the first axis with 1 single copy, keeping their data type
+        return np.concatenate(python_list, axis = 0)
+
+#*
+#* RawManager class
+#*####################
+#*#########################
+#*#### EXTRA METHODS  #####
+#*
+# 'CrossValidator' shared with the forked workers that train its inner folds (see '_train_inner_fold_worker()')
+_shared_cross_validator = None
+
+def _init_inner_fold_worker(num_threads):
+    """
+    (Private method) Initialize 1 worker process of 'CrossValidator.double_cross_validation()': models are trained in the CPU with 'num_threads' threads.
+    """
+    models.configure_backend('cpu', num_threads = num_threads, num_interop_threads = 1)
+
+def _train_inner_fold_worker(Kn, seed):
+    """
+    (Private method) Train the inner fold 'Kn' of the 'CrossValidator' shared with the forked workers (in the CPU).
+    It returns the trained model and its validation OACC.
+    """
+    return _shared_cross_validator._train_inner_fold(Kn, seed)
+
+def _pack_batches(python_list, data_type):
+    """
+    (Private method) Convert all numpy array batches of the input Python list to 1 'PackedBatches'. All batches are copied
+    (and converted to 'data_type') into 1 single preallocated tensor. Only the last batch can have a different size.
+
+    Inputs
+    ----------
+    - 'python_list':    Python list with batches as numpy arrays.
+    - 'data_type':      PyTorch data type (e.g. 'torch.float') or tensor type (e.g. 'torch.LongTensor') of the packed tensor.
+
+    Outputs
+    ----------
+    - 'PackedBatches' with all batches.
+    """
+    # Batches with the same shape as the first one are packed. A smaller last batch is kept as the tail.
+    num_full = len(python_list)
+    if ( num_full > 1 and python_list[-1].shape != python_list[0].shape ):
+        num_full -= 1
+
+    #*################
+    #* ERROR CHECKER
+    #*
+    if any(batch.shape != python_list[0].shape for batch in python_list[:num_full]):
+        raise RuntimeError("Only the last batch can have a different size to pack the batches. Please, use 'packed = False'.")
+    #*    
+    #* END OF ERROR CHECKER ###
+    #*#########################
+
+    # Resolve tensor types (e.g. 'torch.LongTensor') to their data type (e.g. 'torch.int64')
+    dtype = data_type if isinstance(data_type, torch.dtype) else torch.empty(0).type(data_type).dtype
+
+    full = torch.empty((num_full,) + python_list[0].shape, dtype = dtype)
+    for b in range(num_full):
+        full[b].copy_(torch.from_numpy(python_list[b]))
+
+    tail = torch.from_numpy(python_list[-1]).type(data_type) if (num_full < len(python_list)) else None
+
+    return PackedBatches(full, tail)
+
+def _stratified_batch_plan(labels, batch_size, largest_label):
+    """
+    (Private method) Plan the Random Stratified Sampling of all batches working only with sample indices. Every class
+    has its own pool of indices, shuffled once, which is consumed in order as batches are planned. Each batch takes from
+    every class a number of samples proportional to the samples left for that class (at least 1), and in case a batch
+    does not comply with 'batch_size', more samples are added from the 'largest_label' class.
+    No data is copied here, so callers gather their data only once with the returned indices.
+
+    Inputs
+    ----------
+    - 'labels':         Numpy 1D array with the label of every sample.
+    - 'batch_size':     Integer. Size of each batch.
+    - 'largest_label':  Label with more elements. Used to fill batches that do not comply with 'batch_size'.
+
+    Outputs
+    ----------
+    - 'batch_indices':  Python list with 1 numpy array per batch with the indices of its samples (all of 'batch_size' size).
+    - 'left_indices':   Numpy array with the indices (in ascending order) of the samples left that can not fill a batch.
+    """
+    sorted_indices, class_counts, batch_slots, left_slots = _stratified_batch_slots(labels, batch_size, largest_label)
+
+    # Shuffle once the pool of indices of every class. Pools are kept one after the other, as the planned positions expect.
+    class_pools = np.split(sorted_indices, np.cumsum(class_counts)[:-1])
+    pool_indices = np.concatenate([np.random.permutation(pool) for pool in class_pools])
+
+    # Samples left that can not fill a batch, in the same order as they were loaded
+    return list(pool_indices[batch_slots]), np.sort(pool_indices[left_slots])
+
+def _stratified_batch_slots(labels, batch_size, largest_label):
+    """
+    (Private method) Plan the positions used by '_stratified_batch_plan()'. Sample indices are sorted by label, so the indices of every class
+    are consecutive, and every batch is planned as the positions it takes from this sorted array. Since the number of samples of
+    every class in a batch only depends on the number of samples per class, shuffling the indices inside every class and then taking
+    the planned positions is the same as planning with shuffled class pools. See '_stratified_batch_plan()' for the sampling.
+
+    Inputs
+    ----------
+    - 'labels':         Numpy 1D array with the label of every sample.
+    - 'batch_size':     Integer. Size of each batch.
+    - 'largest_label':  Label with more elements. Used to fill batches that do not comply with 'batch_size'.
+
+    Outputs
+    ----------
+    - 'sorted_indices': Numpy array with the sample indices sorted by label (stable).
+    - 'class_counts':   Numpy array with the number of samples of every class (in ascending order of label).
+    - 'batch_slots':    Numpy array (num_batches, batch_size) with the positions of every batch in the array of sorted indices.
+    - 'left_slots':     Numpy array with the positions of the samples left that can not fill a batch.
+    """
+    # Use only 1 scalar label in case 'largest_label' is a numpy array (it happens when 2 labels have the same number of elements)
+    largest_label = np.asarray(largest_label).flatten()[0]
+
+    # 'class_counts' has the number of samples of every class, and 'class_starts' the first position of every class in 'sorted_indices'
+    classes, class_counts = np.unique(labels, return_counts = True)
+    sorted_indices = np.argsort(labels, kind = 'stable')
+    class_starts = np.concatenate(([0], np.cumsum(class_counts)[:-1]))
+
+    class_used = np.zeros(len(classes), dtype=int)      # Number of samples already used from every class
+    largest_index = np.flatnonzero(classes == largest_label)[0]
+
+    num_total_samples_left = len(labels)
+    batch_slots = []
+
+    #*###############################################
+    #* WHILE LOOP PLANS 1 BATCH EVERY ITERATION
+    #*
+    while num_total_samples_left >= batch_size:
+
+        list_slots = []
+        size_current_batch = 0
+
+        #*#################################################
+        #* FOR LOOP ITERATES OVER EVERY LABEL AVAILABLE
         #*
-        #* END OF IF ELSE
-        #*################
+        for c in range(len(classes)):
 
-        # Flag to indicate that we have deleted the first row of the temporary array,
-        # otherwise we would append always the empty row.
-        deleted_row = False
+            class_left = class_counts[c] - class_used[c]        # Number of samples left for the current label
 
-        #*############################################################
-        #* FOR LOOP ITERATES OVER ALL ELEMENTS IN THE INPUT LIST
-        #* AND STACK THEM IN THE TEMPORARY ARRAY
+            if ( class_left > 0 ):
+                num_samples = int(round(batch_size * (class_left / num_total_samples_left)))   # Number of samples to add to the batch for the current label
+
+                if num_samples == 0: num_samples = 1
+
+                # Substract samples in case the batch has reached its limit
+                if ( (size_current_batch + num_samples) > batch_size ):
+                    num_samples = batch_size - size_current_batch
+
+                list_slots.append(np.arange(class_starts[c] + class_used[c], class_starts[c] + class_used[c] + num_samples))
+                class_used[c] += num_samples
+                size_current_batch += num_samples
         #*
-        for element in python_list:
-            temp_array = np.vstack((temp_array, element))
+        #* END OF FOR LOOP
+        #*###################
 
-            #*############################################################
-            #* IF STATEMENT TO CHECK IF FIRST ROW OF THE TEMP ARRAY HAS
-            #* BEEN DELETED. (remember they where created with the first 
-            #* row as empty)
-            #*
-            if not (deleted_row):
-                # Delete the first empty row
-                temp_array = np.delete(temp_array, 0, axis = 0)
-                # Update flag to True
-                deleted_row = True       
-            #*
-            #* END OF IF
-            #*############
+        #*##################################################################
+        #* IF STATEMENT TO ADD ADDITIONAL SAMPLES TO THE CURRENT BATCH 
+        #* IN CASE ITS LENGHT IS LESS THAN THE ACTUAL BATCH_SIZE
+        #* (We take samples from the label with more classes)
         #*
-        #* END FOR LOOP
+        if ( size_current_batch < batch_size ):
+            samples_to_add = batch_size - size_current_batch
+
+            if ( (class_counts[largest_index] - class_used[largest_index]) < samples_to_add ):
+                raise RuntimeError("Not enough samples left with the largest label to complete a batch of size ", batch_size)
+
+            list_slots.append(np.arange(class_starts[largest_index] + class_used[largest_index], class_starts[largest_index] + class_used[largest_index] + samples_to_add))
+            class_used[largest_index] += samples_to_add
+        #*   
+        #* END OF IF
         #*##############
 
-        # Return the numpy array with all elements and delete the first empty row
-        return temp_array
+        batch_slots.append(np.concatenate(list_slots))
+        num_total_samples_left -= batch_size
+    #*
+    #* END OF WHILE 
+    #*################
+
+    batch_slots = np.array(batch_slots, dtype = int).reshape((-1, batch_size))
+    left_slots = np.concatenate([np.arange(class_starts[c] + class_used[c], class_starts[c] + class_counts[c]) for c in range(len(classes))]).astype(int)
+
+    return sorted_indices, class_counts, batch_slots, left_slots
+
+def _get_patches_from_cube(cube, x, y, patch_size):
+    """
+    (Private method) Create 3D patches centered in the input coordenates with 1 single fancy-index operation over
+    a sliding-window view of the cube. Patches are returned with dimension (num_patches, num_features, height, width)
+    to comply with PyTorch convolutional layer requirements.
+    - Note: Patches are gathered as a contiguous (num_patches, height, width, num_features) array and returned as a transposed
+            view of it, which is the 'channels_last' memory format of PyTorch. This way, no more copies are done to reorder them.
+
+    Inputs
+    ----------
+    - 'cube':       Numpy array. Preprocessed cube with already added padding with dimensions (height, width, num_features).
+    - 'x' and 'y':  Coordenates to access the input 'cube' and use them as center coordenates for the patches.
+    - 'patch_size': Integer. Height and width of the patches.
+
+    Outputs
+    ----------
+    - 'patches':    Numpy array with all generated patches from the centered coordenates passed as inputs.
+    """
+    # Extract start coordenates for 'x' and 'y' passed as parameter
+    xs = (np.asarray(x) - int(patch_size/2)).astype(int)
+    ys = (np.asarray(y) - int(patch_size/2)).astype(int)
+
+    # Copy all patches with 1 single fancy-index operation and move the spectral bands to the second dimension
+    return np.transpose(_patch_windows(cube, patch_size)[xs, ys], (0, 3, 1, 2))
+
+def _patch_windows(cube, patch_size):
+    """
+    (Private method) Create a view of the cube where index [i, j] is the patch starting at coordenates (i, j) with dimension
+    (patch_size, patch_size, num_features). The view reuses the strides of the cube, so no data is copied.
+    """
+    return np.lib.stride_tricks.as_strided(cube,
+                                           shape = (cube.shape[0] - patch_size + 1, cube.shape[1] - patch_size + 1, patch_size, patch_size, cube.shape[2]),
+                                           strides = (cube.strides[0], cube.strides[1], cube.strides[0], cube.strides[1], cube.strides[2]),
+                                           writeable = False)
+
+def _get_patches_from_patients(patient_cubes, patients_list, patientNums, x, y, patch_size, dtype = np.float32):
+    """
+    (Private method) Create 3D patches centered in the input coordenates of different patients. Patches of every patient are
+    gathered with 1 single fancy-index operation over a sliding-window view of its own padded cube, so cubes never need to be
+    appended together. Each cube is accessed once, in the order of 'patients_list'.
+    Patches are returned with the same dimensions and memory format as in '_get_patches_from_cube()'.
+
+    Inputs
+    ----------
+    - 'patient_cubes':  'PatientCubeStore' (or Python dictionary) with the padded cube of every patient.
+    - 'patients_list':  Python list with the patient IDs. 'patientNums' are indices of this list.
+    - 'patientNums':    Numpy array with the patient number of every patch.
+    - 'x' and 'y':      Coordenates in the padded cube of every patient, used as center coordenates for the patches.
+    - 'patch_size':     Integer. Height and width of the patches.
+    - 'dtype':          Numpy data type of the patches.
+
+    Outputs
+    ----------
+    - 'patches':    Numpy array with all generated patches from the centered coordenates passed as inputs.
+    """
+    patientNums = np.asarray(patientNums)
+
+    # Extract start coordenates for 'x' and 'y' passed as parameter
+    xs = (np.asarray(x) - int(patch_size/2)).astype(int)
+    ys = (np.asarray(y) - int(patch_size/2)).astype(int)
+
+    patches = None
+
+    #*############################################################
+    #* FOR LOOP ITERATES OVER ALL PATIENTS WITH PATCHES TO COPY
+    #* THEIR PATCHES IN THE PREALLOCATED OUTPUT ARRAY
+    #*
+    for p in np.unique(patientNums):
+
+        cube = patient_cubes[patients_list[p]]['pad_preProcessedImage']
+
+        # Preallocate all patches as (num_patches, height, width, num_features) once the number of bands is known
+        if patches is None:
+            patches = np.empty((len(patientNums), patch_size, patch_size, cube.shape[-1]), dtype = dtype)
+
+        idx = np.nonzero(patientNums == p)[0]
+        patches[idx] = _patch_windows(cube, patch_size)[xs[idx], ys[idx]]
+    #*
+    #* END FOR LOOP
+    #*##############
+
+    if patches is None:
+        patches = np.empty((0, patch_size, patch_size, 0), dtype = dtype)
+
+    # Move the spectral bands to the second dimension
+    return np.transpose(patches, (0, 3, 1, 2))
+
+def _raster_cube_batches(cube, height, width, pad_margin, patch_size, batch_size):
+    """
+    (Private method) Python generator that yields batches of patches for every pixel of an image in raster order (row by row).
+    Each batch is a contiguous block of 'batch_size' pixels, so coordenates are computed from the pixel index and no mask
+    of the image is needed. The last batch may have less than 'batch_size' patches.
+
+    Inputs
+    ----------
+    - 'cube':           Numpy array. Preprocessed cube with already added padding.
+    - 'height':         Integer. Height of the image without padding.
+    - 'width':          Integer. Width of the image without padding.
+    - 'pad_margin':     Integer. Padding added to the cube.
+    - 'patch_size':     Integer. Height and width of the patches.
+    - 'batch_size':     Integer. Number of patches in each batch.
+
+    Outputs (every iteration)
+    ----------
+    - 'cube_batch':     Numpy array with the patches of the batch.
+    - 'coords_batch':   Numpy array with the (x, y) coordenates (without padding) of every patch in the batch.
+    """
+    num_pixels = height * width
+
+    #*###############################################
+    #* FOR LOOP YIELDS 1 BATCH EVERY ITERATION
+    #*
+    for start in range(0, num_pixels, batch_size):
+        # Extract the coordenates of the current block of pixels
+        pixel_indices = np.arange(start, min(start + batch_size, num_pixels))
+        x = pixel_indices // width
+        y = pixel_indices % width
+
+        # Since coordenates do not have the padding, we have to add the pad_margin when accessing the cube
+        yield _get_patches_from_cube(cube, x + pad_margin, y + pad_margin, patch_size), np.array([x, y]).transpose()
+    #*
+    #* END FOR LOOP
+    #*##############
 
 #*
-#* RawManager class
-#*####################
\ No newline at end of file
+def _load_patient_cube(patient, patientNum, dir_path_gt, dir_par_preProcessed, pad_margin, dic_label, dir_store = None, dtype = np.float32):
+    """
+    (Private method) Load the ground-truth map and preProcessedImage of 1 patient, pad them and extract all its labeled pixels.
+    It does not modify any 'CubeManager' instance, so it can run concurrently in threads or processes for different patients.
+    Labeled pixels are sorted by label and, for every label, in raster order.
+
+    Inputs
+    ----------
+    - 'patient':                String with the patient ID.
+    - 'patientNum':             Integer to indicate the patient id of the loaded cube (its index in 'patients_list').
+    - 'dir_path_gt':            String that includes the path directory where the ground truth files are.
+    - 'dir_par_preProcessed':   String that includes the path directory where the preProcessed image files are.
+    - 'pad_margin':             Integer with the padding to add to the height and width of the ground-truth map and preProcessedImage.
+    - 'dic_label':              Python dictionary with the labels as keys and their corresponding label4Classes as values.
+    - 'dir_store':              (Optional) String with the path directory of the memory-mapped stores (see 'load_mat_store()').
+    - 'dtype':                  Numpy data type of the returned preProcessedImages and labeled pixels.
+
+    Outputs
+    ----------
+    - Python dictionary with keys:
+        - 'pad_preProcessedImage' and 'pad_groundTruthMap': Same as in 'CubeManager.patient_cubes'. The raw arrays are not returned
+                            (they would be pickled again when running in processes). Use '_unpad_array()' to get them.
+        - 'label_coords':   2D numpy array with 3 columns (x, y, label) for every labeled pixel in the ground-truth map.
+        - 'data':           2D numpy array with the spectral information of every labeled pixel.
+        - 'label':          2D numpy array with 1 column with the label of every labeled pixel.
+        - 'label4Classes':  2D numpy array with 1 column with the label4Class of every labeled pixel.
+        - 'coords':         2D numpy array with 3 columns (x, y, patientNum) for every labeled pixel.
+    """
+    gt_map = load_mat_store(dir_path_gt + 'SNAPgt' + patient + '_cropped_Pre-processed.mat', ['groundTruthMap'], dir_store = dir_store)['groundTruthMap']                           # Load ground truth map from the current patient
+    preProcessedImage = load_mat_store(dir_par_preProcessed + 'SNAPimages' + patient + '_cropped_Pre-processed.mat', ['preProcessedImage'], dir_store = dir_store)['preProcessedImage']  # Load preProcessed image from the current patient
+
+    # Extract the coordenates of all labeled pixels (label 0 is unlabeled data) and sort them by label.
+    # A stable sort keeps the raster order of the pixels of every label.
+    x, y = np.nonzero(gt_map)
+    labels = gt_map[x, y].astype(int)
+    order = np.argsort(labels, kind = 'stable')
+    x, y, labels = x[order], y[order], labels[order]
+
+    # Get the label4Class of every unique label and map it to every labeled pixel
+    unique_labels, label_idx = np.unique(labels, return_inverse = True)
+    label4Classes = np.array([dic_label.get(str(label)) for label in unique_labels], dtype = int)[label_idx]
+
+    return {'pad_preProcessedImage': _pad_array(preProcessedImage, pad_margin, dtype = dtype),
+            'pad_groundTruthMap': _pad_array(gt_map, pad_margin),
+            'label_coords': np.array([x, y, labels]).transpose(),
+            'data': preProcessedImage[x, y].astype(dtype, copy = False),
+            'label': labels.reshape((-1, 1)),
+            'label4Classes': label4Classes.reshape((-1, 1)),
+            'coords': np.array([x, y, np.full(x.shape, patientNum)]).transpose()}
+
+def _bounded_map(workers, fn, args_list, window):
+    """
+    (Private method) Generator equivalent to 'workers.map(fn, *zip(*args_list))', but only 'window' calls are submitted ahead of the result
+    being consumed. 'Executor.map()' submits all calls at once, so every result would be kept in memory until it is consumed.
+    Results are yielded in the order of 'args_list'.
+    """
+    args_iter = iter(args_list)
+    futures = deque(workers.submit(fn, *args) for args in itertools.islice(args_iter, window))
+    while futures:
+        result = futures.popleft().result()
+        for args in itertools.islice(args_iter, 1):
+            futures.append(workers.submit(fn, *args))
+        yield result
+
+def _pad_array(array, pad_margin, dtype = None):
+    """
+    (Private method) Apply a constant padding (zeros) of 'pad_margin' to the height and width dimensions of 'array' (not the spectral channels).
+    The padded array is allocated once and 'array' is copied (and converted to 'dtype', if given) inside it.
+    """
+    height, width = array.shape[0], array.shape[1]
+    padded = np.zeros((height + 2*pad_margin, width + 2*pad_margin) + array.shape[2:], dtype = array.dtype if dtype is None else dtype)
+    padded[pad_margin : pad_margin + height, pad_margin : pad_margin + width] = array
+    return padded
+
+def _unpad_array(padded, pad_margin):
+    """
+    (Private method) Return the view of 'padded' without the padding added by '_pad_array()' (no copy is done).
+    """
+    return padded[pad_margin : padded.shape[0] - pad_margin, pad_margin : padded.shape[1] - pad_margin]
+
+def _file_hash(path):
+    """
+    (Private method) Return the SHA-1 hash (hexadecimal string) of the content of the file in 'path'. The file is read in chunks.
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _patch_bank_is_valid(bank_path, metadata):
+    """
+    (Private method) Check if the patch bank in 'bank_path' exists and was built with the same 'metadata' (source hashes, patch size, dtype and labels).
+    """
+    if not os.path.isfile(bank_path + '.json'):
+        return False
+    with open(bank_path + '.json') as f:
+        bank_metadata = json.load(f)
+    return all(bank_metadata.get(key) == value for key, value in metadata.items())
+
+def _write_patch_bank(bank_path, metadata, pad_cube, x, y, label4Classes, patch_size):
+    """
+    (Private method) Write the patch bank of 1 patient. Patches are saved as 1 contiguous array (num_patches, height, width, num_features)
+    in '<bank_path>.patches.bin', and label4Classes and (x, y) coordenates in '<bank_path>.label4Classes.bin' and '<bank_path>.coords.bin'.
+    The '<bank_path>.json' metadata file is written last, so an interrupted bank is built again.
+    """
+    os.makedirs(os.path.dirname(bank_path) or '.', exist_ok = True)
+
+    # '_get_patches_from_cube()' returns a transposed view of contiguous (num_patches, height, width, num_features) patches
+    patches = np.ascontiguousarray(np.transpose(_get_patches_from_cube(pad_cube, x, y, patch_size), (0, 2, 3, 1)))
+    patches.tofile(bank_path + '.patches.bin')
+    np.ascontiguousarray(label4Classes, dtype = np.int64).tofile(bank_path + '.label4Classes.bin')
+    np.ascontiguousarray(np.array([x, y]).transpose(), dtype = np.int64).tofile(bank_path + '.coords.bin')
+
+    with open(bank_path + '.json', 'w') as f:
+        json.dump(dict(metadata, patches_shape = list(patches.shape)), f)
+
+def _load_patch_bank(bank_path, gt_shape):
+    """
+    (Private method) Open the patch bank of 1 patient as read-only memory maps. It returns a Python dictionary with the
+    'patches', 'label4Classes' and 'coords' arrays, and a 'row_map' array with the shape of the padded ground-truth map
+    ('gt_shape') that stores the row in the bank of every labeled pixel (-1 for unlabeled pixels).
+    """
+    with open(bank_path + '.json') as f:
+        metadata = json.load(f)
+
+    shape = tuple(metadata['patches_shape'])
+    num_patches = shape[0]
+
+    #*###############################################
+    #* IF ELSE STATEMENT TO MAP THE BANK ARRAYS
+    #* ('np.memmap' can not map empty files)
+    #*
+    if (num_patches == 0):
+        patches = np.zeros(shape, dtype = np.dtype(metadata['dtype']))
+        label4Classes = np.zeros(0, dtype = np.int64)
+        coords = np.zeros((0, 2), dtype = np.int64)
+    else:
+        patches = np.memmap(bank_path + '.patches.bin', dtype = np.dtype(metadata['dtype']), mode = 'r', shape = shape)
+        label4Classes = np.memmap(bank_path + '.label4Classes.bin', dtype = np.int64, mode = 'r', shape = (num_patches,))
+        coords = np.memmap(bank_path + '.coords.bin', dtype = np.int64, mode = 'r', shape = (num_patches, 2))
+    #*
+    #* END OF IF ELSE
+    #*################
+
+    row_map = np.full(gt_shape, -1, dtype = np.int64)
+    row_map[coords[:, 0], coords[:, 1]] = np.arange(num_patches)
+
+    return {'patches': patches, 'label4Classes': label4Classes, 'coords': coords, 'row_map': row_map}
+
+def _get_patches_from_banks(patch_banks, patientNums, x, y):
+    """
+    (Private method) Gather the patches centered in the input coordenates of different patients from their patch banks.
+    Patches are returned with the same dimensions and memory format as '_get_patches_from_patients()'.
+
+    Inputs
+    ----------
+    - 'patch_banks':    Python list with the patch bank of every patient (see '_load_patch_bank()').
+    - 'patientNums':    Numpy array with the patient number of every patch.
+    - 'x' and 'y':      Coordenates of labeled pixels in the padded ground-truth map of their patient.
+
+    Outputs
+    ----------
+    - 'patches':    Numpy array with all gathered patches.
+    """
+    patientNums = np.asarray(patientNums)
+    x, y = np.asarray(x), np.asarray(y)
+
+    bank_shape = patch_banks[0]['patches'].shape
+    patches = np.empty((len(patientNums),) + bank_shape[1:], dtype = patch_banks[0]['patches'].dtype)
+
+    for p in np.unique(patientNums):
+        idx = np.nonzero(patientNums == p)[0]
+        patches[idx] = patch_banks[p]['patches'][patch_banks[p]['row_map'][x[idx], y[idx]]]
+
+    # Move the spectral bands to the second dimension (transposed view, as in '_get_patches_from_cube()')
+    return np.transpose(patches, (0, 3, 1, 2))
+
+def convert_mat_to_store(mat_path, fields, dir_store, metadata = None):
+    """
+    Convert the numpy arrays of a '.mat' file to a binary store that can be opened as memory maps with 'load_mat_store()'.
+    Every field is saved as raw C-ordered data in '<dir_store>/<mat file name>.<field>.bin' and its shape and data type are saved
+    with the size and modification time of the '.mat' file in '<dir_store>/<mat file name>.json'. The metadata is written last,
+    so an interrupted conversion is never used.
+
+    Inputs
+    ----------
+    - 'mat_path':   String with the path of the '.mat' file.
+    - 'fields':     Python list with the name fields of the '.mat' file to convert.
+    - 'dir_store':  String with the path directory of the store. It is created if it does not exist.
+    - 'metadata':   (Optional) Python dictionary with the current (up to date) metadata of the store. Its fields are kept in the new metadata,
+                    so only the fields in 'fields' are converted and added to the store.
+
+    Outputs
+    ----------
+    - Python dictionary with the metadata of the store.
+    """
+    os.makedirs(dir_store, exist_ok = True)
+    store_path = os.path.join(dir_store, os.path.splitext(os.path.basename(mat_path))[0])
+
+    mat = loadmat(mat_path)
+    source = os.stat(mat_path)
+    fields_metadata = dict(metadata['fields']) if metadata is not None else {}
+    metadata = {'source': os.path.basename(mat_path), 'source_size': source.st_size, 'source_mtime': source.st_mtime, 'fields': fields_metadata}
+
+    for field in fields:
+        array = np.ascontiguousarray(mat[field])
+        array.tofile(store_path + '.' + field + '.bin')
+        metadata['fields'][field] = {'shape': list(array.shape), 'dtype': array.dtype.str}
+
+    with open(store_path + '.json', 'w') as f:
+        json.dump(metadata, f)
+
+    return metadata
+
+def load_mat_store(mat_path, fields, dir_store = None):
+    """
+    Load the numpy arrays of a '.mat' file. If 'dir_store' is None, the file is parsed with 'scipy.io.loadmat'.
+    Otherwise, the '.mat' file is converted only once with 'convert_mat_to_store()' (or again if its size or modification time changed)
+    and the fields are opened as read-only 'np.memmap' arrays, so no data is read until it is used.
+
+    Inputs
+    ----------
+    - 'mat_path':   String with the path of the '.mat' file.
+    - 'fields':     Python list with the name fields of the '.mat' file to load.
+    - 'dir_store':  (Optional) String with the path directory of the store.
+
+    Outputs
+    ----------
+    - Python dictionary with the numpy arrays of every field in 'fields'.
+    """
+    if dir_store is None:
+        mat = loadmat(mat_path)
+        return {field: mat[field] for field in fields}
+
+    store_path = os.path.join(dir_store, os.path.splitext(os.path.basename(mat_path))[0])
+
+    # Read the metadata of the store (if it exists) and check if it is up to date with the '.mat' file (if it still exists)
+    metadata = None
+    if os.path.isfile(store_path + '.json'):
+        with open(store_path + '.json') as f:
+            metadata = json.load(f)
+        if os.path.isfile(mat_path):
+            source = os.stat(mat_path)
+            if (metadata['source_size'] != source.st_size) or (metadata['source_mtime'] != source.st_mtime):
+                metadata = None
+
+    # Convert the '.mat' file if the store is missing or outdated. If it is up to date but does not include all fields,
+    # only the missing fields are converted and the fields already in the store are kept.
+    if metadata is None:
+        metadata = convert_mat_to_store(mat_path, fields, dir_store)
+    else:
+        missing_fields = [field for field in fields if field not in metadata['fields']]
+        if missing_fields:
+            metadata = convert_mat_to_store(mat_path, missing_fields, dir_store, metadata = metadata)
+
+    arrays = {}
+    for field in fields:
+        shape = tuple(metadata['fields'][field]['shape'])
+        dtype = np.dtype(metadata['fields'][field]['dtype'])
+        # 'np.memmap' can not map empty files
+        if (np.prod(shape) == 0):
+            arrays[field] = np.zeros(shape, dtype = dtype)
+        else:
+            arrays[field] = np.memmap(store_path + '.' + field + '.bin', dtype = dtype, mode = 'r', shape = shape)
+
+    return arrays
+
+#*#### END EXTRA METHODS  #####
+#*#############################
@@ -10,6 +10,7 @@ import torch.nn.functional as F     # Import Pytorch nn.functional as F
 from tqdm import tqdm               # Import tqdm, a python library used to add progress bars that show the processing behind the execution of the program
 import matplotlib.pyplot as plt     # Import matplotlib to create loss and accuracy plot
 import numpy as np                  # Import numpy
+from timeit import default_timer as timer       # Import timeit to measure the training throughput
 
 
 # ? GPU FUNCTIONALITY HERE
@@ -17,6 +18,47 @@ import numpy as np                  # Import numpy
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 # device = 'cpu'
 
+# Flag to know if 'configure_backend()' has been called (if not, 'trainNet()' calls it with the default values)
+backend_configured = False
+
+def configure_backend(device_name = None, num_threads = None, num_interop_threads = None, mkldnn = None):
+    """
+    Configure the device and the CPU threads used to train and predict with the Neural Networks of this file.
+    By default, the GPU is used if available and the CPU otherwise, so models can also be trained in CPU-only nodes.
+
+    Inputs
+    ----------
+    - 'device_name':            String with the PyTorch device (e.g. 'cpu' or 'cuda:0'). If None, 'cuda:0' is used if available and 'cpu' otherwise.
+    - 'num_threads':            Integer. Number of threads used inside every operation (intra-op). If None, the current PyTorch setting is kept
+                                (which respects 'OMP_NUM_THREADS' and previous calls to 'torch.set_num_threads()').
+    - 'num_interop_threads':    Integer. Number of threads used to run independent operations (inter-op). If None, the current PyTorch setting is kept.
+                                - Note: PyTorch only allows to change it before running any parallel work, so later changes are ignored.
+    - 'mkldnn':                 (Optional) Flag to use the MKL-DNN (oneDNN) CPU kernels for convolutions. They are enabled by default in PyTorch,
+                                so it is mainly useful as a switch to disable them (False). If None, the current setting is kept.
+
+    Outputs
+    ----------
+    - 'device': PyTorch device used by the models
+    """
+    global device, backend_configured
+
+    device = torch.device(device_name if device_name is not None else ("cuda:0" if torch.cuda.is_available() else "cpu"))
+
+    # Threads and kernels are only changed if they are given, so the user settings are not overridden
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            pass
+    if mkldnn is not None:
+        torch.backends.mkldnn.enabled = mkldnn
+
+    backend_configured = True
+
+    return device
+
 #*###############################
 #*#### FourLayerNet class  #####
 #*
@@ -77,13 +119,14 @@ class FourLayerNet(nn.Module):
 
         return x
 
-    def trainNet(self, batch_x, batch_y, epochs = 500, plot = False, lr = 0.002):
+    def trainNet(self, batch_x, batch_y = None, epochs = 500, plot = False, lr = 0.002):
         """
         Train the FourLayerNet Neural Network.
         
         Inputs
         ----------
-        - batch_x:  Python list containing PyTorch tensor batches destined for training
+        - batch_x:  Python list containing PyTorch tensor batches destined for training.
+                    It can also be an iterable yielding (data, labels) batches, like a 'BatchStream' from 'generate_batches()'. Then, 'batch_y' is not used.
         - batch_y:  Python list containing PyTorch tensor batches labels destined for training
         - epochs:   Number of epochs to run over the training data
         - plot:     Flag to whether or not plot the loss and accuracy per epoch
@@ -124,7 +167,7 @@ class FourLayerNet(nn.Module):
             #*###############################################################
             #* FOR LOOP TO ITERATE OVER ALL TRAINING BATCHES ON EVERY EPOCH
             #*
-            for X, Y in zip(batch_x, batch_y):
+            for X, Y in (zip(batch_x, batch_y) if batch_y is not None else batch_x):
 
                 # ? GPU FUNCTIONALITY HERE
                 # Transfer the current batch tensors to the GPU if available
@@ -287,11 +330,15 @@ class Conv2DNet(nn.Module):
 
         Attributes
         - fig_epoch_loss_acc:   PyPlot figure with the epoch/loss-accuracy plot.
+        - samples_per_second:   Number of training samples processed per second in the last call to 'trainNet()'.
+        - epochs_trained:       Number of epochs trained in the last call to 'trainNet()' (less than 'epochs' if it was stopped early).
         """
 
         super(Conv2DNet, self).__init__()
 
         self.fig_epoch_loss_acc = None
+        self.samples_per_second = None
+        self.epochs_trained = 0
 
         # todo: Properly define the CNN architecture
 
@@ -323,17 +370,24 @@ class Conv2DNet(nn.Module):
         x = self.fc(x)
         return x
 
-    def trainNet(self, batch_x, batch_y, epochs = 500, plot = False, lr = 0.002):
+    def trainNet(self, batch_x, batch_y = None, epochs = 500, plot = False, lr = 0.002, channels_last = False, epoch_callback = None):
         """
-        Train the Conv2DNet Neural Network
+        Train the Conv2DNet Neural Network in the device selected by 'configure_backend()' (the GPU if available and the CPU otherwise).
+        The number of training samples processed per second is printed and stored in 'self.samples_per_second'.
         
         Inputs
         ----------
-        - batch_x:  Python list containing PyTorch tensor batches destined for training
+        - batch_x:  Python list containing PyTorch tensor batches destined for training.
+                    It can also be an iterable yielding (data, labels) batches, like a 'BatchStream' from 'generate_batches()'. Then, 'batch_y' is not used.
+                    Python lists and packed batches ('batch_to_tensor(packed = True)') are moved to the GPU once before training and stay there.
         - batch_y:  Python list containing PyTorch tensor batches labels destined for training
         - epochs:   Number of epochs to run over the training data
         - plot:     Flag to whether or not plot the loss and accuracy per epoch
         - lr:       Learning rate used in the optimizer  
+        - channels_last:    Flag to use the 'channels_last' memory format of PyTorch for the model and the batches (usually faster convolutions in CPUs).
+                            Patches created by 'CubeManager' are already in this format, so they are not copied.
+        - epoch_callback:   (Optional) Function called after every epoch with the epoch number (starting at 1). If it returns True, training is stopped
+                            early (for example, to prune unpromising models). The model can be evaluated inside the function.
         """
     	# Define two empty arrays that will store, for each epoch, the cost and the accuracy
     	# These arrays basically are as big as the number of epochs (or iterations) over the
@@ -343,13 +397,20 @@ class Conv2DNet(nn.Module):
         loss_train = np.zeros(epochs+1)     # We add +1 for the plot graph. The first element would not be used, then we have to add another zero.
         accuracy = np.zeros(epochs+1)
 
+        # ? GPU FUNCTIONALITY HERE
+        # Select the device (if not done yet, keeping the CPU threads of PyTorch) and store the model inside the device memory.
+        # The model is moved before creating the optimizer, so the optimizer works with the parameters in the device.
+        if not backend_configured:
+            configure_backend()
+        self.to(device, memory_format = torch.channels_last if channels_last else torch.preserve_format)
+
         # Loss and Optimizer
         optimizer = torch.optim.Adam(self.parameters(), lr = lr)    # 'self' is the model itself. We are basically doing 'model.parameters()'
         criterion = torch.nn.CrossEntropyLoss()
 
-        # ? GPU FUNCTIONALITY HERE
-        # Store the model inside the GPU memory
-        self.cuda()
+        # Keep the training set resident in the GPU: lists are transferred once and packed batches with 1 single bulk copy
+        # (batches of streams are transferred in the training loop, since they are gathered again every epoch)
+        batch_x, batch_y = batches_to_device(batch_x), batches_to_device(batch_y)
 
         # Set the model to train mode to let know PyTorch that during backpropagation
         # it should not apply drop-out, batch norm or any layer with special behaviours
@@ -360,31 +421,35 @@ class Conv2DNet(nn.Module):
         #* FOR LOOP TO TRAIN THE MODEL WITHT THE CORRESPONDING NUMBER OF EPOCHS
         #* IT ALSO SHOWS A PROGRESS BAR THAT INCREASES ON EVERY EPOCH
         #*
-        print("\n\t\t\t Started training your Neural Network of type: ", str(type(self)))
+        print("\n\t\t\t Started training your Neural Network of type: ", str(type(self)), "in", str(device))
+
+        num_samples = 0     # Number of samples processed in all epochs, used to measure the throughput
+        self.epochs_trained = 0
+        start = timer()
 
         # Start at 1 and end with the number of epochs  
         for epoch in range(1, epochs+1, 1): #tqdm(range(epochs)):
 
-            running_loss = 0.0
-            correct_train = 0.0
+            # Loss and accuracy are accumulated in the device, so the host only waits for them once per epoch
+            running_loss = torch.zeros((), dtype = torch.float64, device = device)
+            correct_train = torch.zeros((), dtype = torch.float64, device = device)
+            num_batches = 0
 
             #*###############################################################
             #* FOR LOOP TO ITERATE OVER ALL TRAINING BATCHES ON EVERY EPOCH
             #*
-            for X, Y in zip(batch_x, batch_y):
+            for X, Y in (zip(batch_x, batch_y) if batch_y is not None else batch_x):
 
                 # ? GPU FUNCTIONALITY HERE
-                # Transfer the current batch tensors to the GPU if available
-                X = X.to(device)
-                Y = Y.to(device)
+                # Transfer the current batch tensors to the GPU if they are not there yet (numpy batches are converted without copies)
+                X = torch.as_tensor(X).to(device)
+                Y = torch.as_tensor(Y).to(device)
+                if channels_last:
+                    X = X.contiguous(memory_format = torch.channels_last)
 
                 # Forward pass. This will automatically call the 'forward(self, x)' method
                 y_pred = self(X)    # 'self' is the model itself. We are basically doing 'model(X)'
 
-                # ? GPU FUNCTIONALITY HERE
-                # Transfer the created tensor to the GPU
-                y_pred = y_pred.to(device)
-
                 # Compute loss.
                 # Loss function needs the predicted outputs from 'sef.model()' (or 'self(x)' in our case) and a row vector
                 # with the same number of elements as the number of entries (rows) in 'y_pred'
@@ -404,20 +469,33 @@ class Conv2DNet(nn.Module):
                 # Calling the step function on an Optimizer makes an update to its parameters
                 optimizer.step()
 
-                # Apply softmax and get the value of the tensor with highest probability. Store the predicted class in 'predicted
-                predicted =  torch.argmax(F.softmax(y_pred, dim = 1), dim = 1)
-                # Sum the correct train of the current mini-batch
-                correct_train += ((predicted == Y[:, -1] - 1).sum().item()) / (predicted.shape[0])
-                # Sum the loss of the current mini-batch
-                running_loss += loss.item()
-
-                loss_train[epoch] = running_loss/len(batch_x)
-                accuracy[epoch] = correct_train/len(batch_x)
+                # Get the class with highest output (softmax does not change it). Store the predicted class in 'predicted'
+                predicted =  torch.argmax(y_pred.detach(), dim = 1)
+                # Sum the correct train of the current mini-batch (without waiting for the device)
+                correct_train += (predicted == Y[:, -1] - 1).sum().double() / predicted.shape[0]
+                # Sum the loss of the current mini-batch (without waiting for the device)
+                running_loss += loss.detach()
+                num_batches += 1
+                num_samples += X.shape[0]
             #*
             #* END FOR LOOP
             #*##############
+
+            # Copy the epoch loss and accuracy to the host (the only synchronization of the epoch)
+            loss_train[epoch], accuracy[epoch] = (torch.stack((running_loss, correct_train)) / max(num_batches, 1)).tolist()
+            self.epochs_trained = epoch
+
+            # Stop training if requested. Otherwise, set the model to train mode again (the callback may have evaluated it)
+            if epoch_callback is not None:
+                if epoch_callback(epoch):
+                    print("\t\t\t Training stopped early at epoch", epoch)
+                    break
+                self.train()
         
-        print("\t\t\t Finished training! Your model is now ready to predict.\n")
+        self.samples_per_second = num_samples / (timer() - start)
+
+        print("\t\t\t Finished training! Your model is now ready to predict.")
+        print("\t\t\t Training throughput: %.1f samples/s\n" % self.samples_per_second)
         #*
         #* END FOR LOOP
         #*##############
@@ -445,13 +523,16 @@ class Conv2DNet(nn.Module):
         if(plot):
             plt.show()
 
-    def predict(self, batch_x):
+    def predict(self, batch_x, channels_last = False):
         """
         Predict 3D patches of data with a Conv2DNet model.
         
         Inputs
         ----------
-        - 'batch_x':        PyTorch tensor batches to predict
+        - 'batch_x':        PyTorch tensor batches to predict (any iterable of batches, like the generator returned by 'BatchStream.data()')
+                            Packed batches ('batch_to_tensor(packed = True)') are moved to the GPU at once. Any other batches (Python lists
+                            included) are moved 1 by 1 inside the loop, so only 1 batch of them is in the GPU at a time.
+        - 'channels_last':  Flag to use the 'channels_last' memory format of PyTorch for the model and the batches (see 'trainNet()').
         
         Outputs
         ----------
@@ -461,6 +542,14 @@ class Conv2DNet(nn.Module):
         # Create empty Python lists to store all labels predicted for every batch
         pred_labels = []
 
+        # Transfer packed batches to the GPU with 1 single bulk copy. Lists are not moved by 'batches_to_device()' here,
+        # since the whole prediction set would be copied to the GPU before predicting the first batch.
+        if not isinstance(batch_x, (list, tuple)):
+            batch_x = batches_to_device(batch_x)
+
+        if channels_last:
+            self.to(memory_format = torch.channels_last)
+
         with torch.no_grad():
             self.eval()             # 'self' is the model itself. We are basically doing 'model.eval()' 
 
@@ -471,8 +560,10 @@ class Conv2DNet(nn.Module):
             for X in batch_x:
 
                 # ? GPU FUNCTIONALITY HERE
-                # Transfer the current batch tensor to the GPU if available
-                X = X.to(device)
+                # Transfer the current batch tensor to the GPU if available (numpy batches are converted without copies)
+                X = torch.as_tensor(X).to(device)
+                if channels_last:
+                    X = X.contiguous(memory_format = torch.channels_last)
 
                 # For every single batch 'X', we calculate the label probabilities for every element.
                 # 'ps' is an array where each row represents the probabilities of each element to be one of the output classes returned by the model.
@@ -488,6 +579,81 @@ class Conv2DNet(nn.Module):
 
         return np.transpose(np.concatenate(pred_labels, axis = 1))
 
+    def predict_dense(self, cube, pad_margin, tile_rows = None):
+        """
+        Predict every pixel of an entire padded cube in 1 single pass (or in tiles of rows) with a Conv2DNet model.
+        Instead of extracting 1 patch per pixel, the conv/pool/fc layers are applied as an equivalent fully-convolutional network:
+            - Conv2d:       Same convolution applied over the entire cube.
+            - MaxPool2d:    Max pooling with stride 1, so that the pooled values of every patch are kept.
+            - Linear (1st): Convolution with the weights reshaped to (out_features, conv_channels, k, k) and dilation equal to the pooling size,
+                            which combines the pooled values of each patch exactly as the flattened patch is combined by the layer.
+            - Linear (2nd): 1x1 convolution.
+        Each output pixel is then the prediction of the patch centered in that pixel, so results are the same as 'predict()' with all patches of the cube.
+
+        Inputs
+        ----------
+        - 'cube':           Numpy array. Preprocessed cube with already added padding with dimensions (height, width, num_features).
+        - 'pad_margin':     Integer. Padding added to the height and width of the cube.
+        - 'tile_rows':      Integer. Number of output rows predicted in every pass. If None, the entire cube is predicted in 1 single pass.
+
+        Outputs
+        ----------
+        - 'pred_map':       Numpy array with dimensions (height, width) of the cube without padding, with the predicted label of every pixel.
+        """
+        conv = self.conv[0]         # Conv2d layer
+        pool = self.conv[1]         # MaxPool2d layer
+        fc_1 = self.fc[0]           # First Linear layer
+        fc_2 = self.fc[2]           # Second Linear layer
+
+        # Size of the pooled patches (3 if patches are 7x7) and patch size that the network expects
+        pool_size = pool.kernel_size
+        pooled_size = int(round(np.sqrt(fc_1.in_features / conv.out_channels)))
+        patch_size = conv.kernel_size[0] - 1 + pool_size * pooled_size
+
+        # Reshape the Linear weights as convolution kernels. 'nn.Flatten()' flattens patches as (channels, height, width),
+        # so the first Linear layer weights are reshaped in the same order.
+        fc_1_weight = fc_1.weight.reshape(fc_1.out_features, conv.out_channels, pooled_size, pooled_size)
+        fc_2_weight = fc_2.weight.reshape(fc_2.out_features, fc_2.in_features, 1, 1)
+
+        # Dimensions of the cube without padding and start coordenate of the patch of the first pixel
+        height = cube.shape[0] - 2*pad_margin
+        width = cube.shape[1] - 2*pad_margin
+        start = pad_margin - int(patch_size/2)
+
+        if tile_rows is None: tile_rows = height
+
+        # Create empty Python list to store the predicted labels of every tile of rows
+        pred_tiles = []
+
+        with torch.no_grad():
+            self.eval()             # 'self' is the model itself. We are basically doing 'model.eval()' 
+
+            #*##################################################
+            #* FOR LOOP TO ITERATE OVER ALL TILES OF ROWS
+            #*
+            for row in range(0, height, tile_rows):
+
+                last_row = min(row + tile_rows, height)
+
+                # Extract the cube rows needed to predict the tile (the tile rows plus the surroundings of the patches)
+                # and convert them to a tensor with dimensions (1, num_features, height, width)
+                X = torch.from_numpy(cube[start + row : start + last_row + patch_size - 1, start : start + width + patch_size - 1, :])
+                X = X.permute(2, 0, 1).unsqueeze(0).type(conv.weight.dtype).to(conv.weight.device)
+
+                # Fully-convolutional forward pass
+                X = F.conv2d(X, conv.weight, conv.bias, stride = conv.stride, padding = conv.padding)
+                X = F.relu(F.max_pool2d(X, kernel_size = pool_size, stride = 1))
+                X = F.relu(F.conv2d(X, fc_1_weight, fc_1.bias, dilation = pool_size))
+                X = F.conv2d(X, fc_2_weight, fc_2.bias)
+
+                # Most probable label for every pixel of the tile (+1 since labels start at 1)
+                pred_tiles.append(torch.argmax(X[0], dim = 0).cpu().numpy() + 1)
+            #*
+            #* END FOR LOOP
+            #*##############
+
+        return np.concatenate(pred_tiles, axis = 0)
+
     #*
     #*#### END DEFINED Conv2DNet METHODS #####
     #*########################################   
@@ -514,6 +680,28 @@ def probs_2_label(one_hot_vects):
     """ 
     return np.array([np.where(r == np.amax(r))[0] + 1 for r in one_hot_vects]).transpose()
 
+def batches_to_device(batches, non_blocking = True):
+    """
+    Move all batches to 'device' once, so they stay resident in the device for every epoch. Packed batches (like the 'PackedBatches'
+    returned by 'batch_to_tensor(packed = True)') are moved with 1 single bulk transfer, and Python lists (or tuples) batch by batch.
+    Other batches (streams or generators) are returned as they are, since they are gathered again every epoch.
+    Moving Python lists needs the device memory of all of them at the same time, so it is meant for training sets that are iterated every epoch.
+
+    Inputs
+    ----------
+    - 'batches':        Batches to move. Packed batches are identified because they have a 'to()' method.
+    - 'non_blocking':   Flag to transfer asynchronously (only if the batches are in pinned memory).
+
+    Outputs
+    ----------
+    - Batches in 'device' (or the input batches if they can not be moved before iterating over them)
+    """
+    if callable(getattr(batches, 'to', None)):
+        return batches.to(device, non_blocking = non_blocking)
+    if isinstance(batches, (list, tuple)):
+        return [torch.as_tensor(batch).to(device, non_blocking = non_blocking) for batch in batches]
+    return batches
+
 #*
 #*#### END EXTRA METHODS  #####
 #*#############################
\ No newline at end of file
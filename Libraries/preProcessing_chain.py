@@ -1,4 +1,7 @@
 # Import libraries
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 
 ####################################################
@@ -6,7 +9,7 @@ import numpy as np
 ####################################################
 
 # Spectral correction matrix for 650nm filter
-matrix650 = np.matrix([
+matrix650 = np.array([
     [-0.123638, -0.0540388, -0.040208, 0.00775416, -0.133549, -0.00888526, 0.000647892, 0.00101151, 0.00345197,
      0.00299808, -0.00877219, -4.44255e-005, -0.00223538, -0.00341204, -0.00312183, -0.0740077, -0.0154072, 0.00285804,
      0.00217558, -0.0169405, 1.61723, -0.0800448, 0.0247248, 0.00851731, -0.10706],
@@ -99,29 +102,47 @@ def f_cube(image):
     return image[:-3,:-3].reshape(filter_height, filter_width//5, 5).transpose(1,0,2).reshape(filter_width//5, filter_height//5, bands).transpose(1,0,2)
 
 ### WHITE AND DARK CALIBRATION
-def f_calibration(image, imageW, imageD):
+def f_calibration(image, imageW, imageD, dtype = np.float64):
     # f_calibration
     #  Calibrate the input 2D image (.tif, .png...) using its white reference 'imageW' and dark reference 'imageD'
     # input: image [MxN] matrix (uint8 or uint16) (for 8 and 10 bit images)
-    # output: image cube [mxn] matrix (double)
+    #        dtype  data type of the calibrated image (np.float64 or np.float32). Inputs are converted before substracting.
+    # output: image cube [mxn] matrix (dtype)
 
     # Return calibrated image
-    return ((image - imageD)/(imageW - imageD))
+    calibrated = np.subtract(image, imageD, dtype = dtype)
+    return np.divide(calibrated, np.subtract(imageW, imageD, dtype = dtype), out = calibrated)
 
 ### XIMEA SNAPSHOT SPECTRAL CORRECTION
-def f_spectral_correction(img_cube, matrix = matrix650):
+def f_spectral_correction(img_cube, matrix = matrix650, dtype = np.float64, inplace = False):
     # f_spectral_correction
     # Input: 
     #       img_cube    hyperspectral cube from the img
+    #       matrix      spectral correction matrix [bxb]
+    #       dtype       data type of the corrected cube (np.float64 or np.float32)
+    #       inplace     if True, the correction is written in 'img_cube' (it must be a C-contiguous array of type 'dtype')
     # Output: 
     #       cubes with the spectral correction as explain in the xispect specifications 
-    # Declare the output matrix previous to the loop
-    imSpec = np.zeros((img_cube.shape[0], img_cube.shape[1], img_cube.shape[2]))
 
-    for i in range(img_cube.shape[0]):
-        for j in range(img_cube.shape[1]):
-            # Multiply the input cube with the corresponding correction matrix
-            imSpec[i,j,:] = np.matmul(matrix, img_cube[i, j, :])
+    # Correcting every pixel is 'matrix * pixel', so the entire cube can be corrected with 1 single matrix multiplication
+    # of all pixels as rows of a [(m*n)xb] matrix by the transposed correction matrix: '[(m*n)xb] * [bxb]'
+    matrix_T = np.asarray(matrix, dtype = dtype).T
+
+    if inplace:
+        if not (img_cube.dtype == dtype and img_cube.flags['C_CONTIGUOUS']):
+            raise RuntimeError("Expected a C-contiguous 'img_cube' of type " + str(np.dtype(dtype)) + " to apply the spectral correction in place.")
+
+        # Multiply blocks of pixels so that only 1 small block is copied at a time (the matrix multiplication can not write over its input)
+        pixels = img_cube.reshape(-1, img_cube.shape[-1])
+        block = 65536
+        for start in range(0, pixels.shape[0], block):
+            pixels[start:start + block] = np.matmul(pixels[start:start + block], matrix_T)
+
+        return img_cube
+
+    # Declare the output cube and multiply all pixels writting the result directly on it
+    imSpec = np.empty(img_cube.shape, dtype = dtype)
+    np.matmul(img_cube.reshape(-1, img_cube.shape[-1]).astype(dtype, copy = False), matrix_T, out = imSpec.reshape(-1, img_cube.shape[-1]))
 
     return imSpec
 
@@ -144,4 +165,138 @@ def f_norm_helicoid(img_cube):
     # "operands could not be broadcast together with shapes (X,Y,Z) (X,Y)""
     imageHelNorm = img_cube/pixBrightness[:, :, None];
                             
-    return imageHelNorm
\ No newline at end of file
+    return imageHelNorm
+
+### FUSED PRE-PROCESSING CHAIN
+def f_fused_preProcessing(image, imageW, imageD, pad_margin = 0, matrix = matrix650, dtype = np.float64, block_rows = 16, reference = None):
+    # f_fused_preProcessing
+    #  Apply 'f_calibration', 'f_cube', 'f_spectral_correction' and 'f_norm_helicoid' to the snapshot raw image
+    #  in a single pass over blocks of cube rows, and write the result directly inside a padded output cube.
+    #  Each cube row only depends on 'side' raw rows (5 for 25 bands), so only small blocks are processed at a time using
+    #  scratch buffers that are reused for every block. This way, no full-size temporary cube is created.
+    # input:  image         [MxN] matrix (uint8 or uint16) (for 8 and 10 bit images)
+    #         imageW        [MxN] white reference
+    #         imageD        [MxN] dark reference
+    #         pad_margin    constant padding (zeros) added to the height and width of the output cube
+    #         matrix        spectral correction matrix [bxb]
+    #         dtype         data type of the output cube (np.float64 or np.float32)
+    #         block_rows    number of cube rows processed at a time
+    #         reference     (optional) precomputed calibration reference (imageD, 1/(imageW - imageD)) from 'f_calibration_reference'.
+    #                       If used, 'imageW' and 'imageD' are ignored (can be None) and calibration is a subtract and multiply.
+    # output: padded image cube normalized [(m+2*pad_margin)x(n+2*pad_margin)xb] matrix
+    bands = matrix.shape[0]
+    side = int(np.sqrt(bands))
+
+    # Dimensions of the cube (same as 'f_cube', which discards the last 3 rows and columns of the raw image)
+    height = (image.shape[0] - 3) // side
+    width = (image.shape[1] - 3) // side
+
+    # Preallocated padded output cube and transposed correction matrix
+    padded_cube = np.zeros((height + 2*pad_margin, width + 2*pad_margin, bands), dtype = dtype)
+    matrix_T = np.asarray(matrix, dtype = dtype).T
+
+    # Scratch buffers reused for every block of rows
+    raw_block = np.empty((block_rows*side, width*side), dtype = dtype)      # Calibrated raw rows
+    ref_block = np.empty((block_rows*side, width*side), dtype = dtype)      # White minus dark reference rows
+    pixel_block = np.empty((block_rows*width, bands), dtype = dtype)        # Pixels of the block as rows (demosaiced)
+    corr_block = np.empty((block_rows*width, bands), dtype = dtype)         # Spectrally corrected pixels
+
+    for row in range(0, height, block_rows):
+
+        num_rows = min(block_rows, height - row)
+        raw_rows = slice(row*side, (row + num_rows)*side)
+        raw_cols = slice(0, width*side)
+
+        raw = raw_block[:num_rows*side]
+        ref = ref_block[:num_rows*side]
+        pixels = pixel_block[:num_rows*width]
+        corr = corr_block[:num_rows*width]
+
+        # 1. Calibration: (image - imageD)/(imageW - imageD). Inputs are converted to 'dtype' before substracting.
+        if reference is None:
+            np.subtract(image[raw_rows, raw_cols], imageD[raw_rows, raw_cols], out = raw, dtype = dtype)
+            np.subtract(imageW[raw_rows, raw_cols], imageD[raw_rows, raw_cols], out = ref, dtype = dtype)
+            np.divide(raw, ref, out = raw)
+        else:
+            np.subtract(image[raw_rows, raw_cols], reference[0][raw_rows, raw_cols], out = raw, dtype = dtype)
+            np.multiply(raw, reference[1][raw_rows, raw_cols], out = raw)
+
+        # 2. Cube formation: each 'side'x'side' mosaic of the raw image is 1 pixel with its bands in the same order as 'f_cube'
+        pixels.reshape(num_rows, width, side, side)[...] = raw.reshape(num_rows, side, width, side).transpose(0, 2, 1, 3)
+
+        # 3. Spectral correction of all pixels of the block with 1 single matrix multiplication
+        np.matmul(pixels, matrix_T, out = corr)
+
+        # 4. HELICOiD normalization: divide each pixel by its brightness and write it inside the padded cube
+        pixBrightness = np.sqrt(np.einsum('ij,ij->i', corr, corr) / bands)
+        np.divide(corr.reshape(num_rows, width, bands), pixBrightness.reshape(num_rows, width, 1),
+                  out = padded_cube[pad_margin + row : pad_margin + row + num_rows, pad_margin : pad_margin + width, :])
+
+    return padded_cube
+
+### CALIBRATION REFERENCES
+def f_calibration_reference(imageW, imageD, dtype = np.float64):
+    # f_calibration_reference
+    #  Precompute the terms of the white and dark calibration that only depend on the references,
+    #  so that calibrating any image taken in the same session is 'image - imageD' multiplied by '1/(imageW - imageD)'.
+    # input:  imageW        [MxN] white reference
+    #         imageD        [MxN] dark reference
+    #         dtype         data type of the precomputed terms
+    # output: tuple (imageD, 1/(imageW - imageD)) of [MxN] matrices of type 'dtype'
+    dark = np.asarray(imageD, dtype = dtype)
+    inv_range = np.subtract(imageW, imageD, dtype = dtype)
+    np.reciprocal(inv_range, out = inv_range)
+    return dark, inv_range
+
+class CalibrationCache:
+    """
+    Cache of precomputed calibration references (see 'f_calibration_reference') identified by a key,
+    which is either a session ID given by the user or the content hash of the white and dark references.
+    When more than 'max_references' are stored, the least recently used one is evicted.
+    """
+
+    def __init__(self, max_references = 4, dtype = np.float64):
+        self.max_references = max_references
+        self.dtype = dtype
+        self.references = OrderedDict()
+
+    @staticmethod
+    def reference_key(imageW, imageD):
+        """
+        Return the content hash (hexadecimal string) of a pair of white and dark references.
+        """
+        sha = hashlib.sha1()
+        for image in (np.ascontiguousarray(imageW), np.ascontiguousarray(imageD)):
+            sha.update(str((image.shape, image.dtype.str)).encode())
+            sha.update(image.data)
+        return sha.hexdigest()
+
+    def add(self, imageW, imageD, key = None):
+        """
+        Precompute and store the calibration reference of 'imageW' and 'imageD'.
+        If 'key' is None, the content hash of the references is used as key and nothing is recomputed
+        if it is already stored. A reference stored with the same session ID 'key' is replaced. Returns the key.
+        """
+        if key is None:
+            key = self.reference_key(imageW, imageD)
+            if key in self.references:
+                self.references.move_to_end(key)
+                return key
+
+        self.references[key] = f_calibration_reference(imageW, imageD, dtype = self.dtype)
+        self.references.move_to_end(key)
+
+        # Evict the least recently used references
+        while len(self.references) > self.max_references:
+            self.references.popitem(last = False)
+
+        return key
+
+    def get(self, key):
+        """
+        Return the calibration reference stored with 'key', or None if it is not in the cache.
+        """
+        if key not in self.references:
+            return None
+        self.references.move_to_end(key)
+        return self.references[key]
@@ -48,6 +48,9 @@ parser.add_argument('--patch_size', type=int, dest='patch_size', default=7, help
 parser.add_argument('--k_folds', type=int, dest='k_folds', default=5, help='Number of k-folds to use during double-cross validation')
 parser.add_argument('--learning_rate', type=float, dest='learning_rate', default=0.001, help='Learning rate parameter')
 parser.add_argument('--model_name', type=str, dest='model_name', default='Conv2DNet_default', help='Name of the CNN model')
+parser.add_argument('--cv_workers', type=int, dest='cv_workers', default=None, help='Number of processes training the inner folds of the double-cross validation in parallel')
+parser.add_argument('--pruning_rate', type=int, dest='pruning_rate', default=None, help='Successive-halving rate to stop unpromising inner folds early (disabled by default)')
+parser.add_argument('--patch_bank', type=str, dest='patch_bank', default=None, help='Directory of the precomputed patch banks (3D batches only). They are shared by all experiments')
 
 args = parser.parse_args()
 
@@ -62,6 +65,9 @@ patch_size = args.patch_size
 k_folds = args.k_folds
 lr = args.learning_rate
 model_name = args.model_name
+dir_patch_bank = args.patch_bank
+cv_workers = args.cv_workers
+pruning_rate = args.pruning_rate
 
 end = timer()
 
@@ -102,6 +108,10 @@ cm_train = hsi_dm.CubeManager(patch_size = patch_size, batch_size = batch_size,
 # Load all desired pixels to the 'CubeManager' instance 'cm_train' (all data is stored inside the instance attributes)
 cm_train.load_patient_cubes(patients_list_train, dir_gtMaps, dir_preProImages)
 
+# Gather the training patches from the precomputed patch banks (they are only built again if the patient files changed)
+if dir_patch_bank is not None and batch_dim == '3D':
+    cm_train.load_patch_banks(dir_patch_bank)
+
 print("\tTraining images have been loaded. Creating training batches...")
 
 # Create batches with the loaded data. Returns 'batches' which is a Python dictionary including 2 Python lists, 'data' and 'labels', containing all batches
@@ -124,7 +134,7 @@ print("Training your Neural Network. Please wait...")
 start = timer()
 
 # Create a CrossValidator instance
-cv = hsi_dm.CrossValidator(batch_data=batches_train['cube'], batch_labels=batches_train['label'], k_folds=k_folds, numUniqueLabels=cm_train.numUniqueLabels, numBands=cm_train.numBands, epochs=epochs, lr=lr)
+cv = hsi_dm.CrossValidator(batch_data=batches_train['cube'], batch_labels=batches_train['label'], k_folds=k_folds, numUniqueLabels=cm_train.numUniqueLabels, numBands=cm_train.numBands, epochs=epochs, lr=lr, num_workers=cv_workers, pruning_rate=pruning_rate)
 
 # Perform K-fold double-cross validation
 cv.double_cross_validation()
@@ -159,7 +169,8 @@ batches_test = cm_test.create_batches()
 
 print("\tTest batches have been created. Converting data batches to tensors...")
 
-# Convert 'cube' batches to PyTorch tensors for training our Neural Network
+# Convert 'cube' batches to PyTorch tensors for training our Neural Network. Test batches are not packed, since they are
+# only predicted once and packing would copy all test patches into 1 new tensor
 data_tensor_batch_test = cm_test.batch_to_tensor(batches_test['cube'], data_type = torch.float)
 
 print("\tTensors have been created.")
@@ -244,6 +255,7 @@ run.log_image(name='Model loss and accuracy by epoch', plot=model.fig_epoch_loss
 run.log('Time loading arguments (s)',  time_load_args, description='Time in seconds loading arguments from control script to run script')
 run.log('Time preparing train data (s)',  time_train_data_prep, description='Time in seconds loading datasets, preparing data to create batches and create PyTorch tensors.')
 run.log('Time training CNN (s)',  time_train_CNN, description='Time in seconds training best CNN model. Can be the time spent during double-cross validation or single training.')
+run.log('Training epochs saved by pruning',  cv.epochs_saved, description='Number of training epochs of the inner folds saved by the successive-halving pruning of the double-cross validation.')
 run.log('Time preparing test data (s)',  time_test_data_prep, description='Time in seconds loading test image, preparing data to create batches and create PyTorch tensors.')
 run.log('Time predicting GT test image (s)',  time_predict_test_im, description='Time in seconds spent predicting with the trained model the ground-truth pixels from the test image.')
 run.log('Time generating classification maps (s)',  time_generate_cMap, description='Time in seconds spent generating classification map. Figures with the predicted ground-truth classification map and also with the original ground-truth')
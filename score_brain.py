@@ -9,6 +9,7 @@ from azureml.core.model import Model
 
 import hsi_dataManager as hsi_dm    # Import 'hsi_dataManager.py' file as 'hsi_dm' to load use all desired functions 
 import metrics as mts               # Import 'metrics.py' file as 'mts' to evluate metrics
+import preProcessing_chain as ppc   # Import 'preProcessing_chain.py' file as 'ppc' to cache calibration references
 
 from timeit import default_timer as timer       # Import timeit to measure times in the script
 
@@ -19,9 +20,13 @@ from timeit import default_timer as timer       # Import timeit to measure times
 # Called when the service is loaded
 def init():
     global model
+    global calibration_cache
     # Get the path to the deployed model file and load it
     model_path = Model.get_model_path('Conv2DNet_ID0056C02_CV', version=1)
     model = joblib.load(model_path)
+    # Cache of precomputed white and dark references, since they only change between acquisition sessions.
+    # References are stored with the same precision used by 'RawManager' to preprocess (half the memory of float64)
+    calibration_cache = ppc.CalibrationCache(max_references = 4, dtype = np.float32)
 
 # Called when a request is received
 def run(json_object):
@@ -32,11 +37,23 @@ def run(json_object):
     dictionary = json.loads(json_object)
 
     raw_image = np.asarray(dictionary['raw_image'])
-    white_ref = np.asarray(dictionary['white_ref'])
-    black_ref = np.asarray(dictionary['black_ref'])
+    # Session ID of the white and dark references (optional). If the references are sent, they are cached with this ID
+    # (or with their content hash if no ID is given). Next requests of the same session only need to send the ID.
+    reference_id = dictionary.get('reference_id', None)
+    if 'white_ref' in dictionary and 'black_ref' in dictionary:
+        reference_id = calibration_cache.add(np.asarray(dictionary['white_ref']), np.asarray(dictionary['black_ref']), key = reference_id)
+    calib_reference = calibration_cache.get(reference_id)
+    if calib_reference is None:
+        raise RuntimeError("No cached white and dark references with 'reference_id' = " + str(reference_id) + ". Please send 'white_ref' and 'black_ref'.")
     patch_size = dictionary['patch_size']
     batch_size = dictionary['batch_size']
     patient_id = dictionary['patient_id']
+    # Number of patches predicted at once when classifying the entire cube (optional, 'batch_size' is used by default)
+    inference_batch_size = dictionary.get('inference_batch_size', batch_size)
+    # Flag to predict the entire cube in 1 single fully-convolutional pass instead of patch by patch (optional)
+    dense_inference = dictionary.get('dense_inference', False)
+    # Number of rows predicted in every dense pass (optional, the entire cube is predicted at once by default)
+    tile_rows = dictionary.get('tile_rows', None)
 
     end = timer()
     # Measure time elapsed parsing arguments
@@ -46,7 +63,7 @@ def run(json_object):
     start = timer()
 
     # Create an instance of 'RawManager'
-    rawManager = hsi_dm.RawManager(raw_image, white_ref, black_ref, patch_size = patch_size, batch_size = batch_size)
+    rawManager = hsi_dm.RawManager(raw_image, patch_size = patch_size, batch_size = batch_size, calib_reference = calib_reference)
 
     # Preprocess input image
     rawManager.preProcessImage()
@@ -61,14 +78,20 @@ def run(json_object):
     # Extract dimension of the loaded preProcessed cube with added padding for the input image
     dims = rawManager.pad_processedCube.shape
 
-    # Generate batches for feeding the CNN model
-    cube_batch = rawManager.create_cube_batch()
+    if dense_inference:
+        # Dense inference does not need batches, only the coordenates of every pixel of the cube in raster order
+        height, width = rawManager.processedCube.shape[0], rawManager.processedCube.shape[1]
+        cube_coordenates = np.indices((height, width)).reshape(2, -1).transpose()
+    else:
+        # Generate batches for feeding the CNN model
+        cube_batch = rawManager.create_cube_batch(batch_size = inference_batch_size)
 
-    # Convert 'cube' batches to PyTorch tensors for training our Neural Network
-    cube_tensor_batch = rawManager.batch_to_tensor(cube_batch['data'], data_type = torch.float)
+        # Convert 'cube' batches to PyTorch tensors for training our Neural Network. They are not packed, since packing copies
+        # the patches of the entire image into 1 new tensor and the batches are already zero-copy views of the cube
+        cube_tensor_batch = rawManager.batch_to_tensor(cube_batch['data'], data_type = torch.float)
 
-    # Obtain 'cube' batches coordenates
-    cube_coordenates = rawManager.concatenate_list_to_numpy(cube_batch['coords']).astype(int)
+        # Obtain 'cube' batches coordenates
+        cube_coordenates = rawManager.concatenate_list_to_numpy(cube_batch['coords']).astype(int)
 
     end = timer()
     # Measure time elapsed preparing pre-processed image to PyTorch tensors and batches
@@ -77,8 +100,13 @@ def run(json_object):
 
     start = timer()
 
-    # Predict with the hosted model in the Webservice
-    pred_labels = model.predict(batch_x = cube_tensor_batch)
+    if dense_inference:
+        # Predict every pixel with the hosted model in the Webservice as a fully-convolutional network.
+        # The predicted map is flattened in raster order, the same order as 'cube_coordenates'.
+        pred_labels = model.predict_dense(rawManager.pad_processedCube, rawManager.pad_margin, tile_rows = tile_rows).reshape((-1, 1))
+    else:
+        # Predict with the hosted model in the Webservice
+        pred_labels = model.predict(batch_x = cube_tensor_batch)
 
     # Generate classification map from the predicted labels
     title = "Patient " + patient_id + " classification Map"
@@ -92,7 +120,7 @@ def run(json_object):
     time_predict_cMap = (end - start)
 
     # Return serialized classification map PIL image to bytearray using hexadecimal encoding
-    return json.dumps({'classification_map': classification_map, 'time_parsing_data': time_parsing_data, 'time_preProcessing_data': time_preProcessing_data,
+    return json.dumps({'classification_map': classification_map, 'reference_id': reference_id, 'time_parsing_data': time_parsing_data, 'time_preProcessing_data': time_preProcessing_data,
                         'time_preparing_batches': time_preparing_batches, 'time_predict_cMap': time_predict_cMap}, cls=NumpyArrayEncoder)
     
 